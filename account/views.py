@@ -1,15 +1,12 @@
 from rest_framework.response import Response
 from rest_framework import status
 from dj_rest_auth.registration.views import RegisterView
-from chat.models import Setting
+from chat.setting_cache import get_setting
 
 
 class RegistrationView(RegisterView):
     def create(self, request, *args, **kwargs):
-        try:
-            open_registration = Setting.objects.get(name='open_registration').value == 'True'
-        except Setting.DoesNotExist:
-            open_registration = True
+        open_registration = get_setting('open_registration', 'True') == 'True'
 
         if open_registration:
             return super().create(request, *args, **kwargs)
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatConfig(AppConfig):
@@ -7,3 +8,21 @@ class ChatConfig(AppConfig):
 
     def ready(self):
         import chat.signals
+        from chatgpt_api import tokenizer
+
+        tokenizer.configure(cache_dir=settings.TOKENIZER_CACHE_DIR, offline=settings.TOKENIZER_OFFLINE,
+                            timeout=settings.TOKENIZER_DOWNLOAD_TIMEOUT)
+
+    def warm_up(self):
+        """
+        Loads the tokenizer encodings with TOKENIZER_WARM_UP. Called by the server entry points, wsgi.py and
+        asgi.py, the management commands don't need the encodings.
+        """
+        from chatgpt_api import tokenizer
+
+        if settings.TOKENIZER_WARM_UP:
+            try:
+                tokenizer.warm_up()
+            except Exception as e:
+                # Not fatal, the encodings will be loaded by the first request instead
+                print('Failed to warm up the tokenizer: %s' % e)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chat.models import Message
+from chatgpt_api.api import get_current_model
+from chatgpt_api.tokenizer import get_encoding
+
+
+class Command(BaseCommand):
+    help = 'Stores the token count of messages that were saved without one, or counted with another encoding.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--model', default=None, help='Model whose encoding is used, defaults to the current one.')
+
+    def handle(self, *args, **options):
+        encoding = get_encoding(options['model'] or get_current_model()['name'])
+        pending = Message.objects.filter(Q(token_count__isnull=True) | ~Q(token_encoding=encoding.name))
+
+        updated = 0
+        last_id = None
+        while True:
+            # walk the primary key instead of using offsets, rows drop out of `pending` as they are updated
+            batch = pending.order_by('id').only('id', 'message')
+            if last_id is not None:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:options['batch_size']])
+            if not batch:
+                break
+
+            for message_obj in batch:
+                message_obj.token_count = len(encoding.encode(message_obj.message))
+                message_obj.token_encoding = encoding.name
+            Message.objects.bulk_update(batch, ['token_count', 'token_encoding'])
+
+            updated += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write('Updated %d messages' % updated)
+
+        self.stdout.write(self.style.SUCCESS('Done, %d messages updated with %s' % (updated, encoding.name)))
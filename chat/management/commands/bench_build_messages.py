@@ -0,0 +1,86 @@
+import random
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.models import Conversation, Message
+from chatgpt_api.api import build_messages, get_current_model, set_token_count
+from chatgpt_api.tokenizer import num_tokens_from_messages
+
+WORDS = ['the', 'model', 'answer', 'token', 'context', 'window', 'python', 'django', 'stream', 'message',
+         'conversation', 'budget', 'history', 'assistant', 'user', 'because', 'latency', 'server', 'quickly', '42']
+
+
+def legacy_fit_messages(system_messages, history, max_token_count, model):
+    # The previous algorithm: re-count the whole window for every candidate message
+    current_token_count = num_tokens_from_messages(system_messages, model)
+    messages = []
+    for new_message in history:
+        if current_token_count >= max_token_count:
+            break
+        new_token_count = num_tokens_from_messages(system_messages + messages + [new_message], model)
+        if new_token_count > max_token_count:
+            if len(messages) > 0:
+                break
+            raise ValueError('Prompt is too long.')
+        messages.insert(0, new_message)
+        current_token_count = new_token_count
+    return system_messages + messages
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the context window selection of build_messages over synthetic conversations. ' \
+           'They are written in a transaction rolled back at the end.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,5000', help='Comma separated conversation lengths.')
+        parser.add_argument('--words', type=int, default=20, help='Average number of words per message.')
+        parser.add_argument('--legacy-limit', type=int, default=1000,
+                            help='Skip the quadratic algorithm above this many messages.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.bench(options)
+            transaction.set_rollback(True)
+
+    def bench(self, options):
+        model = get_current_model()
+        max_tokens = model['max_prompt_tokens']
+        system_messages = [{"role": "system", "content": "You are a helpful assistant."}]
+        rng = random.Random(0)
+        user = User.objects.create(username='bench-%s' % uuid.uuid4().hex)
+        message_count = 0
+
+        self.stdout.write('%8s %10s %14s %14s' % ('messages', 'selected', 'build_messages', 'legacy'))
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            history = [
+                {"role": "assistant" if i % 2 else "user",
+                 "content": ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 2 * options['words'])))}
+                for i in range(size)
+            ]
+            conversation_obj = Conversation.objects.create(user=user)
+            messages = []
+            for message in history:
+                # the ids follow the order of the history, for the messages created at the same time
+                message_count += 1
+                message_obj = Message(id=uuid.UUID(int=message_count), conversation=conversation_obj,
+                                      message=message['content'], is_bot=message['role'] == 'assistant')
+                set_token_count(message_obj, model['name'])
+                messages.append(message_obj)
+            Message.objects.bulk_create(messages, batch_size=500)
+
+            start = time.perf_counter()
+            selected = build_messages(conversation_obj)
+            incremental = time.perf_counter() - start
+
+            legacy = '-'
+            if size <= options['legacy_limit']:
+                start = time.perf_counter()
+                expected = legacy_fit_messages(system_messages, iter(history[::-1]), max_tokens, model['name'])
+                legacy = '%11.1f ms' % (1000 * (time.perf_counter() - start))
+                assert expected == selected
+
+            self.stdout.write('%8d %10d %11.1f ms %14s' % (size, len(selected) - 1, 1000 * incremental, legacy))
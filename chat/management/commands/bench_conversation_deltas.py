@@ -0,0 +1,94 @@
+import json
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from chatgpt_api.classes.chat import ConversationStream
+from chatgpt_api.classes.sse import ServerSentEvent
+
+WORDS = [' the', ' model', ' answer', ' "quoted"', ' C:\\path', ' 的', '回答', ' 😀', '\n', '.']
+
+
+def conversation_events(tokens):
+    # data of the backend-api/conversation events for an answer of `tokens` tokens, each with the whole answer
+    # so far, built from the escaped text so that building them costs as little as possible
+    rng = random.Random(0)
+    head = '{"message": {"id": "8a431ea6", "author": {"role": "assistant", "name": null, "metadata": {}}, ' \
+           '"create_time": 1679262119.45, "update_time": null, "content": {"content_type": "text", "parts": ["'
+    tail = '"]}, "status": "in_progress", "end_turn": null, "weight": 1.0, "metadata": {}, "recipient": "all"}, ' \
+           '"conversation_id": "f05a206e", "error": null}'
+    yield '{"message": {"id": "0", "author": {"role": "user"}, "content": {"content_type": "text", "parts": ["hi"]}}, ' \
+          '"conversation_id": "f05a206e", "error": null}'
+    escaped = ''
+    for _ in range(tokens):
+        escaped += json.dumps(rng.choice(WORDS))[1:-1]
+        yield head + escaped + tail
+
+
+class CollectingParser:
+    # The previous loop of Chat.ask: every event parsed as a whole and kept
+    def __init__(self):
+        self.collected_events = []
+        self.completion_text = ''
+
+    def feed(self, sse):
+        event = json.loads(sse.data)
+        self.collected_events.append(event)
+        if event['message']['author']['role'] != 'assistant':
+            return None
+        event_text = event['message']['content']['parts'][0]
+        delta = event_text[len(self.completion_text):]
+        self.completion_text = event_text
+        return delta
+
+
+class LoadingParser(CollectingParser):
+    # Every event parsed as a whole, only the last one kept
+    def feed(self, sse):
+        delta = super().feed(sse)
+        self.collected_events.clear()
+        return delta
+
+
+def run(parser, tokens):
+    elapsed = 0
+    deltas = []
+    for data in conversation_events(tokens):
+        sse = ServerSentEvent(data=data)
+        start = time.perf_counter()
+        delta = parser.feed(sse)
+        elapsed += time.perf_counter() - start
+        if delta is not None:
+            deltas.append(delta)
+    return ''.join(deltas), elapsed
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the extraction of answer deltas from cumulative backend-api/conversation events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=10000, help='Number of tokens, and events, of the answer.')
+
+    def handle(self, *args, **options):
+        tokens = options['tokens']
+        parsers = [('collected', CollectingParser), ('json.loads', LoadingParser), ('assembler', ConversationStream)]
+
+        expected = None
+        self.stdout.write('%12s %12s %14s %12s' % ('parser', 'time', 'per token', 'peak memory'))
+        for name, parser_class in parsers:
+            text, elapsed = run(parser_class(), tokens)
+            if expected is None:
+                expected = text
+            assert text == expected, name
+
+            # measured on its own, tracing allocations slows the parsing down
+            tracemalloc.start()
+            parser = parser_class()
+            run(parser, tokens)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            self.stdout.write('%12s %9.0f ms %11.1f us %9.1f MB' % (
+                name, 1000 * elapsed, 1e6 * elapsed / tokens, peak / 1e6))
@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from chatgpt_api.api_unofficial import iter_conversation_deltas
+
+
+class MockConversationHandler(BaseHTTPRequestHandler):
+    # Mimics chat.openai.com/backend-api/conversation: chunked SSE, cumulative text in every event
+    protocol_version = 'HTTP/1.1'
+    events = 20
+    delay = 0.05
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        message_id = str(uuid.uuid4())
+        conversation_id = str(uuid.uuid4())
+        text = ''
+        for i in range(self.events):
+            time.sleep(self.delay)
+            text += 'token%d ' % i
+            event = {
+                'message': {
+                    'id': message_id,
+                    'author': {'role': 'assistant'},
+                    'content': {'content_type': 'text', 'parts': [text]},
+                },
+                'conversation_id': conversation_id,
+                'error': None,
+            }
+            self._write_chunk(('data: %s\n\n' % json.dumps(event)).encode('utf-8'))
+        self._write_chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Measures time to first delta of the unofficial streaming path against a local mock upstream.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=20, help='Number of events sent by the mock upstream.')
+        parser.add_argument('--delay', type=float, default=0.05, help='Seconds between two upstream events.')
+        parser.add_argument('--runs', type=int, default=3)
+
+    def handle(self, *args, **options):
+        MockConversationHandler.events = options['events']
+        MockConversationHandler.delay = options['delay']
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MockConversationHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d/backend-api/conversation' % server.server_address[1]
+
+        try:
+            for name, run in (('buffered', self._buffered), ('incremental', self._incremental)):
+                first, total = [], []
+                for _ in range(options['runs']):
+                    ttfb, elapsed = run(url)
+                    first.append(ttfb)
+                    total.append(elapsed)
+                self.stdout.write('%-12s first delta %8.1f ms   complete %8.1f ms' % (
+                    name, 1000 * sum(first) / len(first), 1000 * sum(total) / len(total)))
+        finally:
+            server.shutdown()
+
+    @staticmethod
+    def _buffered(url):
+        # The previous behaviour: read the whole body, then split it into events
+        start = time.perf_counter()
+        first = None
+        response = requests.post(url, data='{}', stream=True)
+        for line in response.text.split('\n\n'):
+            if line.startswith('data: {'):
+                json.loads(line[6:])
+                if first is None:
+                    first = time.perf_counter() - start
+        return first, time.perf_counter() - start
+
+    @staticmethod
+    def _incremental(url):
+        start = time.perf_counter()
+        first = None
+        response = requests.post(url, data='{}', stream=True)
+        for _ in iter_conversation_deltas(response):
+            if first is None:
+                first = time.perf_counter() - start
+        return first, time.perf_counter() - start
@@ -0,0 +1,86 @@
+import json
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatgpt_api.classes.sse import SSEDecoder
+
+
+class LegacySSEDecoder(SSEDecoder):
+    # The previous feed: the incomplete line is split again with every chunk
+    def feed(self, chunk: bytes) -> list:
+        self._legacy_buffer = getattr(self, '_legacy_buffer', b'') + chunk
+        lines = self._legacy_buffer.split(b'\n')
+        self._legacy_buffer = lines.pop()
+        events = []
+        for line in lines:
+            event = self._process_line(line.rstrip(b'\r'))
+            if event is not None:
+                events.append(event)
+        return events
+
+
+def decode(decoder_class, chunks):
+    decoder = decoder_class()
+    count = 0
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+    return count + len(decoder.close())
+
+
+def decode_regex(chunks):
+    # The previous whole body parsing of classes/chat.py, it needs the complete body first
+    body = b''.join(chunks).decode('utf-8')
+    return len(re.findall(r'data: (.*)', body))
+
+
+def completion_body(tokens):
+    # events of the chat completions API, one small delta each
+    events = ['data: %s\n\n' % json.dumps({'choices': [{'delta': {'content': ' tok%d' % i}, 'finish_reason': None}]})
+              for i in range(tokens)]
+    return (''.join(events) + 'data: [DONE]\n\n').encode('utf-8')
+
+
+def conversation_body(tokens):
+    # events of the backend-api/conversation endpoint, each with the whole answer so far
+    events = []
+    text = ''
+    for i in range(tokens):
+        text += ' tok%d' % i
+        events.append('data: %s\n\n' % json.dumps({
+            'message': {'id': 'm', 'author': {'role': 'assistant'}, 'content': {'parts': [text]}},
+            'conversation_id': 'c'}))
+    return (''.join(events) + 'data: [DONE]\n\n').encode('utf-8')
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the throughput of the incremental SSE decoder against the previous parsers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=2000, help='Number of events in a body.')
+        parser.add_argument('--chunk-sizes', default='64,1024,16384',
+                            help='Comma separated sizes of the chunks the body is received in.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of each parser, the fastest is kept.')
+
+    def handle(self, *args, **options):
+        bodies = [('completion', completion_body(options['tokens'])),
+                  ('conversation', conversation_body(options['tokens']))]
+        parsers = [('decoder', lambda chunks: decode(SSEDecoder, chunks)),
+                   ('legacy split', lambda chunks: decode(LegacySSEDecoder, chunks)),
+                   ('regex', decode_regex)]
+
+        self.stdout.write('%12s %8s %10s %14s %12s' % ('body', 'chunk', 'size', 'parser', 'MB/s'))
+        for name, body in bodies:
+            for chunk_size in [int(size) for size in options['chunk_sizes'].split(',')]:
+                chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+                for parser_name, parse in parsers:
+                    elapsed = None
+                    for _ in range(options['repeat']):
+                        start = time.perf_counter()
+                        count = parse(chunks)
+                        run = time.perf_counter() - start
+                        elapsed = run if elapsed is None else min(elapsed, run)
+                        assert count == options['tokens'] + 1, (parser_name, count)
+                    self.stdout.write('%12s %8d %8.1f MB %14s %12.1f' % (
+                        name, chunk_size, len(body) / 1e6, parser_name, len(body) / 1e6 / elapsed))
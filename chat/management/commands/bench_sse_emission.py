@@ -0,0 +1,99 @@
+import random
+import socket
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatgpt_api import spool
+from chatgpt_api.classes.utils import sse_pack
+from chatgpt_api.generation import FLUSH_POLICIES, Generation
+from chatgpt_ui_server import settings
+
+WORDS = [' the', ' model', ' answer', ' token', ' stream', ' python', ' django', ',', '.', ' 的', '回答', '\n']
+
+
+def paced(deltas, rate):
+    # Yields the deltas at `rate` per second like an upstream completion, as fast as possible when 0
+    start = time.monotonic()
+    for i, delta in enumerate(deltas):
+        if rate:
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield delta
+
+
+def legacy_stream(deltas, rate):
+    # The previous emission: one json.dumps and one frame, written on its own, per delta
+    for delta in paced(deltas, rate):
+        yield sse_pack('message', {'content': delta})
+    yield sse_pack('done', {})
+
+
+def generation_stream(deltas, rate, policy, spooled):
+    generation = Generation(flush_policy=policy)
+    if spooled:
+        # written for the other workers, as with GENERATION_SPOOL_DIR set
+        generation.spool = spool.Spool(generation.id, None)
+
+    def produce():
+        for delta in paced(deltas, rate):
+            generation.publish_delta(delta)
+        generation.publish(sse_pack('done', {}))
+        generation.finish()
+
+    threading.Thread(target=produce).start()
+    return generation.stream()
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the CPU time spent per streamed token by the SSE emission, for each flush policy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=2000, help='Number of deltas in the answer.')
+        parser.add_argument('--rate', type=float, default=500,
+                            help='Deltas per second sent by the simulated upstream, 0 for as fast as possible.')
+        parser.add_argument('--policies', default=','.join(['legacy'] + list(FLUSH_POLICIES)),
+                            help='Comma separated flush policies, `legacy` is the emission before coalescing.')
+        parser.add_argument('--no-spool', action='store_true',
+                            help='Keep the generations in the process, as with an empty GENERATION_SPOOL_DIR.')
+
+    def handle(self, *args, **options):
+        # the generations are spooled to a directory of their own
+        spool_dir = settings.GENERATION_SPOOL_DIR
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            settings.GENERATION_SPOOL_DIR = tmp_dir
+            try:
+                self.bench(options)
+            finally:
+                settings.GENERATION_SPOOL_DIR = spool_dir
+
+    def bench(self, options):
+        rng = random.Random(0)
+        deltas = [rng.choice(WORDS) for _ in range(options['tokens'])]
+
+        self.stdout.write('%12s %10s %8s %12s %14s' % ('policy', 'frames', 'writes', 'wall', 'cpu/token'))
+        for policy in options['policies'].split(','):
+            # the response is written to a socket, like the WSGI server does, and drained on the other side
+            writer, reader = socket.socketpair()
+            drained = threading.Thread(target=lambda: [None for _ in iter(lambda: reader.recv(65536), b'')])
+            drained.start()
+
+            start, cpu_start = time.perf_counter(), time.process_time()
+            stream = legacy_stream(deltas, options['rate']) if policy == 'legacy' else \
+                generation_stream(deltas, options['rate'], policy, not options['no_spool'])
+            frames = writes = 0
+            for chunk in stream:
+                frames += chunk.count('\n\n')
+                writes += 1
+                writer.sendall(chunk.encode('utf-8'))
+            writer.close()
+            drained.join()
+            reader.close()
+            cpu = time.process_time() - cpu_start
+            wall = time.perf_counter() - start
+
+            self.stdout.write('%12s %10d %8d %9.0f ms %11.1f us' % (
+                policy, frames, writes, 1000 * wall, 1e6 * cpu / options['tokens']))
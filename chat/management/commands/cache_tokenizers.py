@@ -0,0 +1,25 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatgpt_api import tokenizer
+
+
+class Command(BaseCommand):
+    help = 'Downloads the tokenizer encodings into TOKENIZER_CACHE_DIR, so workers start without network access.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='Models to cache, defaults to the ones warmed up at startup.')
+
+    def handle(self, *args, **options):
+        tokenizer.configure(cache_dir=settings.TOKENIZER_CACHE_DIR, offline=False)
+        models = options['models'] or tokenizer.WARM_UP_MODELS
+        for model in models:
+            encoding = tokenizer.get_encoding(model)
+            self.stdout.write('%s: %s' % (model, encoding.name))
+
+        cache_dir = settings.TOKENIZER_CACHE_DIR
+        for name in sorted(os.listdir(cache_dir)):
+            self.stdout.write('  %s (%d bytes)' % (name, os.path.getsize(os.path.join(cache_dir, name))))
+        self.stdout.write(self.style.SUCCESS('Tokenizer cache ready in %s' % cache_dir))
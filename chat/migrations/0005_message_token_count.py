@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:53
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_prompt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='token_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='token_encoding',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='setting',
+            name='value',
+            field=models.TextField(),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:56
+
+from django.db import migrations, models
+
+
+def remove_duplicate_settings(apps, schema_editor):
+    # Keep the oldest row of every name, the one the lookups used to return, before making names unique
+    Setting = apps.get_model('chat', 'Setting')
+    seen = set()
+    for setting_id, name in Setting.objects.order_by('id').values_list('id', 'name'):
+        if name in seen:
+            Setting.objects.filter(id=setting_id).delete()
+        else:
+            seen.add(name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_token_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_settings, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='setting',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='chat_conv_user_cr_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at', 'id'], name='chat_msg_conv_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prompt',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='chat_prompt_user_cr_id_idx'),
+        ),
+    ]
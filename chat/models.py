@@ -1,6 +1,7 @@
 import uuid
 
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 from json import JSONEncoder
@@ -24,6 +25,12 @@ class Conversation(models.Model):
     topic = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # conversations of a user, newest first, `id` breaks ties for the keyset pagination
+            models.Index(fields=['user', 'created_at', 'id'], name='chat_conv_user_cr_id_idx'),
+        ]
+
 
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -31,7 +38,17 @@ class Message(models.Model):
     parent_message = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='replies')
     message = models.TextField()
     is_bot = models.BooleanField(default=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # number of tokens of `message`, and the tiktoken encoding it was counted with
+    token_count = models.IntegerField(null=True, blank=True)
+    token_encoding = models.CharField(max_length=64, null=True, blank=True)
+    # when the message was sent, the question of a turn is only written with its answer
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # messages of a conversation in order, `id` breaks ties for build_messages and the keyset pagination
+            models.Index(fields=['conversation', 'created_at', 'id'], name='chat_msg_conv_created_idx'),
+        ]
 
 
 class Prompt(models.Model):
@@ -40,7 +57,12 @@ class Prompt(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='chat_prompt_user_cr_id_idx'),
+        ]
+
 
 class Setting(models.Model):
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, unique=True)
     value = models.TextField()
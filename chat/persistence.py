@@ -0,0 +1,270 @@
+"""
+Writes the conversation turns: the user message and the answer, with the conversation when it is new.
+
+A turn is written in one transaction with `bulk_create`, so a conversation never has a question without its answer.
+The question keeps the time it was asked at, not the time its answer was written.
+With PERSISTENCE_WRITE_BEHIND, the turns are handed to a background writer instead, the final `done` event is not
+delayed by the database. Each turn is first spooled to PERSISTENCE_SPOOL_DIR:
+
+    <PERSISTENCE_SPOOL_DIR>/<conversation id>.<pid>-<process uuid>.<uuid>.json
+
+The file is removed once the turn is committed, or renamed to `.failed` when it can't be. The turns left by a
+process which died before writing them are written by the next process starting its writer. A request continuing
+a conversation waits for the spooled turns of that conversation first, in whichever worker process they were spooled.
+"""
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from django.db import close_old_connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from chatgpt_ui_server import settings
+from .models import Conversation, Message
+
+_MESSAGE_FIELDS = ('id', 'conversation_id', 'parent_message_id', 'message', 'is_bot', 'token_count', 'token_encoding',
+                   'created_at')
+
+_lock = threading.Lock()
+_written = threading.Condition(_lock)
+
+
+def _reset():
+    global _process, _queue, _pending
+    # tells the spool files of this process from those of a previous one with the same pid
+    _process = '%d-%s' % (os.getpid(), uuid.uuid4().hex)
+    _queue = None
+    # conversation id -> number of turns of this process not written yet
+    _pending = {}
+
+
+_reset()
+# a worker forked from a process which saved turns has neither its writer thread nor its turns
+os.register_at_fork(after_in_child=_reset)
+
+
+def write_turn(conversation: Conversation or None, messages: list):
+    """
+    Writes a turn in one transaction. `conversation` is the new conversation of the turn, None if it exists.
+    The rows already written are skipped, writing a turn twice is harmless. Any other conflict fails the turn.
+    """
+    with transaction.atomic():
+        if conversation is not None and not Conversation.objects.filter(id=conversation.id).exists():
+            Conversation.objects.bulk_create([conversation])
+        written = {str(message_id) for message_id in
+                   Message.objects.filter(id__in=[message.id for message in messages]).values_list('id', flat=True)}
+        # in order, the question is created before its answer
+        Message.objects.bulk_create([message for message in messages if str(message.id) not in written])
+
+
+def save_turn(conversation: Conversation or None, messages: list):
+    """
+    Saves a turn, in the background with PERSISTENCE_WRITE_BEHIND, or written before returning.
+    """
+    if not settings.PERSISTENCE_WRITE_BEHIND:
+        write_turn(conversation, messages)
+        return
+
+    turn = _dump_turn(conversation, messages)
+    conversation_id = turn['messages'][0]['conversation_id']
+    writer = _get_queue()
+    path = _spool_turn(conversation_id, turn)
+    with _lock:
+        _pending[conversation_id] = _pending.get(conversation_id, 0) + 1
+    try:
+        writer.put_nowait((conversation_id, path, turn))
+    except queue.Full:
+        # the writer is behind, write it in the request rather than queuing without a bound
+        try:
+            _write_spooled(path, turn)
+        except Exception:
+            if path is not None:
+                os.replace(path, path + '.failed')
+            raise
+        finally:
+            _done(conversation_id)
+
+
+def wait_for_conversation(conversation_id):
+    """
+    Waits until the turns of `conversation_id` saved in the background are written, or for PERSISTENCE_FLUSH_TIMEOUT
+    seconds. Called before reading a conversation the client may have just been answered in.
+    """
+    if not settings.PERSISTENCE_WRITE_BEHIND or not conversation_id:
+        return
+    _get_queue()
+    conversation_id = str(conversation_id)
+    deadline = time.monotonic() + settings.PERSISTENCE_FLUSH_TIMEOUT
+    with _lock:
+        while _pending.get(conversation_id):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            _written.wait(timeout)
+    # spooled by the other worker processes
+    while _spooled(conversation_id) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def _dump_turn(conversation, messages) -> dict:
+    return {
+        'conversation': None if conversation is None else {'id': str(conversation.id), 'user_id': conversation.user_id},
+        'messages': [
+            {field: str(value) if isinstance(value, uuid.UUID) else
+             value.isoformat() if isinstance(value, datetime.datetime) else value
+             for field, value in ((field, getattr(message, field)) for field in _MESSAGE_FIELDS)}
+            for message in messages
+        ],
+    }
+
+
+def _load_turn(turn: dict):
+    conversation = None if turn['conversation'] is None else Conversation(**turn['conversation'])
+    messages = []
+    for message in turn['messages']:
+        if message.get('created_at'):
+            message = dict(message, created_at=parse_datetime(message['created_at']))
+        messages.append(Message(**message))
+    return conversation, messages
+
+
+def _spool_turn(conversation_id, turn) -> str or None:
+    if not settings.PERSISTENCE_SPOOL_DIR:
+        return None
+    os.makedirs(settings.PERSISTENCE_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(settings.PERSISTENCE_SPOOL_DIR,
+                        '%s.%s.%s.json' % (conversation_id, _process, uuid.uuid4().hex))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(turn, f)
+        f.flush()
+        # on disk before the answer is reported as saved
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _spool_files():
+    # (conversation id, process, name) of the spooled turns
+    try:
+        names = os.listdir(settings.PERSISTENCE_SPOOL_DIR)
+    except (FileNotFoundError, TypeError):
+        return []
+    files = []
+    for name in names:
+        parts = name.split('.')
+        if len(parts) == 4 and parts[3] == 'json':
+            files.append((parts[0], parts[1], name))
+    return files
+
+
+def _is_running(process) -> bool:
+    # whether the process which spooled a turn still runs, and will write it
+    if process == _process:
+        return True
+    pid = int(process.split('-')[0])
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _spooled(conversation_id) -> bool:
+    return any(spooled_id == conversation_id and _is_running(process) for spooled_id, process, _ in _spool_files())
+
+
+def _write_spooled(path, turn):
+    write_turn(*_load_turn(turn))
+    if path is not None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_retrying(conversation_id, path, turn):
+    delay = 1
+    for attempt in range(settings.PERSISTENCE_RETRIES + 1):
+        # the thread lives longer than CONN_MAX_AGE, or than the database keeps an idle connection
+        close_old_connections()
+        try:
+            _write_spooled(path, turn)
+            return
+        except Exception as e:
+            print('>> Failed to write a turn of conversation %s: %s' % (conversation_id, e))
+            if attempt < settings.PERSISTENCE_RETRIES:
+                # e.g. the database restarting, or the previous turn still spooled by another process
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+    if path is not None:
+        # kept aside so it doesn't block the other turns, and no process retries it
+        os.replace(path, path + '.failed')
+
+
+def _done(conversation_id):
+    with _lock:
+        _pending[conversation_id] -= 1
+        if not _pending[conversation_id]:
+            del _pending[conversation_id]
+        _written.notify_all()
+
+
+def _recover() -> list:
+    # takes over the turns spooled by processes which died before writing them
+    turns = []
+    for conversation_id, process, name in _spool_files():
+        if _is_running(process):
+            continue
+        path = os.path.join(settings.PERSISTENCE_SPOOL_DIR, name)
+        own_path = os.path.join(settings.PERSISTENCE_SPOOL_DIR, '%s.%s.%s.json' % (
+            conversation_id, _process, name.split('.')[2]))
+        try:
+            # the rename only succeeds for one of the processes recovering it
+            os.rename(path, own_path)
+            with open(own_path) as f:
+                turns.append((conversation_id, own_path, json.load(f)))
+        except (OSError, ValueError):
+            continue
+        with _lock:
+            _pending[conversation_id] = _pending.get(conversation_id, 0) + 1
+    return turns
+
+
+def _run(writer):
+    for conversation_id, path, turn in _recover():
+        _write_retrying(conversation_id, path, turn)
+        _done(conversation_id)
+    while True:
+        conversation_id, path, turn = writer.get()
+        _write_retrying(conversation_id, path, turn)
+        _done(conversation_id)
+        writer.task_done()
+
+
+def _flush():
+    # lets the writer finish the queued turns when the process exits, the spooled ones would be recovered anyway
+    deadline = time.monotonic() + settings.PERSISTENCE_FLUSH_TIMEOUT
+    with _lock:
+        while _pending and time.monotonic() < deadline:
+            _written.wait(deadline - time.monotonic())
+
+
+def _get_queue():
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                _queue = queue.Queue(settings.PERSISTENCE_QUEUE_SIZE)
+                threading.Thread(target=_run, args=(_queue,), name='persistence-writer', daemon=True).start()
+                atexit.register(_flush)
+    return _queue
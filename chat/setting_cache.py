@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .models import Setting
+
+# All Setting rows of this process, keyed by name, loaded with a single query and kept until invalidated.
+# Other workers are told about changes through the mtime/inode of SETTING_CACHE_VERSION_FILE.
+_cache = None
+_version = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+def _read_version():
+    try:
+        stat = os.stat(settings.SETTING_CACHE_VERSION_FILE)
+        return stat.st_ino, stat.st_mtime_ns
+    except OSError:
+        return None
+
+
+def _write_version():
+    path = settings.SETTING_CACHE_VERSION_FILE
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        # replacing the file gives it a new inode, so workers notice even within the mtime resolution
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('Failed to update the settings version file: %s' % e)
+
+
+def get_settings() -> dict:
+    global _cache, _version, _loaded_at
+    version = _read_version()
+    cache = _cache
+    if cache is not None and version == _version and time.monotonic() - _loaded_at < settings.SETTING_CACHE_TTL:
+        return cache
+
+    with _lock:
+        if _cache is not None and _version == version and _cache is not cache:
+            # reloaded by another thread while we were waiting
+            return _cache
+        # the version is read before the query, a change committed meanwhile triggers another reload
+        rows = Setting.objects.order_by('-id').values_list('name', 'value')
+        # ordered so that the oldest row wins when a name is duplicated
+        _cache = dict(rows)
+        _version = version
+        _loaded_at = time.monotonic()
+        return _cache
+
+
+def get_setting(name: str, default=None):
+    return get_settings().get(name, default)
+
+
+def invalidate():
+    """
+    Drops the cached settings of this process and tells the other workers to drop theirs.
+    """
+    global _cache
+    _cache = None
+    _write_version()
@@ -1,6 +1,8 @@
-from django.db.models.signals import post_migrate
+from django.db import transaction
+from django.db.models.signals import post_migrate, post_save, post_delete
 from django.dispatch import receiver
 from .models import Setting
+from . import setting_cache
 
 
 @receiver(post_migrate)
@@ -13,3 +15,10 @@ def load_default_settings(sender, **kwargs):
         if not Setting.objects.filter(name='open_registration').exists():
             Setting.objects.create(name='open_registration', value='True')
             print('Created setting: open_registration')
+
+
+@receiver(post_save, sender=Setting)
+@receiver(post_delete, sender=Setting)
+def invalidate_setting_cache(sender, **kwargs):
+    # wait for the commit, a worker reloading before it would cache the old values again
+    transaction.on_commit(setting_cache.invalidate)
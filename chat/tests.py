@@ -1,3 +1,1456 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings as django_settings
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import Q
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chatgpt_api import chat_pool, clients, completion_cache, credentials, generation as generation_module, key_pool, \
+    spool, token_refresher, tokenizer
+from chatgpt_api import api as api_module
+from chatgpt_api.api import ChatGptApi, build_messages, fit_token_counts, iter_recent_messages
+from chatgpt_api.api_unofficial import Chat, iter_conversation_deltas, save_failed_turn
+from chatgpt_api.classes.exceptions import PyChatGPTException
+from chatgpt_api.classes import chat as chat_module
+from chatgpt_api.classes.chat import ConversationStream, ask
+from chatgpt_api.classes.sse import DONE, ServerSentEvent, SSEDecoder
+from chatgpt_api.classes.utils import sse_pack
+from chatgpt_ui_server import settings
+from . import persistence, setting_cache, views
+from .models import Conversation, Message, Prompt, Setting
+
+
+class QueryPlanTests(TestCase):
+    """
+    The hot queries must be answered from an index, without a full table scan or a sort of the matching rows.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user')
+        cls.conversation = Conversation.objects.create(user=cls.user, topic='topic')
+        for i in range(20):
+            Message.objects.create(conversation=cls.conversation, message='message %d' % i, is_bot=bool(i % 2))
+            Prompt.objects.create(user=cls.user, prompt='prompt %d' % i)
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        if connection.vendor == 'sqlite':
+            # "SCAN table" reads every row, "SCAN table USING ... INDEX" still walks the whole index
+            self.assertNotRegex(plan, r'\bSCAN\b')
+            self.assertNotIn('TEMP B-TREE', plan)
+        elif connection.vendor == 'mysql':
+            for line in plan.splitlines():
+                # the access type column of a full table scan is ALL
+                self.assertNotIn(' ALL ', ' %s ' % line, plan)
+            self.assertNotIn('Using filesort', plan)
+        else:
+            self.skipTest('No query plan check for %s' % connection.vendor)
+
+    def test_messages_of_conversation(self):
+        self.assertUsesIndex(Message.objects.filter(conversation_id=self.conversation.id).order_by('created_at'))
+
+    def test_recent_messages_of_conversation(self):
+        queryset = Message.objects.filter(conversation=self.conversation).order_by('-created_at', '-id')
+        self.assertUsesIndex(queryset.values_list('created_at', 'id', 'is_bot', 'token_count'))
+
+        newest = queryset.first()
+        self.assertUsesIndex(queryset.filter(
+            Q(created_at__lt=newest.created_at) | Q(created_at=newest.created_at, id__lt=newest.id)))
+
+        rows = list(iter_recent_messages(self.conversation, ('message',), chunk_size=3))
+        self.assertEqual([row[0] for row in rows], ['message %d' % i for i in reversed(range(20))])
+
+    def test_conversations_of_user(self):
+        self.assertUsesIndex(Conversation.objects.filter(user=self.user).order_by('-created_at'))
+
+    def test_conversations_of_user_after_cursor(self):
+        queryset = Conversation.objects.filter(user=self.user).order_by('-created_at', '-id')
+        newest = queryset.first()
+        self.assertUsesIndex(queryset.filter(
+            Q(created_at__lt=newest.created_at) | Q(created_at=newest.created_at, id__lt=newest.id)))
+
+    def test_prompts_of_user(self):
+        self.assertUsesIndex(Prompt.objects.filter(user=self.user).order_by('-created_at'))
+
+    def test_setting_by_name(self):
+        self.assertUsesIndex(Setting.objects.filter(name='openai_api_key'))
+
+
+# claims a turn in a new worker process and prints the generation it got and whether it claimed it
+_CLAIM_SCRIPT = """
+import sys
+import django
+django.setup()
+from chatgpt_ui_server import settings
+settings.GENERATION_SPOOL_DIR = sys.argv[1]
+from types import SimpleNamespace
+from chatgpt_api import generation
+turn, claimed = generation.claim_turn(SimpleNamespace(id=1), None, None, 'hello', sys.argv[2] or None)
+print(turn.id, claimed)
+"""
+
+
+class SpoolClaimTests(SimpleTestCase):
+    """
+    A turn claimed by a worker is followed, not answered again, by the other workers.
+    """
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(settings, 'GENERATION_SPOOL_DIR', self.spool_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+
+    def claim_in_other_worker(self, idempotency_key):
+        result = subprocess.run([sys.executable, '-c', _CLAIM_SCRIPT, self.spool_dir, idempotency_key or ''],
+                                cwd=django_settings.BASE_DIR, capture_output=True, text=True, timeout=60,
+                                env=dict(os.environ, TOKENIZER_WARM_UP='False'))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        generation_id, claimed = result.stdout.split()[-2:]
+        return generation_id, claimed == 'True'
+
+    def assertFollowedDuringClaim(self, idempotency_key):
+        claim_turn = spool.claim_turn
+        seen = []
+
+        def claim_then_race(*args, **kwargs):
+            # the other worker looks at the turn right after it is claimed, before claim_turn returns
+            owner_id = claim_turn(*args, **kwargs)
+            seen.append(self.claim_in_other_worker(idempotency_key))
+            return owner_id
+
+        with mock.patch.object(spool, 'claim_turn', claim_then_race):
+            generation, claimed = generation_module.claim_turn(SimpleNamespace(id=1), None, None, 'hello',
+                                                               idempotency_key)
+        self.addCleanup(generation.finish)
+        self.assertTrue(claimed)
+        self.assertEqual(seen, [(generation.id, False)])
+
+    def test_claim_is_followed_while_being_registered(self):
+        self.assertFollowedDuringClaim(None)
+
+    def test_idempotency_claim_is_followed_while_being_registered(self):
+        self.assertFollowedDuringClaim(uuid.uuid4().hex)
+
+    def test_other_message_to_same_parent_is_another_turn(self):
+        conversation_id, parent_message_id = str(uuid.uuid4()), str(uuid.uuid4())
+        user = SimpleNamespace(id=1)
+        first, claimed = generation_module.claim_turn(user, conversation_id, parent_message_id, 'hello')
+        self.addCleanup(first.finish)
+        self.assertTrue(claimed)
+        self.assertEqual(generation_module.claim_turn(user, conversation_id, parent_message_id, 'hello'),
+                         (first, False))
+        edited, claimed = generation_module.claim_turn(user, conversation_id, parent_message_id, 'hello again')
+        self.addCleanup(edited.finish)
+        self.assertTrue(claimed)
+
+
+class CompletionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(completion_cache.time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertLruAndTtl(self, backend):
+        backend.set('a', '1')
+        self.now += 1
+        backend.set('b', '2')
+        self.now += 1
+        # used last, so b is evicted rather than a
+        self.assertEqual(backend.get('a'), '1')
+        self.now += 1
+        backend.set('c', '3')
+        self.assertEqual((backend.get('a'), backend.get('b'), backend.get('c')), ('1', None, '3'))
+        self.assertEqual(len(backend), 2)
+        self.now += 60
+        self.assertIsNone(backend.get('c'))
+
+    def test_memory_backend(self):
+        self.assertLruAndTtl(completion_cache.MemoryBackend(2, 60))
+
+    def test_sqlite_backend(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'completions.sqlite3')
+        self.assertLruAndTtl(completion_cache.SQLiteBackend(2, 60, path))
+        # shared by the backends of the other workers
+        completion_cache.SQLiteBackend(2, 60, path).set('d', '4')
+        self.assertEqual(completion_cache.SQLiteBackend(2, 60, path).get('d'), '4')
+
+    def test_key_is_canonical(self):
+        messages = [{'role': 'user', 'content': 'hi'}]
+        key = completion_cache.make_key(dict(model='gpt', messages=messages, temperature=0, top_p=1, stream=True))
+        self.assertEqual(key, completion_cache.make_key(dict(
+            top_p=1.0, temperature=0.0, model='gpt', messages=[{'content': 'hi', 'role': 'user'}], api_key='key')))
+        self.assertNotEqual(key, completion_cache.make_key(dict(model='gpt', messages=messages, temperature=0.5)))
+
+    def test_only_deterministic_completions_are_cached(self):
+        backend = completion_cache.MemoryBackend(10, 60)
+        params = dict(model='gpt', messages=[{'role': 'user', 'content': 'hi'}], temperature=0.5)
+        with mock.patch.object(completion_cache, '_backend', backend), \
+                mock.patch.object(settings, 'COMPLETION_CACHE_MAX_TEMPERATURE', 0):
+            completion_cache.put(params, 'sampled')
+            self.assertIsNone(completion_cache.get(params))
+            completion_cache.put(dict(params, temperature=0), 'greedy')
+            self.assertEqual(completion_cache.get(dict(params, temperature=0)), 'greedy')
+            self.assertIsNone(completion_cache.get(dict(params, temperature=None)))
+            # opted in, such as the titles with COMPLETION_CACHE_TITLES
+            completion_cache.put(params, 'sampled', opt_in=True)
+            self.assertEqual(completion_cache.get(params, opt_in=True), 'sampled')
+
+
+class SSEDecoderTests(SimpleTestCase):
+    def decode(self, chunks):
+        decoder = SSEDecoder()
+        events = []
+        for chunk in chunks:
+            events += decoder.feed(chunk)
+        return [(event.event, event.data, event.id) for event in events + decoder.close()]
+
+    def assertDecodes(self, body, expected):
+        # whatever the chunks the body is received in
+        for size in (1, 2, 3, 7, len(body)):
+            self.assertEqual(self.decode([body[i:i + size] for i in range(0, len(body), size)]), expected, size)
+
+    def test_line_endings(self):
+        # the last event id is kept for the following events
+        expected = [(None, 'a', None), ('ping', 'b', '2'), (None, 'c', '2')]
+        for ending in (b'\n', b'\r\n', b'\r'):
+            body = b'data: a\n\nevent: ping\nid: 2\ndata: b\n\ndata: c\n\n'.replace(b'\n', ending)
+            self.assertDecodes(body, expected)
+
+    def test_crlf_split_across_chunks(self):
+        self.assertEqual(self.decode([b'data: a\r', b'\n\r', b'\ndata: b\r\n\r\n']),
+                         [(None, 'a', None), (None, 'b', None)])
+
+    def test_multi_line_data(self):
+        self.assertDecodes(b'data: first\ndata:second\ndata\n\n', [(None, 'first\nsecond\n', None)])
+
+    def test_comments_and_unknown_fields(self):
+        self.assertDecodes(b': keep-alive\n\nretry: 10\ndata: a\n\n', [(None, 'a', None)])
+
+    def test_utf8_split_across_chunks(self):
+        self.assertDecodes('data: 回答 🙂\n\n'.encode('utf-8'), [(None, '回答 🙂', None)])
+
+    def test_last_event_without_blank_line(self):
+        self.assertDecodes(b'data: a\n\ndata: [DONE]', [(None, 'a', None), (None, '[DONE]', None)])
+        self.assertTrue(SSEDecoder().feed(b'data: [DONE]\n\n')[0].done)
+
+
+class ChatPoolTests(SimpleTestCase):
+    def test_accounts(self):
+        with mock.patch.object(settings, 'UNOFFICIAL_ACCOUNTS', ' a@example.com:pass:word , ,b@example.com:x'):
+            self.assertTrue(chat_pool.enabled())
+            self.assertEqual(chat_pool.get_accounts(), [('a@example.com', 'pass:word'), ('b@example.com', 'x')])
+
+    def test_disabled_without_accounts(self):
+        with mock.patch.object(settings, 'UNOFFICIAL_ACCOUNTS', ''):
+            self.assertFalse(chat_pool.enabled())
+            self.assertRaises(RuntimeError, chat_pool.checkout)
+
+    def checkout(self):
+        with mock.patch.object(settings, 'UNOFFICIAL_ACCOUNTS', 'a@example.com:password'), \
+                mock.patch.dict(chat_pool._sessions, clear=True), \
+                mock.patch.object(Chat, '_get_access_token', return_value=('token', None, None)):
+            return chat_pool.checkout()
+
+    def test_invalid_requests_are_not_failures(self):
+        lease = self.checkout()
+        for prompt, conversation_id, parent_message_id in (('', None, None), (None, None, None),
+                                                            ('hello', 'invalid', str(uuid.uuid4()))):
+            self.assertRaises(PyChatGPTException, lease.chat._prepare_ask, prompt, conversation_id,
+                              parent_message_id)
+        self.assertEqual(lease.chat.failures, 0)
+
+    def test_failing_session_is_left_out(self):
+        lease = self.checkout()
+        with mock.patch.object(settings, 'UNOFFICIAL_SESSION_MAX_FAILURES', 2), \
+                mock.patch.object(Chat, '_get_access_token', side_effect=PyChatGPTException('Failed to log in')):
+            self.assertRaises(PyChatGPTException, lease.chat._prepare_ask, 'hello', None, None)
+            chat_pool.record(lease.chat, failed=True)
+            self.assertEqual(lease.chat.failures, 2)
+            lease.release()
+        self.assertIsNone(lease._session.chat)
+        self.assertFalse(lease._session.healthy(time.monotonic()))
+
+    def test_success_resets_the_failures(self):
+        lease = self.checkout()
+        chat_pool.record(lease.chat, failed=True)
+        chat_pool.record(lease.chat, failed=False)
+        lease.release()
+        self.assertEqual(lease.chat.failures, 0)
+        self.assertIs(lease._session.chat, lease.chat)
+
+
+class PersistenceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = mock.patch.object(settings, 'PERSISTENCE_SPOOL_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def turn(self, asked_at=None):
+        conversation = Conversation(user=self.user)
+        question = Message(conversation_id=conversation.id, message='question',
+                           created_at=asked_at or timezone.now())
+        answer = Message(conversation_id=conversation.id, parent_message_id=question.id, message='answer',
+                         is_bot=True)
+        return conversation, [question, answer]
+
+    def test_turn_written_twice(self):
+        asked_at = timezone.now() - timedelta(minutes=1)
+        conversation, messages = self.turn(asked_at)
+        persistence.write_turn(conversation, messages)
+        persistence.write_turn(*persistence._load_turn(persistence._dump_turn(conversation, messages)))
+        self.assertEqual(Conversation.objects.filter(id=conversation.id).count(), 1)
+        # the question keeps the time it was asked at
+        self.assertEqual(list(Message.objects.filter(conversation=conversation).order_by('created_at').values_list(
+            'message', 'created_at'))[0], ('question', asked_at))
+        self.assertEqual(Message.objects.filter(conversation=conversation).count(), 2)
+
+    def test_other_conflicts_fail(self):
+        conversation, messages = self.turn()
+        messages[1].message = None
+        self.assertRaises(IntegrityError, persistence.write_turn, conversation, messages)
+        self.assertFalse(Conversation.objects.filter(id=conversation.id).exists())
+
+    def spool(self, turn, process):
+        conversation_id = turn['messages'][0]['conversation_id']
+        path = os.path.join(self.directory, '%s.%s.%s.json' % (conversation_id, process, uuid.uuid4().hex))
+        with open(path, 'w') as f:
+            json.dump(turn, f)
+        return conversation_id, path
+
+    def test_turns_of_dead_process_are_recovered(self):
+        worker = subprocess.Popen([sys.executable, '-c', 'pass'])
+        worker.wait()
+        conversation, messages = self.turn()
+        conversation_id, path = self.spool(persistence._dump_turn(conversation, messages),
+                                           '%d-%s' % (worker.pid, uuid.uuid4().hex))
+        # a turn which failed is kept aside, no process takes it over
+        failed = self.spool(persistence._dump_turn(*self.turn()), '%d-%s' % (worker.pid, uuid.uuid4().hex))[1]
+        os.replace(failed, failed + '.failed')
+
+        turns = persistence._recover()
+        self.assertEqual([turn[0] for turn in turns], [conversation_id])
+        self.assertTrue(persistence._spooled(conversation_id))
+        for conversation_id, path, turn in turns:
+            persistence._write_retrying(conversation_id, path, turn)
+            persistence._done(conversation_id)
+        self.assertEqual(Message.objects.filter(conversation_id=conversation.id).count(), 2)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(failed) + '.failed'])
+
+    def test_turn_failing_is_kept_aside(self):
+        conversation, messages = self.turn()
+        messages[1].message = None
+        turn = persistence._dump_turn(conversation, messages)
+        conversation_id, path = self.spool(turn, persistence._process)
+        with mock.patch.object(settings, 'PERSISTENCE_RETRIES', 0):
+            persistence._write_retrying(conversation_id, path, turn)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(path) + '.failed'])
+        self.assertEqual(persistence._spool_files(), [])
+
+
+class TokenizerTests(SimpleTestCase):
+    def test_download_times_out(self):
+        with mock.patch.object(tokenizer, '_timeout', 3), mock.patch.object(tokenizer.requests, 'get') as get:
+            tokenizer._read_file('https://example.com/cl100k_base.tiktoken')
+        get.assert_called_once_with('https://example.com/cl100k_base.tiktoken', timeout=3)
+
+    def test_offline(self):
+        with mock.patch.object(tokenizer, '_offline', True), mock.patch.object(tokenizer.requests, 'get') as get:
+            self.assertRaises(tokenizer.TokenizerCacheMissing, tokenizer._read_file,
+                              'https://example.com/cl100k_base.tiktoken')
+        get.assert_not_called()
+
+    def test_warm_up_by_the_server_only(self):
+        with mock.patch.object(tokenizer, 'warm_up') as warm_up, \
+                mock.patch.object(django_settings, 'TOKENIZER_WARM_UP', True):
+            apps.get_app_config('chat').ready()
+            call_command('check', verbosity=0)
+            warm_up.assert_not_called()
+            apps.get_app_config('chat').warm_up()
+            warm_up.assert_called_once_with()
+
+    def test_message_formats(self):
+        self.assertEqual(tokenizer.get_message_format('gpt-4-32k-0613'), tokenizer.MESSAGE_FORMATS['gpt-4'])
+        self.assertEqual(tokenizer.get_message_format('gpt-3.5-turbo-16k'),
+                         tokenizer.MESSAGE_FORMATS['gpt-3.5-turbo'])
+        self.assertRaises(NotImplementedError, tokenizer.get_message_format, 'text-davinci-003')
+
+        # counts the words, the tests can't download the encodings
+        encoding = SimpleNamespace(name='words', encode=str.split)
+        messages = [{'role': 'user', 'content': 'hello there'}, {'role': 'user', 'name': 'bob', 'content': 'hi'}]
+        with mock.patch.dict(tokenizer._encodings, {'gpt-3.5-turbo': encoding, 'gpt-4': encoding}):
+            self.assertEqual(tokenizer.num_tokens_from_message(messages[0], 'gpt-3.5-turbo'), 4 + 1 + 2)
+            self.assertEqual(tokenizer.num_tokens_from_message(messages[0], 'gpt-4'), 3 + 1 + 2)
+            # the name replaces the role for gpt-3.5-turbo, it is added to it for gpt-4
+            self.assertEqual(tokenizer.num_tokens_from_message(messages[1], 'gpt-3.5-turbo'), 4 + 1 + 1 - 1 + 1)
+            self.assertEqual(tokenizer.num_tokens_from_message(messages[1], 'gpt-4'), 3 + 1 + 1 + 1 + 1)
+            self.assertEqual(tokenizer.num_tokens_from_messages(messages, 'gpt-3.5-turbo'), 7 + 6 + 2)
+            self.assertEqual(tokenizer.num_tokens_from_messages(messages, 'gpt-4'), 6 + 7 + 3)
+
+    def test_encoding_loaded_once(self):
+        loaded = []
+
+        def encoding_for_model(model):
+            loaded.append(model)
+            # long enough for the other threads to wait for it
+            time.sleep(0.05)
+            if model == 'gpt-4':
+                return SimpleNamespace(name='words', encode=str.split)
+            raise KeyError(model)
+
+        with mock.patch.dict(tokenizer._encodings, clear=True), \
+                mock.patch.object(tokenizer.tiktoken, 'encoding_for_model', encoding_for_model), \
+                mock.patch.object(tokenizer.tiktoken, 'get_encoding', lambda name: SimpleNamespace(name=name)):
+            encodings = []
+            threads = [threading.Thread(target=lambda: encodings.append(tokenizer.get_encoding('gpt-4')))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(loaded, ['gpt-4'])
+            self.assertEqual(len({id(encoding) for encoding in encodings}), 1)
+            # unknown to tiktoken
+            self.assertEqual(tokenizer.get_encoding('my-model').name, 'cl100k_base')
+
+
+class ConversationStreamTests(SimpleTestCase):
+    def event(self, text, role='assistant', **dumps):
+        return ServerSentEvent(data=json.dumps({
+            'message': {'id': 'm', 'author': {'role': role, 'name': None},
+                        'content': {'content_type': 'text', 'parts': [text]}},
+            'conversation_id': 'c', 'error': None}, **dumps))
+
+    def assertDeltas(self, texts, **dumps):
+        stream = ConversationStream()
+        deltas = [stream.feed(self.event(text, **dumps)) for text in texts]
+        self.assertEqual(''.join(deltas), texts[-1])
+        self.assertEqual(deltas[0], texts[0])
+        self.assertEqual(stream.event['message']['content']['parts'], [texts[-1]])
+        return deltas
+
+    def test_deltas(self):
+        texts = ['He', 'Hello', 'Hello "wor', 'Hello "world"\n\\', 'Hello "world"\n\\ 回答 🙂', 'Hello "world"\n\\ 回答 🙂!']
+        self.assertEqual(self.assertDeltas(texts)[1:], ['llo', ' "wor', 'ld"\n\\', ' 回答 🙂', '!'])
+        self.assertDeltas(texts, ensure_ascii=False)
+
+    def test_other_formatting_is_parsed_as_a_whole(self):
+        self.assertDeltas(['a', 'ab', 'abc'], separators=(',', ':'))
+
+    def test_revised_answer(self):
+        stream = ConversationStream()
+        self.assertEqual(stream.feed(self.event('Hello wor')), 'Hello wor')
+        # the beginning changed, the new text is parsed as a whole
+        self.assertEqual(stream.feed(self.event('Hello, world')), 'rld')
+        self.assertEqual(stream.feed(self.event('Hello, world!')), '!')
+
+    def test_other_events(self):
+        stream = ConversationStream()
+        self.assertIsNone(stream.feed(self.event('You are ChatGPT', role='system')))
+        self.assertIsNone(stream.feed(self.event('question', role='user')))
+        self.assertIsNone(stream.feed(ServerSentEvent(data=json.dumps({'message': None, 'error': None}))))
+        self.assertIsNone(stream.event)
+        self.assertEqual(stream.feed(self.event('answer')), 'answer')
+        self.assertIsNone(stream.feed(ServerSentEvent(data=DONE)))
+        self.assertTrue(stream.done)
+
+    def test_deltas_as_the_chunks_arrive(self):
+        read = []
+
+        def iter_content(chunk_size):
+            for text in ('Hel', 'Hello'):
+                read.append(text)
+                yield ('data: %s\n\n' % self.event(text).data).encode()
+            yield b'data: [DONE]\n\n'
+            # past the end of the stream
+            read.append('more')
+
+        deltas = iter_conversation_deltas(SimpleNamespace(iter_content=iter_content))
+        delta, stream = next(deltas)
+        # yielded before the next chunk is read
+        self.assertEqual((delta, read), ('Hel', ['Hel']))
+        self.assertEqual([delta for delta, stream in deltas], ['lo'])
+        self.assertEqual(read, ['Hel', 'Hello'])
+        self.assertTrue(stream.done)
+
+
+class GenerationReplayTests(SimpleTestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(settings, 'GENERATION_SPOOL_DIR', self.spool_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+
+    def generation(self, contents):
+        generation = generation_module.Generation(flush_policy='latency')
+        generation.spool = spool.Spool(generation.id, 1)
+        for content in contents:
+            generation.publish_delta(content)
+        generation.publish(sse_pack('done', {}))
+        generation.finish()
+        return generation
+
+    def expected(self, contents, last_event_id):
+        frames = [sse_pack('message', {'content': content}) for content in contents] + [sse_pack('done', {})]
+        return ''.join('id: %d\n%s' % (i, frame) for i, frame in enumerate(frames, 1) if i > last_event_id)
+
+    def test_replay_from_last_event_id(self):
+        generation = self.generation(['a', 'b', 'c'])
+        for last_event_id in (0, 2, 4):
+            self.assertEqual(''.join(generation.stream(last_event_id)), self.expected(['a', 'b', 'c'], last_event_id))
+
+    def test_replay_from_spool(self):
+        # as read by another worker
+        generation = self.generation(['a', 'b', 'c'])
+        spooled = spool.SpooledGeneration(generation.id, 1, os.getpid())
+        self.assertTrue(spooled.done)
+        for last_event_id in (0, 3):
+            self.assertEqual(''.join(spooled.stream(last_event_id)), self.expected(['a', 'b', 'c'], last_event_id))
+
+    def test_stream_follows_the_producer(self):
+        generation = generation_module.Generation(flush_policy='latency')
+        stream = generation.stream()
+        generation.publish_delta('a')
+        self.assertEqual(next(stream), 'id: 1\n' + sse_pack('message', {'content': 'a'}))
+        generation.publish(sse_pack('done', {}))
+        generation.finish()
+        self.assertEqual(list(stream), ['id: 2\n' + sse_pack('done', {})])
+
+    def test_last_event_id(self):
+        factory = RequestFactory()
+        self.assertEqual(generation_module.get_last_event_id(factory.get('/', HTTP_LAST_EVENT_ID='5')), 5)
+        self.assertEqual(generation_module.get_last_event_id(factory.get('/', {'lastEventId': '3'})), 3)
+        self.assertEqual(generation_module.get_last_event_id(factory.get('/', {'lastEventId': '-1'})), 0)
+        self.assertEqual(generation_module.get_last_event_id(factory.get('/', HTTP_LAST_EVENT_ID='x')), 0)
+
+
+class GenerationCancelTests(SimpleTestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(settings, 'GENERATION_SPOOL_DIR', self.spool_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+
+    def test_cancel(self):
+        generation = generation_module.Generation()
+        cancelled = []
+        generation.on_cancel(lambda: cancelled.append('upstream'))
+        self.assertTrue(generation.cancel())
+        self.assertTrue(generation.cancelled)
+        self.assertFalse(generation.cancel())
+        # registered once cancelled, called right away
+        generation.on_cancel(lambda: cancelled.append('late'))
+        self.assertEqual(cancelled, ['upstream', 'late'])
+
+    def test_finished_generation_is_not_cancelled(self):
+        generation = generation_module.Generation()
+        generation.finish()
+        self.assertFalse(generation.cancel())
+        self.assertFalse(generation.cancelled)
+
+    def test_cancel_from_other_worker(self):
+        generation = generation_module.Generation(flush_policy='latency')
+        generation.spool = spool.Spool(generation.id, 1)
+        self.addCleanup(generation.finish)
+        generation.publish_delta('a')
+        self.assertTrue(spool.SpooledGeneration(generation.id, 1, os.getpid()).cancel())
+        # the marker is looked for once per GENERATION_SPOOL_POLL
+        with mock.patch.object(settings, 'GENERATION_SPOOL_POLL', 60):
+            generation.publish_delta('b')
+        self.assertFalse(generation.cancelled)
+        with mock.patch.object(settings, 'GENERATION_SPOOL_POLL', 0):
+            generation.publish_delta('c')
+        self.assertTrue(generation.cancelled)
+
+    def test_finished_spooled_generation_is_not_cancelled(self):
+        generation = generation_module.Generation()
+        generation.spool = spool.Spool(generation.id, 1)
+        generation.finish()
+        self.assertFalse(spool.SpooledGeneration(generation.id, 1, os.getpid()).cancel())
+
+
+class GenerationCoalescingTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch.object(generation_module.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(generation_module.FLUSH_POLICIES, {'test': (0.05, 10)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def contents(self, generation):
+        return [json.loads(frame.split('data: ', 1)[1]).get('content') for frame in generation.frames]
+
+    def test_latency(self):
+        generation = generation_module.Generation(flush_policy='latency')
+        for delta in 'abc':
+            generation.publish_delta(delta)
+        self.assertEqual(self.contents(generation), ['a', 'b', 'c'])
+
+    def test_flushed_by_size(self):
+        generation = generation_module.Generation(flush_policy='test')
+        generation.publish_delta('abc')
+        generation.publish_delta('def')
+        self.assertEqual(generation.frames, [])
+        generation.publish_delta('ghijk')
+        self.assertEqual(self.contents(generation), ['abcdefghijk'])
+
+    def test_flushed_by_time(self):
+        generation = generation_module.Generation(flush_policy='test')
+        generation.publish_delta('a')
+        self.now += 0.01
+        generation.publish_delta('b')
+        self.assertEqual(generation.frames, [])
+        self.now += 0.04
+        generation.publish_delta('c')
+        self.assertEqual(self.contents(generation), ['abc'])
+        # due with no delta following it, flushed by the reader
+        generation.publish_delta('d')
+        self.now += 0.05
+        with generation._condition:
+            frames, count, done = generation._read(1)
+        self.assertEqual((count, done), (1, False))
+        self.assertEqual(self.contents(generation), ['abc', 'd'])
+
+    def test_flushed_before_other_frames(self):
+        generation = generation_module.Generation(flush_policy='test')
+        generation.publish_delta('a')
+        generation.publish(sse_pack('done', {}))
+        generation.publish_delta('b')
+        generation.finish()
+        self.assertEqual(self.contents(generation), ['a', None, 'b'])
+
+
+class SpoolTests(SimpleTestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(settings, 'GENERATION_SPOOL_DIR', self.spool_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+
+    def claim_as(self, key, generation_id, pid):
+        os.makedirs(os.path.join(self.spool_dir, 'turns'), exist_ok=True)
+        with open(spool._turn_path(key), 'w') as f:
+            json.dump({'generation_id': generation_id, 'pid': pid}, f)
+
+    def holder(self, key):
+        with open(spool._turn_path(key)) as f:
+            return json.load(f)['generation_id']
+
+    def dead_pid(self):
+        worker = subprocess.Popen([sys.executable, '-c', 'pass'])
+        worker.wait()
+        return worker.pid
+
+    def test_claim(self):
+        self.assertIsNone(spool.claim_turn('turn', 'a'))
+        self.assertEqual(self.holder('turn'), 'a')
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, 'turns')), ['turn'])
+
+    def test_claim_of_running_worker_is_followed(self):
+        self.claim_as('turn', 'a', os.getppid())
+        self.assertEqual(spool.claim_turn('turn', 'b'), 'a')
+        self.assertEqual(self.holder('turn'), 'a')
+
+    def test_claim_of_dead_worker_is_taken_over(self):
+        self.claim_as('turn', 'a', self.dead_pid())
+        self.assertIsNone(spool.claim_turn('turn', 'b'))
+        self.assertEqual(self.holder('turn'), 'b')
+
+    def test_release(self):
+        spool.claim_turn('turn', 'a')
+        spool.release_turn('turn', 'b')
+        self.assertEqual(self.holder('turn'), 'a')
+        spool.release_turn('turn', 'a')
+        self.assertFalse(os.path.exists(spool._turn_path('turn')))
+
+    def test_claim_kept_for_replay(self):
+        spool.Spool('a', 1).close()
+        self.claim_as('key', 'a', self.dead_pid())
+        # finished, its owner gone, still replayed
+        self.assertEqual(spool.claim_turn('key', 'b', replay_ttl=60), 'a')
+        expired = time.time() - 120
+        os.utime(spool._turn_path('key'), (expired, expired))
+        self.assertIsNone(spool.claim_turn('key', 'b', replay_ttl=60))
+        self.assertEqual(self.holder('key'), 'b')
+
+    def test_unfinished_claim_is_not_replayed(self):
+        # spooled up to the crash of its worker, without END_FRAME
+        os.makedirs(spool._generation_path('a'))
+        with open(spool._generation_path('a', 'frames'), 'w') as f:
+            f.write(sse_pack('message', {'content': 'Hel'}))
+        self.claim_as('key', 'a', os.getppid())
+        self.assertEqual(spool.claim_turn('key', 'b', replay_ttl=60), 'a')
+        self.claim_as('key', 'a', self.dead_pid())
+        self.assertIsNone(spool.claim_turn('key', 'b', replay_ttl=60))
+        self.assertEqual(self.holder('key'), 'b')
+
+    def test_purge(self):
+        for generation_id in ('old', 'new'):
+            spool.Spool(generation_id, 1).close()
+        os.makedirs(os.path.join(self.spool_dir, 'unwritten'))
+        self.claim_as('of-old', 'old', os.getpid())
+        self.claim_as('of-new', 'new', os.getpid())
+        expired = time.time() - 120
+        for path in (spool._generation_path('old', 'frames'), os.path.join(self.spool_dir, 'unwritten'),
+                     spool._turn_path('of-old'), spool._turn_path('of-new')):
+            os.utime(path, (expired, expired))
+        spool.purge(60)
+        self.assertEqual(sorted(os.listdir(self.spool_dir)), ['new', 'turns'])
+        # the claims of the generations left are kept
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, 'turns')), ['of-new'])
+
+
+class KeyPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.keys = 'a, b'
+        self.now = 1000.0
+        for patcher in (mock.patch.object(key_pool, 'get_setting', lambda name: self.keys),
+                        mock.patch.object(key_pool.time, 'monotonic', lambda: self.now),
+                        mock.patch.object(settings, 'API_KEY_RPM', 60),
+                        mock.patch.object(settings, 'API_KEY_TPM', 1000),
+                        mock.patch.object(settings, 'API_KEY_MAX_WAIT', 100),
+                        mock.patch.object(settings, 'API_KEY_COOLDOWN', 20),
+                        mock.patch.dict(key_pool._keys, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # the keys are learned about once used
+        key_pool._states()
+
+    def test_parse_duration(self):
+        self.assertEqual(key_pool.parse_duration('20ms'), 0.02)
+        self.assertEqual(key_pool.parse_duration('6m0s'), 360)
+        self.assertEqual(key_pool.parse_duration('1h2m3.5s'), 3723.5)
+        self.assertEqual(key_pool.parse_duration('1.5'), 1.5)
+        self.assertIsNone(key_pool.parse_duration('soon'))
+        self.assertIsNone(key_pool.parse_duration(None))
+
+    def test_no_key(self):
+        self.keys = ''
+        self.assertEqual(key_pool.reserve(100), (None, 0))
+
+    def test_spread_over_the_keys(self):
+        self.assertEqual([key_pool.reserve(100)[0] for _ in range(4)], ['a', 'b', 'a', 'b'])
+
+    def test_requests_bucket(self):
+        self.keys = 'a'
+        self.assertEqual({key_pool.reserve(1) for _ in range(60)}, {('a', 0)})
+        # a request a second
+        self.assertEqual(key_pool.reserve(1), ('a', 1))
+        self.now += 3
+        self.assertEqual(key_pool.reserve(1), ('a', 0))
+
+    def test_tokens_bucket(self):
+        self.keys = 'a'
+        self.assertEqual(key_pool.reserve(800), ('a', 0))
+        self.assertEqual(key_pool.reserve(800), ('a', 36))
+        with mock.patch.object(settings, 'API_KEY_MAX_WAIT', 10):
+            self.assertEqual(key_pool.reserve(800), ('a', 10))
+        # more than the bucket holds waits for a full bucket
+        self.now += 300
+        self.assertEqual(key_pool.reserve(5000), ('a', 0))
+
+    def test_learn_from_headers(self):
+        key_pool.reserve(1)
+        key_pool.update('a', 200, {'x-ratelimit-limit-requests': '120', 'x-ratelimit-remaining-requests': '0',
+                                   'x-ratelimit-limit-tokens': '2000', 'x-ratelimit-remaining-tokens': '1500'})
+        state = key_pool._keys['a']
+        self.assertEqual((state.requests.limit, state.requests.level), (120, 0))
+        self.assertEqual((state.tokens.limit, state.tokens.level), (2000, 999))
+        self.assertEqual(key_pool.reserve(1)[0], 'b')
+        # unknown keys and headers are ignored
+        key_pool.update('c', 200, {'x-ratelimit-remaining-requests': '0'})
+        key_pool.update('b', 200, {'x-ratelimit-limit-requests': 'many'})
+        self.assertEqual(key_pool._keys['b'].requests.limit, 60)
+
+    def test_retry_after(self):
+        key_pool.update('a', 429, {'retry-after': '2'})
+        self.assertEqual(key_pool.reserve(1)[0], 'b')
+        self.keys = 'a'
+        self.assertEqual(key_pool.reserve(1), ('a', 2))
+        self.now += 2
+        self.assertEqual(key_pool.reserve(1), ('a', 0))
+
+    def test_blocked_until_the_limit_resets(self):
+        # the tokens ran out, the requests would be allowed again sooner
+        key_pool.update('a', 429, {'x-ratelimit-reset-requests': '1s', 'x-ratelimit-reset-tokens': '40s',
+                                   'x-ratelimit-remaining-requests': '59', 'x-ratelimit-remaining-tokens': '0'})
+        self.assertEqual(key_pool._keys['a'].blocked_until, self.now + 40)
+        key_pool.update('a', 429, {'x-ratelimit-reset-requests': '6m0s', 'x-ratelimit-reset-tokens': '20ms'})
+        self.assertEqual(key_pool._keys['a'].blocked_until, self.now + 360)
+        key_pool.update('b', 429, {'x-ratelimit-reset-requests': '20ms', 'x-ratelimit-reset-tokens': '1s',
+                                   'x-ratelimit-remaining-requests': '0', 'x-ratelimit-remaining-tokens': '900'})
+        self.assertAlmostEqual(key_pool._keys['b'].blocked_until, self.now + 0.02)
+        key_pool.update('b', 429, {})
+        self.assertEqual(key_pool._keys['b'].blocked_until, self.now + 20)
+        # a shorter wait doesn't unblock the key
+        key_pool.update('b', 429, {'retry-after': '1'})
+        self.assertEqual(key_pool._keys['b'].blocked_until, self.now + 20)
+
+    def test_follow_the_setting(self):
+        key_pool.reserve(1)
+        state = key_pool._keys['a']
+        self.keys = 'c\na'
+        self.assertEqual(key_pool.reserve(1)[0], 'c')
+        self.assertEqual(list(key_pool._keys), ['c', 'a'])
+        self.assertIs(key_pool._keys['a'], state)
+
+
+class SettingCacheTests(TestCase):
+    def setUp(self):
+        version_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, version_dir, ignore_errors=True)
+        overrides = override_settings(SETTING_CACHE_VERSION_FILE=os.path.join(version_dir, 'settings.version'),
+                                      SETTING_CACHE_TTL=60)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(setting_cache, '_cache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Setting.objects.update_or_create(name='open_registration', defaults={'value': 'True'})
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(setting_cache.get_setting('open_registration'), 'True')
+            self.assertEqual(setting_cache.get_setting('missing', 'default'), 'default')
+            setting_cache.get_settings()
+
+    def test_saved_setting_once_committed(self):
+        setting_cache.get_settings()
+        with self.captureOnCommitCallbacks() as callbacks:
+            setting = Setting.objects.get(name='open_registration')
+            setting.value = 'False'
+            setting.save()
+            # a worker reloading before the commit would keep the old value
+            self.assertEqual(setting_cache.get_setting('open_registration'), 'True')
+        for callback in callbacks:
+            callback()
+        self.assertEqual(setting_cache.get_setting('open_registration'), 'False')
+
+    def test_deleted_setting(self):
+        setting_cache.get_settings()
+        with self.captureOnCommitCallbacks(execute=True):
+            Setting.objects.filter(name='open_registration').delete()
+        self.assertIsNone(setting_cache.get_setting('open_registration'))
+
+    def test_changed_by_another_worker(self):
+        setting_cache.get_settings()
+        # without signal, as seen from this worker
+        Setting.objects.filter(name='open_registration').update(value='False')
+        self.assertEqual(setting_cache.get_setting('open_registration'), 'True')
+        setting_cache._write_version()
+        with self.assertNumQueries(1):
+            self.assertEqual(setting_cache.get_setting('open_registration'), 'False')
+            setting_cache.get_settings()
+
+    def test_ttl(self):
+        setting_cache.get_settings()
+        Setting.objects.filter(name='open_registration').update(value='False')
+        with override_settings(SETTING_CACHE_TTL=0):
+            self.assertEqual(setting_cache.get_setting('open_registration'), 'False')
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pager')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        created_at = timezone.now()
+        for i in range(7):
+            Conversation.objects.create(user=self.user, topic=str(i))
+        # ties are broken by the id
+        Conversation.objects.filter(topic__in=['2', '3', '4']).update(created_at=created_at)
+        Conversation.objects.create(user=User.objects.create_user('other'), topic='other')
+        self.ids = [str(pk) for pk in Conversation.objects.filter(user=self.user)
+                    .order_by('-created_at', '-id').values_list('id', flat=True)]
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_not_paginated(self):
+        data = self.get('/api/chat/conversations/')
+        self.assertEqual([conversation['id'] for conversation in data], self.ids)
+
+    def test_walk_forward_and_back(self):
+        pages = []
+        page = self.get('/api/chat/conversations/?page_size=3')
+        self.assertIsNone(page['previous'])
+        while True:
+            pages.append([conversation['id'] for conversation in page['results']])
+            if page['next'] is None:
+                break
+            page = self.get(page['next'])
+        self.assertEqual(pages, [self.ids[0:3], self.ids[3:6], self.ids[6:]])
+
+        back = []
+        while page['previous'] is not None:
+            page = self.get(page['previous'])
+            back.append([conversation['id'] for conversation in page['results']])
+        self.assertEqual(back, [self.ids[3:6], self.ids[0:3]])
+        self.assertIsNotNone(page['next'])
+
+    def test_ascending_view(self):
+        conversation = Conversation.objects.filter(user=self.user).first()
+        for i in range(3):
+            Message.objects.create(conversation=conversation, message=str(i), is_bot=False)
+        page = self.get('/api/chat/messages/?conversationId=%s&page_size=2' % conversation.id)
+        self.assertEqual([message['message'] for message in page['results']], ['0', '1'])
+        page = self.get(page['next'])
+        self.assertEqual([message['message'] for message in page['results']], ['2'])
+        self.assertIsNone(page['next'])
+
+    def test_page_size(self):
+        with mock.patch('chat.pagination.KeysetPagination.max_page_size', 4):
+            self.assertEqual(len(self.get('/api/chat/conversations/?page_size=100')['results']), 4)
+        self.assertEqual(len(self.get('/api/chat/conversations/?page_size=0')['results']), 1)
+        self.assertEqual(len(self.get('/api/chat/conversations/?cursor=')['results']), 7)
+
+    def test_invalid_cursor(self):
+        for cursor in ('nope', 'e30=', 'eyJjIjogIm5vdyIsICJpIjogMX0='):
+            self.assertEqual(self.client.get('/api/chat/conversations/?cursor=%s' % cursor).status_code, 404)
+
+
+class UpstreamFailureTests(TestCase):
+    """
+    A turn whose upstream request fails keeps its question.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        # counts the words, the tests can't download the encodings
+        encoding = SimpleNamespace(name='words', encode=str.split)
+        for patcher in (mock.patch.dict(tokenizer._encodings, {'gpt-3.5-turbo': encoding}),
+                        mock.patch.object(settings, 'PERSISTENCE_WRITE_BEHIND', False),
+                        mock.patch.object(settings, 'GENERATION_SPOOL_DIR', ''),
+                        # run by the test, on its database connection
+                        mock.patch.object(api_module, 'start_generation', self.run_generation),
+                        mock.patch.object(generation_module, 'close_old_connections', lambda: None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_generation(self, producer, user=None, generation=None):
+        self.generation = generation_module.Generation(user_id=user.id, flush_policy='latency')
+        generation_module._run(self.generation, producer)
+        return self.generation
+
+    def upstream(self, *deltas):
+        def stream_completion(api, generation=None, **params):
+            yield from deltas
+            raise ConnectionResetError('Connection reset by peer')
+
+        return mock.patch.object(ChatGptApi, 'stream_completion', stream_completion)
+
+    def test_question_kept(self):
+        with self.upstream():
+            ChatGptApi().send_message('hello there', None, None, self.user)
+        self.assertEqual(self.generation.frames[-1], sse_pack('error', {'error': 'Connection reset by peer'}))
+        self.assertTrue(Conversation.objects.filter(user=self.user).exists())
+        self.assertEqual(list(Message.objects.values_list('message', 'is_bot', 'token_count')),
+                         [('hello there', False, 2)])
+
+    def test_partial_answer_kept(self):
+        with self.upstream('Hel', 'lo'):
+            ChatGptApi().send_message('hello there', None, None, self.user)
+        self.assertEqual(self.generation.frames[-1], sse_pack('error', {'error': 'Connection reset by peer'}))
+        question, answer = Message.objects.order_by('is_bot')
+        self.assertEqual((question.message, answer.message), ('hello there', 'Hello'))
+        self.assertEqual(answer.parent_message_id, question.id)
+        self.assertEqual(answer.conversation_id, question.conversation_id)
+
+    async def test_partial_answer_kept_by_the_async_api(self):
+        async def astream_completion(api, **params):
+            yield 'Hel'
+            yield 'lo'
+            raise ConnectionResetError('Connection reset by peer')
+
+        def astart_generation(producer, user=None, generation=None):
+            self.producer = producer
+            self.generation = generation_module.Generation(user_id=user.id, flush_policy='latency')
+            return self.generation
+
+        with mock.patch.object(ChatGptApi, 'astream_completion', astream_completion), \
+                mock.patch.object(api_module, 'astart_generation', astart_generation):
+            await ChatGptApi().asend_message('hello there', None, None, self.user)
+            await generation_module._arun(self.generation, self.producer)
+        self.assertEqual(self.generation.frames[-1], sse_pack('error', {'error': 'Connection reset by peer'}))
+        self.assertEqual([message async for message in Message.objects.order_by('is_bot').values_list('message')],
+                         [('hello there',), ('Hello',)])
+
+    def test_partial_answer_kept_by_the_unofficial_api(self):
+        conversation_id, message_id = str(uuid.uuid4()), str(uuid.uuid4())
+        # refused before answering a new conversation, there is no conversation to keep it in
+        save_failed_turn(self.user, 'hello', '', None, None, None)
+        self.assertFalse(Message.objects.exists())
+        event = {'conversation_id': conversation_id, 'message': {'id': message_id}}
+        save_failed_turn(self.user, 'hello', 'Hel', None, None, event)
+        self.assertEqual(Conversation.objects.get().id, uuid.UUID(conversation_id))
+        self.assertEqual(list(Message.objects.order_by('is_bot').values_list('id', 'message')),
+                         [(mock.ANY, 'hello'), (uuid.UUID(message_id), 'Hel')])
+        # without any answer, the question is kept in the conversation it was asked in
+        save_failed_turn(self.user, 'again', '', conversation_id, message_id, None)
+        self.assertEqual(Message.objects.get(message='again').parent_message_id, uuid.UUID(message_id))
+
+
+class ConversationTurnStreamTests(TestCase):
+    """
+    The other tabs and devices of the user find the answer being generated to a turn of a conversation.
+    """
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(settings, 'GENERATION_SPOOL_DIR', self.spool_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+        self.user = User.objects.create(username='user')
+        self.conversation_id, self.parent_message_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+    def get(self, user=None, parent_message_id=None):
+        request = RequestFactory().get('/api/conversation/stream/', {
+            'conversationId': self.conversation_id,
+            'parentMessageId': parent_message_id or self.parent_message_id,
+        }, HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(user or self.user))
+        return views.conversation_turn_stream(request)
+
+    def test_other_tab(self):
+        generation, claimed = generation_module.claim_turn(self.user, self.conversation_id, self.parent_message_id,
+                                                           'hello', flush_policy='latency')
+        self.addCleanup(generation.finish)
+        generation.publish_delta('Hel')
+
+        response = self.get()
+        self.assertEqual(response['X-Generation-Id'], generation.id)
+        stream = iter(response.streaming_content)
+        self.assertEqual(next(stream).decode(), 'id: 1\n' + sse_pack('message', {'content': 'Hel'}))
+        generation.publish(sse_pack('done', {}))
+        generation.finish()
+        self.assertEqual(b''.join(stream).decode(), 'id: 2\n' + sse_pack('done', {}))
+        # answered
+        self.assertEqual(self.get().status_code, 404)
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, 'running')), [])
+
+    def test_other_turns(self):
+        generation, claimed = generation_module.claim_turn(self.user, self.conversation_id, self.parent_message_id,
+                                                           'hello')
+        self.addCleanup(generation.finish)
+        self.assertEqual(self.get(parent_message_id=str(uuid.uuid4())).status_code, 404)
+        self.assertEqual(self.get(User.objects.create(username='other')).status_code, 404)
+
+    def run_in_other_worker(self, generation_id, pid):
+        os.makedirs(spool._generation_path(generation_id, 'readers'), exist_ok=True)
+        with open(spool._generation_path(generation_id, 'meta.json'), 'w') as f:
+            json.dump({'user_id': self.user.id, 'pid': pid}, f)
+        with open(spool._generation_path(generation_id, 'frames'), 'w') as f:
+            f.write(sse_pack('message', {'content': 'Hel'}) + spool.END_FRAME.decode())
+        key = generation_module._turn_key(self.user.id, self.conversation_id, self.parent_message_id)
+        os.makedirs(os.path.join(self.spool_dir, 'running'), exist_ok=True)
+        with open(spool._running_path(key), 'w') as f:
+            json.dump({'generation_id': generation_id, 'pid': pid}, f)
+
+    def test_other_worker(self):
+        generation_id = str(uuid.uuid4())
+        self.run_in_other_worker(generation_id, os.getppid())
+        response = self.get()
+        self.assertEqual(response['X-Generation-Id'], generation_id)
+        self.assertEqual(b''.join(response.streaming_content).decode(),
+                         'id: 1\n' + sse_pack('message', {'content': 'Hel'}))
+
+        worker = subprocess.Popen([sys.executable, '-c', 'pass'])
+        worker.wait()
+        self.run_in_other_worker(generation_id, worker.pid)
+        self.assertEqual(self.get().status_code, 404)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(settings, 'GENERATION_SPOOL_DIR', self.spool_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+        self.user = User.objects.create(username='user')
+        self.authorization = 'Bearer %s' % AccessToken.for_user(self.user)
+        self.generation = generation_module.Generation(user_id=self.user.id, flush_policy='latency')
+        self.generation.publish_delta('Hello')
+        self.generation.publish(sse_pack('done', {}))
+        self.generation.finish()
+        self.expected = 'id: 1\n%sid: 2\n%s' % (sse_pack('message', {'content': 'Hello'}), sse_pack('done', {}))
+
+    async def content(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    async def test_claim_off_the_event_loop(self):
+        loop_thread = threading.current_thread()
+        claimed_in = []
+
+        def claim_turn(*args):
+            claimed_in.append(threading.current_thread())
+            # answered for another tab
+            return self.generation, False
+
+        request = AsyncRequestFactory().post('/api/conversation/', {'message': 'hello'},
+                                             content_type='application/json',
+                                             headers={'Authorization': self.authorization})
+        with mock.patch.object(views, 'claim_turn', claim_turn):
+            response = await views.aconversation(request)
+        self.assertEqual(response['X-Generation-Id'], self.generation.id)
+        self.assertEqual(await self.content(response), self.expected)
+        self.assertEqual(len(claimed_in), 1)
+        self.assertIsNot(claimed_in[0], loop_thread)
+
+    async def test_stream(self):
+        def get(generation_id, authorization=self.authorization):
+            request = AsyncRequestFactory().get('/api/conversation/%s/' % generation_id,
+                                                headers={'Last-Event-ID': '1', 'Authorization': authorization})
+            return views.aconversation_stream(request, generation_id)
+
+        with mock.patch.dict(generation_module._generations, {self.generation.id: self.generation}):
+            response = await get(self.generation.id)
+            self.assertEqual(await self.content(response), self.expected[self.expected.index('id: 2'):])
+            self.assertEqual((await get(str(uuid.uuid4()))).status_code, 404)
+            self.assertEqual((await get(self.generation.id, '')).status_code, 401)
+
+
+class TokenRefresherTests(SimpleTestCase):
+    def setUp(self):
+        token_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, token_dir, ignore_errors=True)
+        # email -> credentials, saved by the login
+        self.store = {}
+        self.logins = []
+        self.fail = False
+        for patcher in (mock.patch.object(settings, 'ACCESS_TOKEN_DIR', token_dir),
+                        mock.patch.object(settings, 'ACCESS_TOKEN_RETRY', 300),
+                        mock.patch.object(token_refresher.Credentials, 'get',
+                                          lambda email=None: self.store.get(email, (None, None, None))),
+                        mock.patch.object(token_refresher.OpenAI, 'Auth', self.auth)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.account = token_refresher._Account('user@example.com', 'password', None)
+
+    def auth(self, email_address, password, proxy):
+        def create_token():
+            self.logins.append(email_address)
+            # long enough for the other threads to wait for it
+            time.sleep(0.1)
+            if self.fail:
+                raise PyChatGPTException('Login failed')
+            self.store[email_address] = ('token', str(time.time()), None)
+        return SimpleNamespace(create_token=create_token)
+
+    def test_single_login(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.account.refresh(0))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual(self.logins, ['user@example.com'])
+
+    def test_login_of_other_worker(self):
+        # the same account in another worker, with its own thread lock
+        other = token_refresher._Account('user@example.com', 'password', None)
+        with other._lock_file(True):
+            self.assertFalse(self.account.refresh(0, wait=False))
+        self.assertEqual(self.logins, [])
+        self.assertTrue(self.account.refresh(0, wait=False))
+
+    def test_valid_token_is_kept(self):
+        self.store['user@example.com'] = ('token', str(time.time()), None)
+        self.assertTrue(self.account.refresh(0))
+        # renewed once it expires in less than `ahead`
+        self.assertTrue(self.account.refresh(3600))
+        self.assertEqual(self.logins, ['user@example.com'])
+
+    def test_failed_login_is_not_retried(self):
+        self.fail = True
+        with self.assertRaisesMessage(PyChatGPTException, 'Login failed'):
+            self.account.refresh(0)
+        # nor by another worker
+        account = token_refresher._Account('user@example.com', 'password', None)
+        with self.assertRaisesMessage(PyChatGPTException, 'retrying later'):
+            account.refresh(0)
+        self.assertEqual(len(self.logins), 1)
+        self.fail = False
+        with mock.patch.object(settings, 'ACCESS_TOKEN_RETRY', 0):
+            self.assertTrue(account.refresh(0))
+        self.assertEqual(len(self.logins), 2)
+
+
+class CredentialsTests(TestCase):
+    def setUp(self):
+        version_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, version_dir, ignore_errors=True)
+        overrides = override_settings(SETTING_CACHE_VERSION_FILE=os.path.join(version_dir, 'settings.version'),
+                                      SETTING_CACHE_TTL=60)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(setting_cache, '_cache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = int(time.time())
+        # set by an admin, shared by the accounts
+        with self.captureOnCommitCallbacks(execute=True):
+            for name, value in (('openai_access_token', 'shared'), ('openai_access_token_expire_at', str(self.now)),
+                                ('openai_cookie', 'cookie')):
+                Setting.objects.update_or_create(name=name, defaults={'value': value})
+
+    def save(self, email, access_token, expires_at, cookie=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            credentials.save(email, access_token, expires_at, cookie)
+
+    def test_valid_until(self):
+        self.assertEqual(credentials.valid_until('1000'), 4600)
+        self.assertEqual(credentials.valid_until(1000), 4600)
+        self.assertIsNone(credentials.valid_until(None))
+        self.assertIsNone(credentials.valid_until('soon'))
+
+    def test_is_valid(self):
+        # accepted an hour past the time it expires at
+        self.assertTrue(credentials.is_valid(('token', self.now - 3000, None)))
+        self.assertFalse(credentials.is_valid(('token', self.now - 3000, None), ahead=600))
+        self.assertFalse(credentials.is_valid(('token', self.now - 4000, None)))
+        self.assertFalse(credentials.is_valid((None, self.now, None)))
+        self.assertFalse(credentials.is_valid(('token', None, None)))
+
+    def test_valid_the_longest(self):
+        self.assertEqual(credentials.get('user@example.com'), ('shared', str(self.now), 'cookie'))
+        # the cookie in use is kept
+        self.save('user@example.com', 'own', self.now + 60)
+        self.assertEqual(credentials.get('user@example.com'), ('own', self.now + 60, 'cookie'))
+        self.assertEqual(credentials.get(), ('shared', str(self.now), 'cookie'))
+        self.save('user@example.com', 'own', self.now - 60, 'other cookie')
+        self.assertEqual(credentials.get('user@example.com'), ('shared', str(self.now), 'cookie'))
+
+    def test_discard(self):
+        self.save('user@example.com', 'own', self.now + 60)
+        self.save('other@example.com', 'other', self.now + 60)
+        with self.captureOnCommitCallbacks(execute=True):
+            credentials.discard('own')
+        self.assertEqual(credentials.get('user@example.com'), ('shared', str(self.now), 'cookie'))
+        self.assertTrue(credentials.is_valid(credentials.get('other@example.com')))
+        with self.captureOnCommitCallbacks(execute=True):
+            credentials.discard('shared')
+        self.assertFalse(credentials.is_valid(credentials.get()))
+        self.assertEqual(Setting.objects.get(name='openai_access_token_expire_at').value, '0')
+
+    def test_discarded_once_refused(self):
+        session = SimpleNamespace(post=lambda *args, **kwargs: SimpleNamespace(status_code=401, text='expired'))
+        with mock.patch('chatgpt_api.classes.chat.get_session', lambda proxy=None: session), \
+                self.captureOnCommitCallbacks(execute=True):
+            answer, message_id, conversation_id = ask(credentials.get(), 'hello', None, None, None,
+                                                      pass_moderation=True)
+        self.assertEqual((answer, message_id), ('[Status Code] 401 | [Response Text] expired', None))
+        # the next lookup logs in again
+        self.assertFalse(credentials.is_valid(credentials.get()))
+
+
+class BuildMessagesTests(TestCase):
+    def setUp(self):
+        # counts the words, the tests can't download the encodings
+        encoding = SimpleNamespace(name='words', encode=str.split)
+        patcher = mock.patch.dict(tokenizer._encodings, {'gpt-3.5-turbo': encoding})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conversation = Conversation.objects.create(user=User.objects.create(username='user'))
+        created_at = timezone.now()
+        for i, (message, is_bot, token_count, token_encoding) in enumerate([
+                ('one two three', False, 3, 'words'),
+                ('four', True, 1, 'words'),
+                # not counted yet
+                ('five six', False, None, None),
+                # counted for another encoding
+                ('seven', True, 30, 'cl100k_base')]):
+            Message.objects.create(conversation=self.conversation, message=message, is_bot=is_bot,
+                                   token_count=token_count, token_encoding=token_encoding,
+                                   created_at=created_at + timedelta(seconds=i))
+        self.new_message = Message(conversation=self.conversation, message='eight nine', token_count=2,
+                                   token_encoding='words')
+
+    def build_messages(self, max_prompt_tokens):
+        model = dict(api_module.get_current_model(), max_prompt_tokens=max_prompt_tokens)
+        with mock.patch.object(api_module, 'get_current_model', lambda: model):
+            return build_messages(self.conversation, self.new_message)
+
+    def test_window_over_the_stored_counts(self):
+        # 12 tokens for the system message, 5 for the role of each message and the words of its text
+        with self.assertNumQueries(4):
+            messages = self.build_messages(12 + 7 + 6 + 7 + 6)
+        self.assertEqual(messages[1:], [{'role': 'assistant', 'content': 'four'},
+                                        {'role': 'user', 'content': 'five six'},
+                                        {'role': 'assistant', 'content': 'seven'},
+                                        {'role': 'user', 'content': 'eight nine'}])
+        self.assertEqual(len(self.build_messages(12 + 7 + 6 + 7 + 6 + 8)), 6)
+
+    def test_question_too_long(self):
+        with self.assertRaisesMessage(ValueError, 'Prompt is too long'):
+            self.build_messages(12 + 6)
+
+    def test_fit_token_counts(self):
+        token_counts = iter([5, 5, 5, 5])
+        self.assertEqual(fit_token_counts(token_counts, 2, 13), 2)
+        # stopped at the first count which doesn't fit
+        self.assertEqual(list(token_counts), [5])
+        self.assertEqual(fit_token_counts([5, 1], 2, 7), 1)
+        self.assertEqual(fit_token_counts([], 2, 7), 0)
+
+
+class BackfillTokenCountsTests(TestCase):
+    def setUp(self):
+        # counts the words, the tests can't download the encodings
+        encoding = SimpleNamespace(name='words', encode=str.split)
+        patcher = mock.patch.dict(tokenizer._encodings, {'gpt-3.5-turbo': encoding})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        conversation = Conversation.objects.create(user=User.objects.create(username='user'))
+        for message, token_count, token_encoding in [('one', None, None), ('two words', 30, 'cl100k_base'),
+                                                     ('three more words', None, None), ('counted', 5, 'words')]:
+            Message.objects.create(conversation=conversation, message=message, token_count=token_count,
+                                   token_encoding=token_encoding)
+
+    def test_backfill(self):
+        out = io.StringIO()
+        call_command('backfill_token_counts', batch_size=2, stdout=out)
+        self.assertEqual(dict(Message.objects.values_list('message', 'token_count')),
+                         {'one': 1, 'two words': 2, 'three more words': 3, 'counted': 5})
+        self.assertEqual(set(Message.objects.values_list('token_encoding', flat=True)), {'words'})
+        self.assertIn('Done, 3 messages updated with words', out.getvalue())
+        # nothing left to count
+        call_command('backfill_token_counts', stdout=out)
+        self.assertIn('Done, 0 messages updated', out.getvalue())
+
+
+class ClientsTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(clients._sessions, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_session_reused(self):
+        proxy = {'https': 'http://proxy', 'http': 'http://proxy'}
+        session = clients.get_session('key', 'https://api.openai.com', proxy)
+        # the same proxy, in another order
+        self.assertIs(clients.get_session('key', 'https://api.openai.com', dict(reversed(proxy.items()))), session)
+        self.assertEqual(session.headers['Authorization'], 'Bearer key')
+        self.assertEqual(session.proxies, {'http': 'http://proxy', 'https': 'http://proxy'})
+        adapter = session.get_adapter('https://api.openai.com')
+        self.assertEqual((adapter._pool_maxsize, adapter._pool_block), (settings.HTTP_POOL_SIZE, True))
+
+        others = [clients.get_session('other key', 'https://api.openai.com'),
+                  clients.get_session('key', 'https://example.com'),
+                  clients.get_session('key', 'https://api.openai.com', 'http://proxy'),
+                  clients.get_session(proxy='http://proxy')]
+        self.assertEqual(len({id(other) for other in [session] + others}), 5)
+        self.assertEqual(others[2].proxies, {'http': 'http://proxy', 'https': 'http://proxy'})
+        # a token which changes is sent by the requests
+        self.assertNotIn('Authorization', others[3].headers)
+
+    def test_session_created_once(self):
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(clients.get_session('key'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({id(session) for session in sessions}), 1)
+
+    async def test_client_session_of_the_loop(self):
+        session = clients.get_client_session('key', 'https://api.openai.com')
+        self.assertIs(clients.get_client_session('key', 'https://api.openai.com'), session)
+        other = clients.get_client_session('other key', 'https://api.openai.com')
+        self.assertIsNot(other, session)
+        await other.close()
+        await session.close()
+        # a closed session is replaced
+        session = clients.get_client_session('key', 'https://api.openai.com')
+        self.assertFalse(session.closed)
+        await session.close()
+
+
+class ModerationPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        self.released = threading.Event()
+        for patcher in (mock.patch.object(settings, 'MODERATION_WORKERS', 1),
+                        mock.patch.object(settings, 'MODERATION_QUEUE_SIZE', 2),
+                        mock.patch.object(chat_module, '_moderation_executor', None),
+                        mock.patch.object(chat_module, '_moderation_slots', None),
+                        mock.patch.object(chat_module, '__pass_mo', self.pass_moderation)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: chat_module._moderation_executor and chat_module._moderation_executor.shutdown())
+        self.addCleanup(self.released.set)
+
+    def pass_moderation(self, access_token, text, proxies):
+        self.released.wait(5)
+        self.sent.append(text)
+        if text == 'fail':
+            raise ConnectionResetError('Connection reset by peer')
+
+    def drain(self):
+        # the single worker runs the callbacks of a moderation, releasing its slot, before its next task
+        chat_module._moderation_executor.submit(lambda: None).result(5)
+
+    def test_bounded(self):
+        moderations = [chat_module._moderate('token', text, None) for text in ('a', 'b', 'c')]
+        # skipped rather than queued
+        self.assertIsNone(moderations[2])
+        self.released.set()
+        self.drain()
+        self.assertEqual(self.sent, ['a', 'b'])
+        # the slots are released once sent, failed or not
+        moderation = chat_module._moderate('token', 'fail', None)
+        self.drain()
+        self.assertIsInstance(moderation.exception(), ConnectionResetError)
+        moderations = [chat_module._moderate('token', text, None) for text in ('d', 'e')]
+        self.drain()
+        self.assertTrue(all(moderation.done() for moderation in moderations))
+        self.assertEqual(self.sent, ['a', 'b', 'fail', 'd', 'e'])
+
+    def test_wait(self):
+        moderation = chat_module._moderate('token', 'a', None)
+        started_at = time.monotonic()
+        with mock.patch.object(settings, 'MODERATION_WAIT', 0):
+            chat_module._wait_for_moderation(moderation)
+        self.assertLess(time.monotonic() - started_at, 0.05)
+        with mock.patch.object(settings, 'MODERATION_WAIT', 0.1):
+            chat_module._wait_for_moderation(moderation)
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.1)
+        self.assertFalse(moderation.done())
+        self.released.set()
+        with mock.patch.object(settings, 'MODERATION_WAIT', 5):
+            chat_module._wait_for_moderation(moderation)
+        self.assertTrue(moderation.done())
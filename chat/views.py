@@ -1,19 +1,28 @@
+import asyncio
 import os
+import time
 import json
 import openai
 import datetime
-import tiktoken
 
-from chatgpt_api import Chat, Options
+from chatgpt_api import chat_pool, completion_cache, key_pool
 from chatgpt_api.api import ChatGptApi
-from .models import Conversation, Message, Setting, Prompt
+from chatgpt_api.clients import get_client_session
+from chatgpt_api.generation import get_generation, claim_turn, find_turn, get_flush_policy, get_last_event_id, \
+    get_disconnected_event, generation_response, ageneration_response
+from . import persistence
+from .models import Conversation, Message, Prompt
 from django.conf import settings
-from django.http import StreamingHttpResponse
-from rest_framework import viewsets, status
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse, JsonResponse
+from rest_framework import viewsets, status, exceptions
+from rest_framework.request import Request
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.settings import api_settings
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.decorators import api_view, authentication_classes, permission_classes, action
+from .pagination import KeysetPagination
 from .serializers import ConversationSerializer, MessageSerializer, PromptSerializer
 
 
@@ -21,6 +30,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
     serializer_class = ConversationSerializer
     # authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Conversation.objects.filter(user=self.request.user).order_by('-created_at')
@@ -36,16 +46,20 @@ class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     # authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
-        return Message.objects.filter(conversation_id=self.request.query_params.get('conversationId')).order_by(
-            'created_at')
+        conversation_id = self.request.query_params.get('conversationId')
+        # the last turn may still be being written
+        persistence.wait_for_conversation(conversation_id)
+        return Message.objects.filter(conversation_id=conversation_id).order_by('created_at')
 
 
 class PromptViewSet(viewsets.ModelViewSet):
     serializer_class = PromptSerializer
     # authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Prompt.objects.filter(user=self.request.user).order_by('-created_at')
@@ -67,11 +81,26 @@ class PromptViewSet(viewsets.ModelViewSet):
         return Response(status=204)
 
 
+def _title_params(model, messages):
+    # the parameters of a title completion, also the key of its cached title
+    return dict(
+        model=model['name'],
+        messages=messages,
+        max_tokens=256,
+        temperature=0.5,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+    )
+
+
 @api_view(['POST'])
 # @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
 def gen_title(request):
     conversation_id = request.data.get('conversationId')
+    # asked for right after the first answer, which may still be being written
+    persistence.wait_for_conversation(conversation_id)
     conversation_obj = Conversation.objects.get(id=conversation_id)
     message = Message.objects.filter(conversation_id=conversation_id).order_by('created_at').first()
 
@@ -81,23 +110,28 @@ def gen_title(request):
     ]
 
     model = get_current_model()
-
-    my_openai = get_openai()
-    try:
-        openai_response = my_openai.ChatCompletion.create(
-            model=model['name'],
-            messages=messages,
-            max_tokens=256,
-            temperature=0.5,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        )
-        completion_text = openai_response['choices'][0]['message']['content']
-        title = completion_text.strip().replace('"', '')
-    except Exception as e:
-        print(e)
-        title = 'Untitled Conversation'
+    completion_params = _title_params(model, messages)
+
+    # sampled, so only cached when opted in: the same first message then gets the same title
+    completion_text = completion_cache.get(completion_params, settings.COMPLETION_CACHE_TITLES)
+    if completion_text is None:
+        # on the key of the pool with the most headroom, like the answers
+        api_key, delay = key_pool.reserve(key_pool.estimate_tokens(messages, 256))
+        time.sleep(delay)
+        try:
+            # the key is passed with the request, the openai module is shared by the threads
+            openai_response = openai.ChatCompletion.create(
+                api_key=api_key,
+                api_base=os.getenv('OPENAI_API_PROXY') or None,
+                **completion_params
+            )
+            completion_text = openai_response['choices'][0]['message']['content']
+            completion_cache.put(completion_params, completion_text, settings.COMPLETION_CACHE_TITLES)
+        except Exception as e:
+            print(e)
+            if isinstance(e, openai.error.RateLimitError):
+                key_pool.update(api_key, 429, e.headers)
+    title = completion_text.strip().replace('"', '') if completion_text is not None else 'Untitled Conversation'
     # update the conversation title
     conversation_obj.topic = title
     conversation_obj.save()
@@ -114,68 +148,261 @@ def conversation(request):
     conversation_id = request.data.get('conversationId')
     parent_message_id = request.data.get('parentMessageId')
 
+    generation, claimed = claim_turn(request.user, conversation_id, parent_message_id, message,
+                                     request.headers.get('Idempotency-Key'), get_flush_policy(request))
+    if not claimed:
+        # a retry or a double click, or the turn is being answered for another tab or device: follow or replay
+        # the same stream
+        return generation_response(generation)
+
     def api_send_message():
-        api = ChatGptApi(get_openai_api_key())
+        api = ChatGptApi()
         return api.send_message(message=message, conversation_id=conversation_id, parent_message_id=parent_message_id,
-                                user=request.user, stream=True)
+                                user=request.user, stream=True, generation=generation)
 
     def api_unofficial_send_message():
-        options = Options()
-
-        # [New] Pass Moderation. https://github.com/rawandahmad698/PyChatGPT/discussions/103
-        # options.pass_moderation = False
-
-        # [New] Enable, Disable logs
-        options.log = True
-
-        # Track conversation
-        options.track = True
+        # a ready session of the pool, given back when the answer is finished
+        lease = chat_pool.checkout()
+        try:
+            response = lease.chat.ask(prompt=message, conversation_id=conversation_id,
+                                      parent_message_id=parent_message_id, user=request.user, generation=generation)
+        except Exception:
+            # the session counted its failure if it was one, not an invalid request
+            lease.release()
+            raise
+        generation.on_finish(lease.release)
+        return response
 
-        # Use a proxy
-        # options.proxies = 'http://localhost:1087'
-
-        # Optionally, you can pass a file path to save the conversation
-        # They're created if they don't exist
+    try:
+        if chat_pool.enabled():
+            return api_unofficial_send_message()
+        return api_send_message()
+    finally:
+        if not generation.started:
+            # failed before sending anything upstream, let the next request for the turn answer it
+            generation.finish()
 
-        # options.chat_log = "chat_log.txt"
-        # options.id_log = "id_log.txt"
 
-        # Create a Chat object
-        chat = Chat(email="audiofirst2019@gmail.com", password="TryitNow!!", options=options)
-        return chat.ask(prompt=message, conversation_id=conversation_id, parent_message_id=parent_message_id,
-                        user=request.user)
+@api_view(['POST'])
+# @authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def stop_generation(request, generation_id):
+    """
+    Stops a generation: the upstream request is cancelled and the answer received so far is saved.
+    """
+    generation = get_generation(generation_id)
+    if generation is None or generation.user_id != request.user.id:
+        return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response({'stopped': generation.cancel()})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def completion_cache_stats(request):
+    """
+    Hits, misses and hit rate of the completion cache, counted by the worker process answering the request.
+    """
+    return Response(completion_cache.get_stats())
+
+
+def _authenticate(request):
+    """
+    Wraps a plain Django request into a DRF one, so views that can't be API views (async or event streams) share
+    the authentication and the parsers of the API views. Returns the DRF request, or a response to send back when
+    the user is not authenticated.
+    """
+    drf_request = Request(
+        request,
+        parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+        authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+    )
+    try:
+        user = drf_request.user
+    except exceptions.APIException as e:
+        return None, JsonResponse({'detail': str(e.detail)}, status=e.status_code)
+    if not user or not user.is_authenticated:
+        return None, JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                                  status=status.HTTP_401_UNAUTHORIZED)
+    return drf_request, None
+
+
+async def _aauthenticate(request):
+    # the authenticators hit the database to load the user
+    return await sync_to_async(_authenticate)(request)
+
+
+def conversation_stream(request, generation_id):
+    """
+    Streams a generation again, starting after the event id given by `Last-Event-ID`, so a client that lost its
+    connection can resume the answer.
+    """
+    request, error_response = _authenticate(request)
+    if error_response:
+        return error_response
+    generation = get_generation(generation_id)
+    if generation is None or generation.user_id != request.user.id:
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return generation_response(generation, get_last_event_id(request))
+
+
+def conversation_turn_stream(request):
+    """
+    Streams the answer being generated to the `parentMessageId` of the conversation `conversationId`, whichever tab
+    or device asked for it, starting after the event id given by `Last-Event-ID` like `conversation_stream`.
+    """
+    request, error_response = _authenticate(request)
+    if error_response:
+        return error_response
+    generation = find_turn(request.user, request.query_params.get('conversationId'),
+                           request.query_params.get('parentMessageId'))
+    if generation is None or generation.user_id != request.user.id:
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return generation_response(generation, get_last_event_id(request))
+
+
+async def aconversation_stream(request, generation_id):
+    """
+    Async version of `conversation_stream` for the ASGI server.
+    """
+    request, error_response = await _aauthenticate(request)
+    if error_response:
+        return error_response
+    # the generations of the other workers are read from the spool
+    generation = await sync_to_async(get_generation)(generation_id)
+    if generation is None or generation.user_id != request.user.id:
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return ageneration_response(generation, get_last_event_id(request), get_disconnected_event(request))
+
+
+async def aconversation_turn_stream(request):
+    """
+    Async version of `conversation_turn_stream` for the ASGI server.
+    """
+    request, error_response = await _aauthenticate(request)
+    if error_response:
+        return error_response
+    # the generations of the other workers are looked up in the spool
+    generation = await sync_to_async(find_turn)(request.user, request.query_params.get('conversationId'),
+                                                request.query_params.get('parentMessageId'))
+    if generation is None or generation.user_id != request.user.id:
+        return JsonResponse({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return ageneration_response(generation, get_last_event_id(request), get_disconnected_event(request))
+
+
+async def agen_title(request):
+    """
+    Async version of `gen_title` for the ASGI server.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method "%s" not allowed.' % request.method},
+                            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    request, error_response = await _aauthenticate(request)
+    if error_response:
+        return error_response
 
-    return api_unofficial_send_message()
+    conversation_id = request.data.get('conversationId')
+    # asked for right after the first answer, which may still be being written
+    await sync_to_async(persistence.wait_for_conversation)(conversation_id)
+    conversation_obj = await Conversation.objects.aget(id=conversation_id)
+    message = await Message.objects.filter(conversation_id=conversation_id).order_by('created_at').afirst()
 
+    messages = [
+        {"role": "user",
+         "content": 'Generate a short title for the following content, no more than 10 words: \n\n "%s"' % message.message},
+    ]
 
-def build_messages(conversation_obj):
     model = get_current_model()
+    completion_params = _title_params(model, messages)
+
+    # sampled, so only cached when opted in, the sqlite backend blocks
+    completion_text = await sync_to_async(completion_cache.get)(completion_params, settings.COMPLETION_CACHE_TITLES)
+    if completion_text is None:
+        # on the key of the pool with the most headroom, like the answers
+        api_key, delay = await sync_to_async(key_pool.reserve)(key_pool.estimate_tokens(messages, 256))
+        await asyncio.sleep(delay)
+        # reuse the pooled connections instead of a new aiohttp session per call
+        openai.aiosession.set(get_client_session())
+        try:
+            openai_response = await openai.ChatCompletion.acreate(
+                api_key=api_key,
+                api_base=os.getenv('OPENAI_API_PROXY') or None,
+                **completion_params
+            )
+            completion_text = openai_response['choices'][0]['message']['content']
+            await sync_to_async(completion_cache.put)(completion_params, completion_text,
+                                                      settings.COMPLETION_CACHE_TITLES)
+        except Exception as e:
+            print(e)
+            if isinstance(e, openai.error.RateLimitError):
+                key_pool.update(api_key, 429, e.headers)
+    title = completion_text.strip().replace('"', '') if completion_text is not None else 'Untitled Conversation'
+    # update the conversation title
+    conversation_obj.topic = title
+    await conversation_obj.asave()
+    return JsonResponse({
+        'title': title
+    })
 
-    ordered_messages = Message.objects.filter(conversation=conversation_obj).order_by('created_at')
-    ordered_messages_list = list(ordered_messages)
 
-    system_messages = [{"role": "system", "content": "You are a helpful assistant."}]
+async def aconversation(request):
+    """
+    Async version of `conversation` for the ASGI server, the upstream answer is streamed without holding a thread.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method "%s" not allowed.' % request.method},
+                            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    request, error_response = await _aauthenticate(request)
+    if error_response:
+        return error_response
 
-    current_token_count = num_tokens_from_messages(system_messages, model['name'])
+    message = request.data.get('message')
+    conversation_id = request.data.get('conversationId')
+    parent_message_id = request.data.get('parentMessageId')
 
-    max_token_count = model['max_prompt_tokens']
+    # the claims are files of the spool shared by the workers, keep their reads and writes off the event loop
+    generation, claimed = await sync_to_async(claim_turn)(request.user, conversation_id, parent_message_id, message,
+                                                          request.headers.get('Idempotency-Key'),
+                                                          get_flush_policy(request))
+    if not claimed:
+        # a retry or a double click, or the turn is being answered for another tab or device: follow or replay
+        # the same stream
+        return ageneration_response(generation, disconnected=get_disconnected_event(request))
+
+    async def api_send_message():
+        api = ChatGptApi()
+        return await api.asend_message(message=message, conversation_id=conversation_id,
+                                       parent_message_id=parent_message_id, user=request.user,
+                                       disconnected=get_disconnected_event(request), generation=generation)
+
+    async def api_unofficial_send_message():
+        # a ready session of the pool, given back when the answer is finished. Creating one reads the access token
+        # and may log in, keep that off the event loop
+        lease = await sync_to_async(chat_pool.checkout)()
+        try:
+            response = await lease.chat.aask(prompt=message, conversation_id=conversation_id,
+                                             parent_message_id=parent_message_id, user=request.user,
+                                             disconnected=get_disconnected_event(request), generation=generation)
+        except Exception:
+            # the session counted its failure if it was one, not an invalid request
+            lease.release()
+            raise
+        generation.on_finish(lease.release)
+        return response
 
-    messages = []
+    try:
+        if chat_pool.enabled():
+            return await api_unofficial_send_message()
+        return await api_send_message()
+    finally:
+        if not generation.started:
+            # failed before sending anything upstream, let the next request for the turn answer it
+            generation.finish()
 
-    while current_token_count < max_token_count and len(ordered_messages_list) > 0:
-        message = ordered_messages_list.pop()
-        role = "assistant" if message.is_bot else "user"
-        new_message = {"role": role, "content": message.message}
-        new_token_count = num_tokens_from_messages(system_messages + messages + [new_message])
-        if new_token_count > max_token_count:
-            if len(messages) > 0:
-                break
-            raise ValueError(
-                f"Prompt is too long. Max token count is {max_token_count}, but prompt is {new_token_count} tokens long.")
-        messages.insert(0, new_message)
-        current_token_count = new_token_count
 
-    return system_messages + messages
+# Like the api views, authentication is handled by the JWT cookie. The `csrf_exempt` decorator can't be used here,
+# it wraps the coroutine function into a sync one in this Django version.
+agen_title.csrf_exempt = True
+aconversation.csrf_exempt = True
 
 
 def get_current_model():
@@ -186,40 +413,3 @@ def get_current_model():
         'max_response_tokens': 1000
     }
     return model
-
-
-def get_openai_api_key():
-    row = Setting.objects.filter(name='openai_api_key').first()
-    if row:
-        return row.value
-    return None
-
-
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
-    else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}. See 
-        https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to 
-        tokens.""")
-
-
-def get_openai():
-    openai.api_key = get_openai_api_key()
-    proxy = os.getenv('OPENAI_API_PROXY')
-    if proxy:
-        openai.api_base = proxy
-    return openai
@@ -1,20 +1,32 @@
+import asyncio
 import os
 import json
+import time
 
 import openai
-import tiktoken
+from asgiref.sync import sync_to_async
+from django.db.models import Q
 from django.http import StreamingHttpResponse, HttpResponse, JsonResponse
 from requests import Response
 from rest_framework import status
 
-from chat.models import Message, Conversation, Setting
+from chat import persistence
+from chat.models import Message, Conversation
 from chatgpt_ui_server import settings
+from . import clients, key_pool
+from .classes.sse import iter_sse, aiter_sse
 from .classes.utils import sse_pack
+from .generation import Delta, start_generation, astart_generation, generation_response, ageneration_response
+from .tokenizer import get_encoding, num_tokens_from_message, num_tokens_from_messages
+
+# Number of history rows read per query when building the context window
+HISTORY_CHUNK_SIZE = 50
 
 
 class ChatGptApi:
     api_base_url = "https://api.openai.com/v1"
-    api_key = ''
+    # None spreads the requests over the keys of the `openai_api_key` setting
+    api_key = None
     debug = True
     temperature = 0.8
     top_p = 1.0
@@ -23,7 +35,7 @@ class ChatGptApi:
     # Creates a new client wrapper around OpenAI's chat completion API, mimicing the official ChatGPT webapp's
     # functionality as closely as possible.
     #
-    # @param api_key - OpenAI API key (required).
+    # @param api_key - Optional OpenAI API key, the keys of the `openai_api_key` setting are used by default.
     # @param api_base_url - Optional override for the OpenAI API base URL.
     # @param debug - Optional enables logging debugging info to stdout.
     # @param model - ID of the model to use. Currently, only `gpt-3.5-turbo` and `gpt-3.5-turbo-0301` are supported.
@@ -42,8 +54,6 @@ class ChatGptApi:
             self.api_base_url = api_base_url
         if api_key is not None:
             self.api_key = api_key
-        else:
-            self.api_key = get_openai_api_key()
         if debug is not None:
             self.debug = debug
         if temperature is not None:
@@ -54,25 +64,27 @@ class ChatGptApi:
             self.presence_penalty = presence_penalty
 
     def send_message(self, message, conversation_id, parent_message_id, user, max_tokens=None,
-                     temperature=None, top_p=None, frequency_penalty=None, presence_penalty=None, stream=True):
+                     temperature=None, top_p=None, frequency_penalty=None, presence_penalty=None, stream=True,
+                     generation=None):
         model = get_current_model()
         if conversation_id:
-            # get the conversation
+            # get the conversation, once its previous turn is written
+            persistence.wait_for_conversation(conversation_id)
             conversation_obj = Conversation.objects.get(id=conversation_id)
+            new_conversation_obj = None
         else:
-            # create a new conversation
-            conversation_obj = Conversation(user=user)
-            conversation_obj.save()
-        # insert a new message
+            # create a new conversation, saved with the turn
+            conversation_obj = new_conversation_obj = Conversation(user=user)
+        # the new message, saved with the answer
         message_obj = Message(
             conversation_id=conversation_obj.id,
             parent_message_id=parent_message_id,
             message=message
         )
-        message_obj.save()
+        set_token_count(message_obj, model['name'])
 
         try:
-            messages = build_messages(conversation_obj)
+            messages = build_messages(conversation_obj, message_obj)
 
             if settings.DEBUG:
                 print(messages)
@@ -88,98 +100,235 @@ class ChatGptApi:
         num_tokens = num_tokens_from_messages(messages)
         max_tokens = min(model['max_tokens'] - num_tokens, model['max_response_tokens'])
 
-        def normal_content():
-            my_openai = self.get_openai()
-
-            openai_response = my_openai.ChatCompletion.create(
-                model=model['name'],
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=self.temperature,
-                top_p=self.top_p,
-                frequency_penalty=0,
-                presence_penalty=self.presence_penalty,
-                stream=True,
-            )
-            completion_text = ''
-            # iterate through the stream of events
-            for event in openai_response:
-                # print(event)
-                if event['choices'][0]['finish_reason'] is not None:
-                    break
-                # if debug
-                if settings.DEBUG:
-                    print(event)
-                if 'content' in event['choices'][0]['delta']:
-                    event_text = event['choices'][0]['delta']['content']
-                    completion_text += event_text  # append the text
+        completion_params = dict(
+            model=model['name'],
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            frequency_penalty=0,
+            presence_penalty=self.presence_penalty,
+        )
 
-            ai_message_obj = Message(
-                conversation_id=conversation_obj.id,
-                parent_message_id=message_obj.id,
-                message=completion_text,
-                is_bot=True
-            )
-            ai_message_obj.save()
+        def normal_content():
+            try:
+                completion_text = ''.join(self.stream_completion(**completion_params))
+            except Exception:
+                # the question is kept
+                save_turn(new_conversation_obj, message_obj, None)
+                raise
+
+            ai_message_obj = save_turn(new_conversation_obj, message_obj, completion_text)
             return {'messageId': ai_message_obj.id, 'conversationId': conversation_obj.id, 'content': completion_text}
 
 
-        def stream_content():
-            my_openai = self.get_openai()
-
-            openai_response = my_openai.ChatCompletion.create(
-                model=model['name'],
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=self.temperature,
-                top_p=self.top_p,
-                frequency_penalty=0,
-                presence_penalty=self.presence_penalty,
-                stream=stream,
-            )
-            collected_events = []
+        def stream_content(generation):
             completion_text = ''
-            # iterate through the stream of events
-            for event in openai_response:
-                collected_events.append(event)  # save the event response
-                # print(event)
-                if event['choices'][0]['finish_reason'] is not None:
-                    break
-                # if debug
-                if settings.DEBUG:
-                    print(event)
-                if 'content' in event['choices'][0]['delta']:
-                    event_text = event['choices'][0]['delta']['content']
+            try:
+                for event_text in self.stream_completion(generation, **completion_params):
                     completion_text += event_text  # append the text
-                    yield sse_pack('message', {'content': event_text})
+                    yield Delta(event_text)
+            except Exception:
+                # the question and the answer received so far are kept, before the generation runner sends the error
+                save_turn(new_conversation_obj, message_obj, completion_text or None)
+                raise
 
-            ai_message_obj = Message(
-                conversation_id=conversation_obj.id,
-                parent_message_id=message_obj.id,
-                message=completion_text,
-                is_bot=True
-            )
-            ai_message_obj.save()
-            yield sse_pack('done', {'messageId': ai_message_obj.id, 'conversationId': conversation_obj.id})
+            ai_message_obj = save_turn(new_conversation_obj, message_obj, completion_text)
+            yield sse_pack('done', {'messageId': ai_message_obj.id, 'conversationId': conversation_obj.id,
+                                    'stopped': generation.cancelled})
 
         if stream:
-            return StreamingHttpResponse(stream_content(), content_type='text/event-stream')
+            # generated detached from the response, the answer is saved even if the client goes away
+            generation = start_generation(stream_content, user=user, generation=generation)
+            return generation_response(generation)
         else:
             return JsonResponse(normal_content())
 
-    def get_openai(self):
-        openai.api_key = self.api_key
-        proxy = os.getenv('OPENAI_API_PROXY')
-        if proxy:
-            openai.api_base = proxy
-        return openai
+    async def asend_message(self, message, conversation_id, parent_message_id, user, disconnected=None,
+                            generation=None):
+        """
+        Async counterpart of `send_message` (stream mode) for the ASGI server. The completion is streamed with
+        aiohttp, so waiting on tokens does not hold a worker thread. `disconnected` is the event set when the client
+        goes away.
+        """
+        model = get_current_model()
+        if conversation_id:
+            # get the conversation, once its previous turn is written
+            await sync_to_async(persistence.wait_for_conversation)(conversation_id)
+            conversation_obj = await Conversation.objects.aget(id=conversation_id)
+            new_conversation_obj = None
+        else:
+            # create a new conversation, saved with the turn
+            conversation_obj = new_conversation_obj = Conversation(user=user)
+        # the new message, saved with the answer
+        message_obj = Message(
+            conversation_id=conversation_obj.id,
+            parent_message_id=parent_message_id,
+            message=message
+        )
+        await sync_to_async(set_token_count)(message_obj, model['name'])
+
+        try:
+            # tokenizing and reading the history are blocking, run them in a worker thread
+            messages = await sync_to_async(build_messages)(conversation_obj, message_obj)
+
+            if settings.DEBUG:
+                print(messages)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+        num_tokens = await sync_to_async(num_tokens_from_messages)(messages)
+        max_tokens = min(model['max_tokens'] - num_tokens, model['max_response_tokens'])
 
-def get_openai_api_key():
-    row = Setting.objects.filter(name='openai_api_key').first()
-    if row:
-        return row.value
-    return None
+        async def stream_content(generation):
+            completion_text = ''
+            try:
+                async for event_text in self.astream_completion(
+                        model=model['name'],
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=self.temperature,
+                        top_p=self.top_p,
+                        frequency_penalty=0,
+                        presence_penalty=self.presence_penalty,
+                ):
+                    completion_text += event_text  # append the text
+                    yield Delta(event_text)
+            except asyncio.CancelledError:
+                # stopped, the upstream connection is closed with the stream, keep the partial answer
+                if not generation.cancelled:
+                    raise
+            except Exception:
+                # the question and the answer received so far are kept, before the generation runner sends the error
+                await sync_to_async(save_turn)(new_conversation_obj, message_obj, completion_text or None)
+                raise
+
+            ai_message_obj = await sync_to_async(save_turn)(new_conversation_obj, message_obj, completion_text)
+            yield sse_pack('done', {'messageId': ai_message_obj.id, 'conversationId': conversation_obj.id,
+                                    'stopped': generation.cancelled})
+
+        generation = astart_generation(stream_content, user=user, generation=generation)
+        return ageneration_response(generation, disconnected=disconnected)
+
+    def _completion_request(self, **params):
+        # requested without the openai library, so the raw stream goes through the shared SSE decoder
+        base_url = (os.getenv('OPENAI_API_PROXY') or self.api_base_url).rstrip('/')
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream',
+        }
+        return base_url, '%s/chat/completions' % base_url, headers, json.dumps(dict(params, stream=True))
+
+    def stream_completion(self, generation=None, **params):
+        """
+        Yields the content deltas of a streamed chat completion. Cancelling `generation` closes the response,
+        which interrupts a read waiting for the next chunk.
+        """
+        base_url, url, headers, body = self._completion_request(**params)
+        tokens = key_pool.estimate_tokens(params['messages'], params.get('max_tokens'))
+        for attempt in range(settings.API_KEY_RETRIES + 1):
+            api_key, delay = self._reserve_key(tokens)
+            time.sleep(delay)
+            # the client of the API key sends it, and keeps the connection for the next completion
+            response = clients.get_session(api_key, base_url).post(url, headers=headers, data=body, stream=True)
+            key_pool.update(api_key, response.status_code, response.headers)
+            if response.status_code != 429 or self.api_key or attempt == settings.API_KEY_RETRIES:
+                break
+            # rate limited before anything was streamed, the next key is tried
+            response.close()
+        try:
+            if response.status_code != 200:
+                raise completion_error(response.status_code, response.text)
+            if generation is not None:
+                generation.on_cancel(response.close)
+            for delta in iter_completion_deltas(iter_sse(response.iter_content(chunk_size=None))):
+                if generation is not None and generation.cancelled:
+                    return
+                yield delta
+        except Exception:
+            if generation is None or not generation.cancelled:
+                raise
+        finally:
+            response.close()
+
+    async def astream_completion(self, **params):
+        """
+        Async counterpart of `stream_completion`, the response is closed when the task is cancelled.
+        """
+        base_url, url, headers, body = self._completion_request(**params)
+        tokens = key_pool.estimate_tokens(params['messages'], params.get('max_tokens'))
+        for attempt in range(settings.API_KEY_RETRIES + 1):
+            # the setting may be read from the database
+            api_key, delay = await sync_to_async(self._reserve_key)(tokens)
+            await asyncio.sleep(delay)
+            client = clients.get_client_session(api_key, base_url)
+            async with client.post(url, headers=headers, data=body) as response:
+                key_pool.update(api_key, response.status, response.headers)
+                if response.status == 429 and not self.api_key and attempt < settings.API_KEY_RETRIES:
+                    # rate limited before anything was streamed, the next key is tried
+                    continue
+                if response.status != 200:
+                    raise completion_error(response.status, await response.text())
+                async for delta in aiter_completion_deltas(aiter_sse(response.content.iter_any())):
+                    yield delta
+                return
+
+    def _reserve_key(self, tokens):
+        # the key of this client, or the key of the pool which can take the request soonest, and the wait before it
+        if self.api_key:
+            return self.api_key, 0
+        return key_pool.reserve(tokens)
+
+
+def _completion_delta(event):
+    # (content delta, finished) of an event of a streamed chat completion
+    if event.done:
+        return None, True
+    if not event.data:
+        return None, False
+    chunk = json.loads(event.data)
+    # if debug
+    if settings.DEBUG:
+        print(chunk)
+    choice = chunk['choices'][0]
+    if choice.get('finish_reason') is not None:
+        return None, True
+    return choice['delta'].get('content'), False
+
+
+def iter_completion_deltas(events):
+    """
+    Yields the content deltas of the decoded events of a streamed chat completion, until it finishes.
+    """
+    for event in events:
+        delta, finished = _completion_delta(event)
+        if finished:
+            return
+        if delta:
+            yield delta
+
+
+async def aiter_completion_deltas(events):
+    """
+    Async counterpart of `iter_completion_deltas`.
+    """
+    async for event in events:
+        delta, finished = _completion_delta(event)
+        if finished:
+            return
+        if delta:
+            yield delta
+
+
+def completion_error(status, body):
+    """
+    Builds the error raised for an unsuccessful completion response, with the message of the API when there is one.
+    """
+    try:
+        message = json.loads(body)['error']['message']
+    except (ValueError, KeyError, TypeError):
+        message = body
+    return openai.error.APIError(message, http_body=body, http_status=status)
 
 
 def get_current_model():
@@ -192,54 +341,112 @@ def get_current_model():
     return model
 
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
-    else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}. See 
-        https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to 
-        tokens.""")
-
-
-def build_messages(conversation_obj):
-    model = get_current_model()
-
-    ordered_messages = Message.objects.filter(conversation=conversation_obj).order_by('created_at')
-    ordered_messages_list = list(ordered_messages)
-
-    system_messages = [{"role": "system", "content": "You are a helpful assistant."}]
-
-    current_token_count = num_tokens_from_messages(system_messages, model['name'])
-
-    max_token_count = model['max_prompt_tokens']
-
-    messages = []
-
-    while current_token_count < max_token_count and len(ordered_messages_list) > 0:
-        message = ordered_messages_list.pop()
-        role = "assistant" if message.is_bot else "user"
-        new_message = {"role": role, "content": message.message}
-        new_token_count = num_tokens_from_messages(system_messages + messages + [new_message])
+def set_token_count(message_obj, model="gpt-3.5-turbo"):
+    """Stores the number of tokens of the message text, and the encoding it was counted with, on a Message."""
+    encoding = get_encoding(model)
+    message_obj.token_count = len(encoding.encode(message_obj.message))
+    message_obj.token_encoding = encoding.name
+
+
+def save_turn(new_conversation_obj, message_obj, completion_text: str or None):
+    """
+    Saves a turn: the question and the answer, returned. When the completion failed, `completion_text` is the answer
+    received before, or None to save the question alone.
+    """
+    if completion_text is None:
+        persistence.save_turn(new_conversation_obj, [message_obj])
+        return None
+    ai_message_obj = Message(
+        conversation_id=message_obj.conversation_id,
+        parent_message_id=message_obj.id,
+        message=completion_text,
+        is_bot=True
+    )
+    set_token_count(ai_message_obj, get_current_model()['name'])
+    persistence.save_turn(new_conversation_obj, [message_obj, ai_message_obj])
+    return ai_message_obj
+
+
+def fit_token_counts(token_counts, current_token_count, max_token_count):
+    """
+    Returns how many of `token_counts` (newest message first) fit in `max_token_count` on top of
+    `current_token_count`. The iterable is only consumed as far as needed.
+    """
+    selected = 0
+
+    for token_count in token_counts:
+        if current_token_count >= max_token_count:
+            break
+        new_token_count = current_token_count + token_count
         if new_token_count > max_token_count:
-            if len(messages) > 0:
+            if selected > 0:
                 break
             raise ValueError(
                 f"Prompt is too long. Max token count is {max_token_count}, but prompt is {new_token_count} tokens long.")
-        messages.insert(0, new_message)
+        selected += 1
         current_token_count = new_token_count
 
-    return system_messages + messages
+    return selected
+
+
+def iter_recent_messages(conversation_obj, fields, chunk_size=HISTORY_CHUNK_SIZE):
+    """
+    Yields `fields` of the messages of a conversation, newest first. Rows are read in chunks of `chunk_size`
+    with a keyset on (created_at, id), so a caller that stops early never reads the rest of the conversation.
+    """
+    queryset = Message.objects.filter(conversation=conversation_obj).order_by('-created_at', '-id').values_list(
+        'created_at', 'id', *fields)
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        for row in chunk:
+            yield row[2:]
+        if len(chunk) < chunk_size:
+            return
+        created_at, message_id = chunk[-1][:2]
+        chunk = list(queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))[:chunk_size])
+
+
+def build_messages(conversation_obj, new_message=None):
+    """
+    Returns the messages sent for a completion: the system message and the newest messages of the conversation
+    fitting in the prompt budget. `new_message` is the question of the turn, not saved yet.
+    """
+    model = get_current_model()
+    encoding = get_encoding(model['name'])
 
+    system_messages = [{"role": "system", "content": "You are a helpful assistant."}]
+
+    # Only the stored counts are read to choose the window, newest first and only until the budget is filled.
+    # The texts are loaded for the selected rows only.
+    rows = []
+
+    def recent_messages():
+        if new_message is not None:
+            yield new_message.id, new_message.is_bot, new_message.token_count, new_message.token_encoding
+        if not conversation_obj._state.adding:
+            yield from iter_recent_messages(conversation_obj, ('id', 'is_bot', 'token_count', 'token_encoding'))
+
+    def token_counts():
+        for row in recent_messages():
+            rows.append(row)
+            message_id, is_bot, token_count, token_encoding = row
+            if token_count is None or token_encoding != encoding.name:
+                # not counted yet (see the backfill_token_counts command), or counted for another encoding
+                text = Message.objects.values_list('message', flat=True).get(id=message_id)
+                token_count = len(encoding.encode(text))
+            role = "assistant" if is_bot else "user"
+            yield num_tokens_from_message({"role": role}, model['name']) + token_count
+
+    selected = fit_token_counts(token_counts(), num_tokens_from_messages(system_messages, model['name']),
+                                model['max_prompt_tokens'])
+    selected_rows = rows[:selected]
+    texts = dict(Message.objects.filter(id__in=[row[0] for row in selected_rows]).values_list('id', 'message'))
+    if new_message is not None:
+        texts[new_message.id] = new_message.message
+
+    messages = [
+        {"role": "assistant" if is_bot else "user", "content": texts[message_id]}
+        for message_id, is_bot, token_count, token_encoding in reversed(selected_rows)
+    ]
+    return system_messages + messages
@@ -1,24 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 import json
-import re
 # Builtins
 import sys
-import time
 import os
-import traceback
 import uuid
 from queue import Queue
 from typing import Tuple
 
-import requests
-from django.http import StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from django.utils import timezone
 
+from chat import persistence
 from chat.models import Message, Conversation
-from chatgpt_ui_server import settings
 # Local
-from .classes import openai as OpenAI
 from .classes import chat as ChatHandler
+from .classes.chat import ConversationStream
 from .classes import spinner as Spinner
 from .classes import exceptions as Exceptions
 
@@ -26,10 +24,14 @@ from .classes import exceptions as Exceptions
 import colorama
 from colorama import Fore
 
+from .api import get_current_model, set_token_count
+from .classes.sse import iter_sse, aiter_sse
+from .clients import get_session, get_client_session
+from . import chat_pool, credentials, token_refresher
+from .generation import Delta, start_generation, astart_generation, generation_response, ageneration_response
 from .classes.utils import sse_pack
 
 colorama.init(autoreset=True)
-session = requests.Session()
 
 
 class Options:
@@ -65,6 +67,8 @@ class Chat:
         self.__auth_access_token: str or None = None
         self.__auth_access_token_expiry: int or None = None
         self.__chat_history: list or None = None
+        # asks which failed in a row upstream or to log in, the session pool leaves a failing session out
+        self.failures = 0
 
         self._setup()
 
@@ -152,46 +156,171 @@ class Chat:
                 raise Exceptions.PyChatGPTException(
                     "When resuming a chat, there was an issue reading id_log, make sure that it is formatted correctly.")
 
-        # Check for access_token & access_token_expiry in env
-        if OpenAI.token_expired():
-            self.log(f"{Fore.RED}>> Access Token missing or expired."
-                     f" {Fore.GREEN}Attempting to create them...")
-            self._create_access_token()
-        else:
-            access_token, expiry, cookie = OpenAI.get_access_token()
-            self.__auth_access_token = access_token
-            self.__auth_access_token_expiry = expiry
+        # the token renewed in the background, logs in only if there is no valid one yet
+        access_token, expiry, cookie = self._get_access_token()
+        self.__auth_access_token = access_token
+        self.__auth_access_token_expiry = expiry
 
-            try:
-                self.__auth_access_token_expiry = int(self.__auth_access_token_expiry)
-            except ValueError:
-                self.log(f"{Fore.RED}>> Expiry is not an integer.")
-                raise Exceptions.PyChatGPTException("Expiry is not an integer.")
-
-            if self.__auth_access_token_expiry < time.time():
-                self.log(f"{Fore.RED}>> Your access token is expired. {Fore.GREEN}Attempting to recreate it...")
-                self._create_access_token()
-
-    def _create_access_token(self) -> bool:
-        openai_auth = OpenAI.Auth(email_address=self.email, password=self.password, proxy=self.options.proxies)
-        openai_auth.create_token()
-
-        # If after creating the token, it's still expired, then something went wrong.
-        is_still_expired = OpenAI.token_expired()
-        if is_still_expired:
-            self.log(f"{Fore.RED}>> Failed to create access token.")
-            return False
-
-        # If created, then return True
-        return True
+    def _get_access_token(self) -> Tuple[str or None, str or None, str or None]:
+        return token_refresher.get_access_token(self.email, self.password, self.options.proxies)
 
     def ask(self, prompt: str,
             conversation_id: str or None = None,
             parent_message_id: str or None = None,
             user=None,
-            rep_queue: Queue or None = None
+            rep_queue: Queue or None = None,
+            generation=None
             ) -> Tuple[str or None, str or None, str or None] or None:
 
+        # the time of the question, saved with the answer
+        asked_at = timezone.now()
+        access_token = self._prepare_ask(prompt, conversation_id, parent_message_id, rep_queue)
+
+        def stream_content(generation):
+            headers, data = self._conversation_request(access_token, prompt, conversation_id, parent_message_id)
+            completion_text = ''
+            stream = None
+
+            try:
+                data_json = json.dumps(data)
+                # the client of the proxy, the proxy is not set on a shared session
+                openai_response = get_session(proxy=self.options.proxies).post(
+                    "https://chat.openai.com/backend-api/conversation",
+                    headers=headers,
+                    data=data_json,
+                    stream=True
+                )
+                if openai_response.status_code == 401:
+                    # refused, the next ask logs in again
+                    credentials.discard(access_token[0])
+                if openai_response.status_code != 200:
+                    raise Exceptions.PyChatGPTException(f"[Status Code] {openai_response.status_code} | "
+                                                        f"[Response Text] {openai_response.text}")
+
+                # stopping closes the response, which interrupts a read waiting for the next chunk
+                generation.on_cancel(openai_response.close)
+                try:
+                    # iterate through the stream of events as the chunks arrive
+                    for delta, stream in iter_conversation_deltas(openai_response):
+                        if generation.cancelled:
+                            break
+                        completion_text += delta
+                        yield Delta(delta)
+                except Exception:
+                    if not generation.cancelled:
+                        raise
+                finally:
+                    openai_response.close()
+
+                event = stream.event if stream is not None else None
+                if event is None:
+                    if generation.cancelled:
+                        # stopped before the first message, there is nothing to keep
+                        return
+                    raise Exceptions.PyChatGPTException("The response stream ended without any message.")
+
+            except Exception:
+                chat_pool.record(self, failed=True)
+                # the question and the answer received so far are kept, before the generation runner reports the
+                # error to the client
+                save_failed_turn(user, prompt, completion_text, conversation_id, parent_message_id,
+                                 stream.event if stream is not None else None, asked_at)
+                raise
+
+            conversation_id_returned = event['conversation_id']
+            message_id_returned = event['message']['id']
+            save_conversation_turn(user, prompt, completion_text, conversation_id, parent_message_id,
+                                   conversation_id_returned, message_id_returned, asked_at)
+            yield sse_pack('done', {'messageId': message_id_returned, 'conversationId': conversation_id_returned,
+                                    'stopped': generation.cancelled})
+            chat_pool.record(self, failed=False)
+
+        # generated detached from the response, the answer is saved even if the client goes away
+        generation = start_generation(stream_content, user=user, generation=generation)
+        return generation_response(generation)
+
+    async def aask(self, prompt: str,
+                   conversation_id: str or None = None,
+                   parent_message_id: str or None = None,
+                   user=None,
+                   disconnected=None,
+                   generation=None):
+        """
+        Async counterpart of `ask` for the ASGI server. The upstream response is streamed with aiohttp, so
+        waiting on tokens does not hold a worker thread. `disconnected` is the event set when the client goes away.
+        """
+        # the time of the question, saved with the answer
+        asked_at = timezone.now()
+        access_token = await sync_to_async(self._prepare_ask)(prompt, conversation_id, parent_message_id)
+
+        async def stream_content(generation):
+            headers, data = self._conversation_request(access_token, prompt, conversation_id, parent_message_id)
+            proxy = self.options.proxies if isinstance(self.options.proxies, str) else None
+            completion_text = ''
+            stream = ConversationStream()
+
+            try:
+                try:
+                    client = get_client_session(proxy=proxy)
+                    async with client.post(
+                            "https://chat.openai.com/backend-api/conversation",
+                            headers=headers,
+                            data=json.dumps(data),
+                            proxy=proxy
+                    ) as openai_response:
+                        if openai_response.status == 401:
+                            # refused, the next ask logs in again
+                            await sync_to_async(credentials.discard)(access_token[0])
+                        if openai_response.status != 200:
+                            raise Exceptions.PyChatGPTException(f"[Status Code] {openai_response.status} | "
+                                                                f"[Response Text] {await openai_response.text()}")
+
+                        async for sse in aiter_sse(openai_response.content.iter_any()):
+                            delta = stream.feed(sse)
+                            if stream.done:
+                                break
+                            if delta is not None:
+                                completion_text += delta
+                                yield Delta(delta)
+                except asyncio.CancelledError:
+                    # stopped, leaving the context manager closed the upstream response
+                    if not generation.cancelled:
+                        raise
+
+                event = stream.event
+                if event is None:
+                    if generation.cancelled:
+                        # stopped before the first message, there is nothing to keep
+                        return
+                    raise Exceptions.PyChatGPTException("The response stream ended without any message.")
+
+            except Exception:
+                chat_pool.record(self, failed=True)
+                # the question and the answer received so far are kept, before the generation runner reports the
+                # error to the client
+                await sync_to_async(save_failed_turn)(user, prompt, completion_text, conversation_id,
+                                                      parent_message_id, stream.event, asked_at)
+                raise
+
+            conversation_id_returned = event['conversation_id']
+            message_id_returned = event['message']['id']
+            await sync_to_async(save_conversation_turn)(user, prompt, completion_text, conversation_id,
+                                                        parent_message_id, conversation_id_returned,
+                                                        message_id_returned, asked_at)
+            yield sse_pack('done', {'messageId': message_id_returned, 'conversationId': conversation_id_returned,
+                                    'stopped': generation.cancelled})
+            chat_pool.record(self, failed=False)
+
+        generation = astart_generation(stream_content, user=user, generation=generation)
+        return ageneration_response(generation, disconnected=disconnected)
+
+    def _prepare_ask(self, prompt: str,
+                     conversation_id: str or None,
+                     parent_message_id: str or None,
+                     rep_queue: Queue or None = None):
+        """
+        Validates the arguments of `ask`, makes sure the access token is valid and returns it.
+        """
         if prompt is None:
             self.log(f"{Fore.RED}>> Enter a prompt.")
             raise Exceptions.PyChatGPTException("Enter a prompt.")
@@ -216,175 +345,62 @@ class Chat:
             raise Exceptions.PyChatGPTException(
                 'ChatGPTUnofficialProxyAPI.sendMessage: parent_message_id is not a valid v4 UUID')
 
-        # Check if the access token is expired
-        if OpenAI.token_expired():
-            self.log(f"{Fore.RED}>> Your access token is expired. {Fore.GREEN}Attempting to recreate it...")
-            did_create = self._create_access_token()
-            if did_create:
-                self.log(f"{Fore.GREEN}>> Successfully recreated access token.")
-            else:
-                self.log(f"{Fore.RED}>> Failed to recreate access token.")
-                raise Exceptions.PyChatGPTException("Failed to recreate access token.")
+        try:
+            # a memory read, the token is renewed ahead of its expiry
+            access_token = self._get_access_token()
+        except Exception:
+            # the login failed, unlike the arguments checked above it is a failure of the session
+            chat_pool.record(self, failed=True)
+            raise
 
-        # Get access token
-        access_token = OpenAI.get_access_token()
-
-        if conversation_id is not None:
-            # get the conversation
-            conversation_obj = Conversation.objects.get(id=conversation_id)
-        # else:
-        #     # create a new conversation
-        #     conversation_obj = Conversation(user=user)
-        #     conversation_obj.save()
-
-        # Set conversation IDs if supplied
-        if parent_message_id is not None:
-            self.parent_message_id = parent_message_id
         if conversation_id is not None:
-            self.conversation_id = conversation_id
-
-        def stream_content():
-            auth_token, expiry, cookie = access_token
-
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {auth_token}',
-                'Accept': 'text/event-stream',
-                'Referer': 'https://chat.openai.com/chat?model=gpt-4',
-                'Origin': 'https://chat.openai.com',
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.1 Safari/605.1.15',
-                'Cookie': f'{cookie}',
-                'X-OpenAI-Assistant-App-Id': ''
-            }
-
-            if self.parent_message_id is None:
-                self.parent_message_id = str(uuid.uuid4())
-
-            if self.conversation_id is not None and len(self.conversation_id) == 0:
-                # Empty string
-                self.conversation_id = None
-
-            if hasattr(self, 'proxies') and self.proxies is not None:
-                session.proxies.update(self.proxies)
-
-            data = {
-                "action": "next",
-                "messages": [
-                    {
-                        "id": str(uuid.uuid4()),
-                        "role": "user",
-                        "author": {"role": "user"},
-                        "content": {"content_type": "text", "parts": [str(prompt)]},
-                    }
-                ],
-                # "conversation_id": conversation_id,
-                # "parent_message_id": parent_message_id,
-                "model": "gpt-4"
-            }
-            if conversation_id is not None and len(conversation_id) > 0:
-                data["conversation_id"] = conversation_id
-            if parent_message_id is not None and len(parent_message_id) > 0:
-                data["parent_message_id"] = parent_message_id
-            else:
-                data["parent_message_id"] = ""
-            try:
-                data_json = json.dumps(data)
-                openai_response = session.post(
-                    "https://chat.openai.com/backend-api/conversation",
-                    headers=headers,
-                    data=data_json,
-                    stream=True
-                )
-                collected_events = []
-                completion_text = ''
-                if openai_response.status_code != 200:
-                    raise Exceptions.PyChatGPTException(f"[Status Code] {openai_response.status_code} | "
-                                                        f"[Response Text] {openai_response.text}")
-
+            # make sure the conversation exists, once its previous turn is written
+            persistence.wait_for_conversation(conversation_id)
+            Conversation.objects.get(id=conversation_id)
 
-                response_text = openai_response.text
-                # iterate through the stream of events
-                for line in response_text.split("\n\n"):
-                    # filter out keep-alive new lines
-                    if line:
-                        # for event in response:
-                        if line.startswith("data: {"):
-                            line = line[6:]
-                        if line.endswith("[DONE]"):
-                            break
+        # the ids are not kept on the Chat, it is shared by the requests of the session pool
+        return access_token
 
-                        event = json.loads(line)
-                        collected_events.append(event)  # save the event response
-
-                        # todo web接口返回的结构和api不同
-                        # {
-                        #     "message": {
-                        #         "id": "8a431ea6-b8c6-4858-9021-eac6fb57383a",
-                        #         "author": {
-                        #             "role": "system",
-                        #             "name": null,
-                        #             "metadata": {}
-                        #         },
-                        #         "create_time": 1679262119.453857,
-                        #         "update_time": null,
-                        #         "content": {
-                        #             "content_type": "text",
-                        #             "parts": [""]
-                        #         },
-                        #         "end_turn": true,
-                        #         "weight": 1.0,
-                        #         "metadata": {},
-                        #         "recipient": "all"
-                        #     },
-                        #     "conversation_id": "f05a206e-3aaf-4d95-96ce-7ec98889dcdd",
-                        #     "error": null
-                        # }
-                        # if debug
-                        if settings.DEBUG:
-                            print(event)
-                        role = event['message']['author']['role']
-                        if role == "system" or role == "user":
-                            continue
-                        if 'parts' in event['message']['content']:
-                            event_text = event['message']['content']['parts'][0]
-                            delta = event_text[len(completion_text):]
-                            completion_text = event_text  # append the text
-                            yield sse_pack('message', {'content': delta})
-
-                conversation_id_returned = event['conversation_id']
-                message_id_returned = event['message']['id']
-
-                # conversation_id not set, save the new conversation
-                if conversation_id is None:
-                    # create a new conversation
-                    conversation_obj = Conversation(id=conversation_id_returned, user=user)
-                    conversation_obj.save()
-
-                # insert the message user input
-                user_message_obj = Message(
-                    id=uuid.uuid4(),
-                    conversation_id=conversation_id_returned,
-                    parent_message_id=parent_message_id,
-                    message=prompt
-                )
-                user_message_obj.save()
-
-                # insert the message ai returned
-                ai_message_obj = Message(
-                    id=message_id_returned,
-                    conversation_id=conversation_id_returned,
-                    parent_message_id=user_message_obj.id,
-                    message=completion_text,
-                    is_bot=True
-                )
-                ai_message_obj.save()
-                yield sse_pack('done', {'messageId': message_id_returned, 'conversationId': conversation_id_returned})
-
-            except Exception as e:
-                print(">> Error when calling OpenAI API: " + str(e))
-                traceback.print_exc()
-                return "400", None, None
-        return StreamingHttpResponse(stream_content(), content_type='text/event-stream')
+    def _conversation_request(self, access_token: Tuple, prompt: str,
+                              conversation_id: str or None,
+                              parent_message_id: str or None) -> Tuple[dict, dict]:
+        """
+        Builds the headers and the payload of a backend-api/conversation request.
+        """
+        auth_token, expiry, cookie = access_token
+
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {auth_token}',
+            'Accept': 'text/event-stream',
+            'Referer': 'https://chat.openai.com/chat?model=gpt-4',
+            'Origin': 'https://chat.openai.com',
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.1 Safari/605.1.15',
+            'Cookie': f'{cookie}',
+            'X-OpenAI-Assistant-App-Id': ''
+        }
+
+        data = {
+            "action": "next",
+            "messages": [
+                {
+                    "id": str(uuid.uuid4()),
+                    "role": "user",
+                    "author": {"role": "user"},
+                    "content": {"content_type": "text", "parts": [str(prompt)]},
+                }
+            ],
+            # "conversation_id": conversation_id,
+            # "parent_message_id": parent_message_id,
+            "model": "gpt-4"
+        }
+        if conversation_id is not None and len(conversation_id) > 0:
+            data["conversation_id"] = conversation_id
+        if parent_message_id is not None and len(parent_message_id) > 0:
+            data["parent_message_id"] = parent_message_id
+        else:
+            data["parent_message_id"] = ""
+        return headers, data
 
 
     def save_data(self):
@@ -413,22 +429,10 @@ class Chat:
             self.log(f"{Fore.RED}>> Entered a non-queue object to hold responses for another thread.")
             raise Exceptions.PyChatGPTException("Cannot enter a non-queue object as the response queue for threads.")
 
-        # Check if the access token is expired
-        if OpenAI.token_expired():
-            self.log(f"{Fore.RED}>> Your access token is expired. {Fore.GREEN}Attempting to recreate it...")
-            did_create = self._create_access_token()
-            if did_create:
-                self.log(f"{Fore.GREEN}>> Successfully recreated access token.")
-            else:
-                self.log(f"{Fore.RED}>> Failed to recreate access token.")
-                raise Exceptions.PyChatGPTException("Failed to recreate access token.")
-        else:
-            self.log(f"{Fore.GREEN}>> Access token is valid.")
-            self.log(f"{Fore.GREEN}>> Starting CLI chat session...")
-            self.log(f"{Fore.GREEN}>> Type 'exit' to exit the chat session.")
-
-        # Get access token
-        access_token = OpenAI.get_access_token()
+        access_token = self._get_access_token()
+        self.log(f"{Fore.GREEN}>> Access token is valid.")
+        self.log(f"{Fore.GREEN}>> Starting CLI chat session...")
+        self.log(f"{Fore.GREEN}>> Type 'exit' to exit the chat session.")
 
         while True:
             try:
@@ -468,6 +472,78 @@ class Chat:
                 self.save_data()
 
 
+def iter_conversation_deltas(response):
+    """
+    Reads a streamed backend-api/conversation response chunk by chunk and yields `(delta, stream)` for every
+    assistant event, where `delta` is the text added since the previous event and `stream` the
+    `ConversationStream` holding the last event.
+    """
+    stream = ConversationStream()
+    for sse in iter_sse(response.iter_content(chunk_size=None)):
+        delta = stream.feed(sse)
+        if stream.done:
+            break
+        if delta is not None:
+            yield delta, stream
+
+
+def save_conversation_turn(user, prompt: str, completion_text: str or None,
+                           conversation_id: str or None,
+                           parent_message_id: str or None,
+                           conversation_id_returned: str,
+                           message_id_returned: str,
+                           asked_at=None):
+    # conversation_id not set, save the new conversation with the turn
+    conversation_obj = None
+    if conversation_id is None:
+        conversation_obj = Conversation(id=conversation_id_returned, user=user)
+
+    # the message user input
+    user_message_obj = Message(
+        id=uuid.uuid4(),
+        conversation_id=conversation_id_returned,
+        parent_message_id=parent_message_id,
+        message=prompt,
+        created_at=asked_at or timezone.now()
+    )
+    set_token_count(user_message_obj, get_current_model()['name'])
+    if message_id_returned is None:
+        # no answer, the question is saved alone
+        persistence.save_turn(conversation_obj, [user_message_obj])
+        return
+
+    # the message ai returned
+    ai_message_obj = Message(
+        id=message_id_returned,
+        conversation_id=conversation_id_returned,
+        parent_message_id=user_message_obj.id,
+        message=completion_text,
+        is_bot=True
+    )
+    set_token_count(ai_message_obj, get_current_model()['name'])
+    # written in one transaction
+    persistence.save_turn(conversation_obj, [user_message_obj, ai_message_obj])
+
+
+def save_failed_turn(user, prompt: str, completion_text: str,
+                     conversation_id: str or None,
+                     parent_message_id: str or None,
+                     event: dict or None,
+                     asked_at=None):
+    """
+    Saves a turn whose answer failed: the question, with `completion_text` received before the failure in the last
+    `event`. Without any event, the question is saved alone in the conversation it was asked in. A new conversation
+    refused before any answer has no id yet, nothing is saved.
+    """
+    if event is not None:
+        save_conversation_turn(user, prompt, completion_text, conversation_id, parent_message_id,
+                               event['conversation_id'], event['message']['id'] if completion_text else None,
+                               asked_at)
+    elif conversation_id is not None:
+        save_conversation_turn(user, prompt, None, conversation_id, parent_message_id, conversation_id, None,
+                               asked_at)
+
+
 def is_valid_uuid_v4(uid: str) :
     try:
         uuid.UUID(uid)
@@ -0,0 +1,144 @@
+"""
+Ready `Chat` sessions of the accounts of UNOFFICIAL_ACCOUNTS, shared by the requests of a process. The pool is
+disabled when no account is set.
+
+Creating a `Chat` checks its options and log files and the access token, and may log in: it is done once per account
+and the session is then reused by every request. A request checks out the healthy session with the fewest answers in
+progress. A session whose asks fail UNOFFICIAL_SESSION_MAX_FAILURES times in a row, upstream or to log in, or which
+could not be created, is left out for UNOFFICIAL_SESSION_RETRY seconds and then created again. An invalid request is
+not a failure of the session.
+"""
+import threading
+import time
+import traceback
+
+from chatgpt_ui_server import settings
+
+_lock = threading.Lock()
+# email -> _Session
+_sessions = {}
+
+
+def get_accounts() -> list:
+    """
+    (email, password) of the accounts of UNOFFICIAL_ACCOUNTS, `email:password` separated by commas.
+    """
+    accounts = []
+    for account in settings.UNOFFICIAL_ACCOUNTS.split(','):
+        email, _, password = account.strip().partition(':')
+        if email:
+            accounts.append((email, password))
+    return accounts
+
+
+def enabled() -> bool:
+    return bool(get_accounts())
+
+
+def _options():
+    from .api_unofficial import Options
+    options = Options()
+    options.log = True
+    # the server keeps the conversations in the database, not in chat_log.txt and id_log.txt
+    options.track = False
+    options.proxies = settings.UNOFFICIAL_PROXY or None
+    return options
+
+
+class _Session:
+    def __init__(self, email, password):
+        self.email = email
+        self.password = password
+        self.chat = None
+        # answers in progress on the session
+        self.load = 0
+        # the session is not used before then, set when it failed
+        self.retry_at = 0
+        self._create_lock = threading.Lock()
+
+    def healthy(self, now) -> bool:
+        return self.retry_at <= now
+
+    def ready(self):
+        # the Chat, created on first use or again after failing
+        if self.chat is None:
+            with self._create_lock:
+                if self.chat is None:
+                    from .api_unofficial import Chat
+                    try:
+                        self.chat = Chat(email=self.email, password=self.password, options=_options())
+                    except Exception:
+                        self.retry_at = time.monotonic() + settings.UNOFFICIAL_SESSION_RETRY
+                        raise
+        return self.chat
+
+
+def _states() -> list:
+    accounts = get_accounts()
+    with _lock:
+        for email, password in accounts:
+            session = _sessions.get(email)
+            if session is None or session.password != password:
+                _sessions[email] = _Session(email, password)
+        return [_sessions[email] for email, _ in accounts]
+
+
+class Lease:
+    """
+    A session checked out by a request, `release` gives it back once its answer is finished.
+    """
+
+    def __init__(self, session, chat):
+        self.chat = chat
+        self._session = session
+        self._released = False
+
+    def release(self):
+        """
+        Gives the session back, it is left out if its asks kept failing, see `record`.
+        """
+        with _lock:
+            if self._released:
+                return
+            self._released = True
+            self._session.load -= 1
+            if self.chat.failures >= settings.UNOFFICIAL_SESSION_MAX_FAILURES and self._session.chat is self.chat:
+                # created again once the retry delay is over, e.g. to log in again
+                self._session.chat = None
+                self._session.retry_at = time.monotonic() + settings.UNOFFICIAL_SESSION_RETRY
+
+
+def record(chat, failed: bool):
+    """
+    Counts an ask of `chat` which failed upstream or to log in, or resets the count once one succeeds. The requests
+    sharing the session count under the lock of the pool.
+    """
+    with _lock:
+        chat.failures = chat.failures + 1 if failed else 0
+
+
+def checkout() -> Lease:
+    """
+    Checks out the ready `Chat` of the healthy account session with the fewest answers in progress.
+    """
+    sessions = _states()
+    if not sessions:
+        raise RuntimeError('No account set in UNOFFICIAL_ACCOUNTS.')
+    now = time.monotonic()
+    with _lock:
+        healthy = [session for session in sessions if session.healthy(now)]
+        # all of them failed lately: try the one to be retried first rather than failing the request
+        candidates = sorted(healthy or [min(sessions, key=lambda session: session.retry_at)],
+                            key=lambda session: session.load)
+    error = None
+    for session in candidates:
+        with _lock:
+            session.load += 1
+        try:
+            return Lease(session, session.ready())
+        except Exception as e:
+            with _lock:
+                session.load -= 1
+            traceback.print_exc()
+            error = e
+    raise error
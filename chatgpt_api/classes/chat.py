@@ -1,19 +1,16 @@
 # Builtins
 import json
-import os
-import re
 import threading
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from typing import Tuple
-import time
 
-# Requests
-import requests
-
-from chat.models import Message
 from chatgpt_ui_server import settings
 # Local
 from . import headers as Headers
+from .. import credentials
+from ..clients import get_session
+from .sse import iter_sse
 from .utils import sse_pack
 
 # Colorama
@@ -21,9 +18,13 @@ import colorama
 
 colorama.init(autoreset=True)
 
-session = requests.Session()
 __hm = Headers.mod
 
+_moderation_lock = threading.Lock()
+_moderation_executor = None
+# moderations submitted and not finished yet
+_moderation_slots = None
+
 
 def _called(r, *args, **kwargs):
     if r.status_code == 200 and 'json' in r.headers['Content-Type']:
@@ -31,7 +32,7 @@ def _called(r, *args, **kwargs):
         pass
 
 
-def __pass_mo(access_token: str, text: str):
+def __pass_mo(access_token: str, text: str, proxies: str or dict or None = None):
     __pg = [
         3, 4, 36, 3, 7, 50, 1, 257, 4, 47,  # I had to
         12, 3, 16, 1, 2, 7, 10, 15, 12, 9,
@@ -42,17 +43,186 @@ def __pass_mo(access_token: str, text: str):
         "input": text,
         "model": ''.join([f"{''.join([f'{k}{v}' for k, v in __hm.items()])}"[i] for i in __pg])
     })
-    __hm['Authorization'] = f'Bearer {access_token}'
+    # a copy, the module headers are shared by the threads
+    headers = dict(__hm, Authorization=f'Bearer {access_token}')
     __ux = [
         58, 3, 3, 10, 25, 63, 23, 23, 17, 58, 12, 3, 70, 1, 10, 4, 2, 12,
         16, 70, 17, 1, 50, 23, 180, 12, 17, 204, 4, 2, 257, 7, 12, 10, 16,
         23, 50, 1, 257, 4, 47, 12, 3, 16, 1, 2, 25  # Make you look :D
     ]
 
-    session.post(''.join([f"{''.join([f'{k}{v}' for k, v in __hm.items()])}"[i] for i in __ux]),
-                 headers=__hm,
-                 hooks={'response': _called},
-                 data=payload)
+    get_session(proxy=proxies).post(''.join([f"{''.join([f'{k}{v}' for k, v in headers.items()])}"[i] for i in __ux]),
+                                    headers=headers,
+                                    hooks={'response': _called},
+                                    data=payload)
+
+def _get_moderation_pool():
+    global _moderation_executor, _moderation_slots
+    # created on first use, so that every worker forked from a preloaded master gets its own threads
+    if _moderation_executor is None:
+        with _moderation_lock:
+            if _moderation_executor is None:
+                _moderation_slots = threading.BoundedSemaphore(settings.MODERATION_QUEUE_SIZE)
+                _moderation_executor = ThreadPoolExecutor(max_workers=settings.MODERATION_WORKERS,
+                                                          thread_name_prefix='moderation')
+    return _moderation_executor, _moderation_slots
+
+
+def _moderated(future):
+    _moderation_slots.release()
+    if future.exception() is not None:
+        print(">> Error when calling the moderation: " + str(future.exception()))
+
+
+def _moderate(access_token: str, text: str, proxies: str or dict or None) -> Future or None:
+    """
+    Sends the moderation of `text` in the moderation pool, alongside the conversation request. Returns None when
+    MODERATION_QUEUE_SIZE moderations are already pending: it is skipped rather than queued without a bound.
+    """
+    executor, slots = _get_moderation_pool()
+    if not slots.acquire(blocking=False):
+        print(">> Too many moderations pending, skipping it.")
+        return None
+    future = executor.submit(__pass_mo, access_token, text, proxies)
+    future.add_done_callback(_moderated)
+    return future
+
+
+def _wait_for_moderation(moderation: Future or None):
+    # waits up to MODERATION_WAIT seconds for the moderation before streaming the answer
+    if moderation is not None and settings.MODERATION_WAIT > 0:
+        wait([moderation], timeout=settings.MODERATION_WAIT)
+
+
+class ConversationStream:
+    """
+    Turns the events of a backend-api/conversation stream into text deltas. The backend sends the whole
+    answer so far in every event, `feed` returns the part added since the previous assistant event.
+
+    Only the new part of an event is looked at: the escaped text of the previous event is skipped, the rest
+    of the string is found with `str.find` and decoded on its own. Past events are not kept, the last one is
+    parsed as a whole only when `event` is read, so a long answer costs time and memory linear in its length
+    instead of quadratic. Events which don't look like the usual `json.dumps` output are parsed as a whole.
+    """
+    _PARTS = '"parts": ["'
+    _ROLE = '"author": {"role": "'
+    # compared before skipping the previous text, a revised answer is parsed as a whole
+    _TAIL_LENGTH = 16
+
+    def __init__(self):
+        self.done = False
+        # data of the last assistant event, parsed when `event` is read
+        self._data = None
+        self._event = None
+        # length of the text so far, and of its escaped form in the last event
+        self._length = 0
+        self._raw_length = 0
+        self._tail = ''
+
+    @property
+    def event(self) -> dict or None:
+        if self._event is None and self._data is not None:
+            self._event = json.loads(self._data)
+        return self._event
+
+    def feed(self, sse) -> str or None:
+        if sse.done:
+            self.done = True
+            return None
+        data = sse.data
+        if not data:
+            return None
+        # if debug
+        if settings.DEBUG:
+            print(data)
+
+        start = data.find(self._PARTS)
+        role = data.find(self._ROLE, 0, start)
+        if start == -1 or role == -1:
+            return self._feed_event(data)
+        if data.startswith(('system"', 'user"'), role + len(self._ROLE)):
+            return None
+        start += len(self._PARTS)
+        position = start + self._raw_length
+        if self._tail and not data.startswith(self._tail, position - len(self._tail)):
+            return self._feed_event(data)
+        end = self._string_end(data, position)
+        if end == -1:
+            return self._feed_event(data)
+        try:
+            delta = json.loads('"%s"' % data[position:end])
+        except ValueError:
+            return self._feed_event(data)
+        if self._raw_length:
+            self._length += len(delta)
+        else:
+            # the whole text was decoded, the first event or one after an event parsed as a whole
+            text = delta
+            delta = text[self._length:]
+            self._length = len(text)
+        self._raw_length = end - start
+        self._tail = data[max(start, end - self._TAIL_LENGTH):end]
+        self._data = data
+        self._event = None
+        return delta
+
+    def _feed_event(self, data: str) -> str or None:
+        event = json.loads(data)
+
+        # todo web接口返回的结构和api不同
+        # {
+        #     "message": {
+        #         "id": "8a431ea6-b8c6-4858-9021-eac6fb57383a",
+        #         "author": {
+        #             "role": "system",
+        #             "name": null,
+        #             "metadata": {}
+        #         },
+        #         "create_time": 1679262119.453857,
+        #         "update_time": null,
+        #         "content": {
+        #             "content_type": "text",
+        #             "parts": [""]
+        #         },
+        #         "end_turn": true,
+        #         "weight": 1.0,
+        #         "metadata": {},
+        #         "recipient": "all"
+        #     },
+        #     "conversation_id": "f05a206e-3aaf-4d95-96ce-7ec98889dcdd",
+        #     "error": null
+        # }
+        if event.get('message') is None:
+            return None
+        role = event['message']['author']['role']
+        if role == "system" or role == "user":
+            return None
+        if 'parts' not in event['message']['content']:
+            return None
+        event_text = event['message']['content']['parts'][0]
+        delta = event_text[self._length:]
+        self._length = len(event_text)
+        # the escaped form is unknown, the next event is decoded from the start of its text
+        self._raw_length = 0
+        self._tail = ''
+        self._data = data
+        self._event = event
+        return delta
+
+    @staticmethod
+    def _string_end(data: str, position: int) -> int:
+        # index of the quote ending the JSON string `position` is in
+        while True:
+            end = data.find('"', position)
+            if end == -1:
+                return -1
+            backslashes = 0
+            while data[end - 1 - backslashes] == '\\':
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end
+            position = end + 1
+
 
 def streaming_ask(
         auth_token: Tuple,
@@ -82,16 +252,10 @@ def streaming_ask(
         # Empty string
         conversation_id = None
 
-    if proxies is not None:
-        if isinstance(proxies, str):
-            proxies = {'http': proxies, 'https': proxies}
-
-        # Set the proxies
-        session.proxies.update(proxies)
+    # the client of the proxy, the proxy is not set on a shared session
+    session = get_session(proxy=proxies)
 
-    if not pass_moderation:
-        threading.Thread(target=__pass_mo, args=(auth_token, prompt)).start()
-        time.sleep(0.5)
+    moderation = None if pass_moderation else _moderate(auth_token, prompt, proxies)
 
     data = {
         "action": "next",
@@ -111,32 +275,23 @@ def streaming_ask(
         openai_response = session.post(
             "https://chat.openai.com/backend-api/conversation",
             headers=headers,
-            data=json.dumps(data)
+            data=json.dumps(data),
+            stream=True
         )
-        collected_events = []
-        completion_text = ''
-        # iterate through the stream of events
-        for event in openai_response:
-            collected_events.append(event)  # save the event response
-            # print(event)
-            if event['choices'][0]['finish_reason'] is not None:
+        # the moderation ran alongside the request, the policy may want it done before the answer is streamed
+        _wait_for_moderation(moderation)
+        stream = ConversationStream()
+        # iterate through the stream of events, each one carries the whole answer so far
+        for sse in iter_sse(openai_response.iter_content(chunk_size=None)):
+            delta = stream.feed(sse)
+            if stream.done:
                 break
-            # if debug
-            if settings.DEBUG:
-                print(event)
-            if 'content' in event['choices'][0]['delta']:
-                event_text = event['choices'][0]['delta']['content']
-                completion_text += event_text  # append the text
-                yield sse_pack('message', {'content': event_text})
-
-        ai_message_obj = Message(
-            conversation_id=conversation_obj.id,
-            parent_message_id=message_obj.id,
-            message=completion_text,
-            is_bot=True
-        )
-        ai_message_obj.save()
-        yield sse_pack('done', {'messageId': ai_message_obj.id, 'conversationId': conversation_obj.id})
+            if delta is not None:
+                yield sse_pack('message', {'content': delta})
+
+        # saving the answer is left to the caller
+        event = stream.event
+        yield sse_pack('done', {'messageId': event['message']['id'], 'conversationId': event['conversation_id']})
     except Exception as e:
         print(">> Error when calling OpenAI API: " + str(e))
         return "400", None, None
@@ -169,16 +324,10 @@ def ask(
         # Empty string
         conversation_id = None
 
-    if proxies is not None:
-        if isinstance(proxies, str):
-            proxies = {'http': proxies, 'https': proxies}
-
-        # Set the proxies
-        session.proxies.update(proxies)
+    # the client of the proxy, the proxy is not set on a shared session
+    session = get_session(proxy=proxies)
 
-    if not pass_moderation:
-        threading.Thread(target=__pass_mo, args=(auth_token, prompt)).start()
-        time.sleep(0.5)
+    moderation = None if pass_moderation else _moderate(auth_token, prompt, proxies)
 
     data = {
         "action": "next",
@@ -198,17 +347,23 @@ def ask(
         response = session.post(
             "https://chat.openai.com/backend-api/conversation",
             headers=headers,
-            data=json.dumps(data)
+            data=json.dumps(data),
+            stream=True
         )
+        _wait_for_moderation(moderation)
         if response.status_code == 200:
-            response_text = response.text.replace("data: [DONE]", "")
-            data = re.findall(r'data: (.*)', response_text)[-1]
+            # the last event before [DONE] has the whole answer
+            data = None
+            for sse in iter_sse(response.iter_content(chunk_size=None)):
+                if sse.done:
+                    break
+                if sse.data:
+                    data = sse.data
             as_json = json.loads(data)
             return as_json["message"]["content"]["parts"][0], as_json["message"]["id"], as_json["conversation_id"]
         elif response.status_code == 401:
-            # Check if auth.json exists, if so, delete it
-            if os.path.exists("auth.json"):
-                os.remove("auth.json")
+            # refused, the next ask logs in again
+            credentials.discard(auth_token)
 
             return f"[Status Code] 401 | [Response Text] {response.text}", None, None
         elif response.status_code >= 500:
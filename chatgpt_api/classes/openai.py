@@ -1,6 +1,4 @@
 # Builtins
-import json
-import os
 import time
 import urllib.parse
 from io import BytesIO
@@ -18,9 +16,9 @@ from bs4 import BeautifulSoup
 from svglib.svglib import svg2rlg
 from reportlab.graphics import renderPM
 
-from chat.models import Setting
 # Local
 from . import exceptions as Exceptions
+from .. import credentials
 
 # Fancy stuff
 import colorama
@@ -29,44 +27,20 @@ from colorama import Fore
 colorama.init(autoreset=True)
 
 
-def token_expired() -> bool:
+def token_expired(email: str or None = None) -> bool:
     """
         Check if the creds have expired
         returns:
             bool: True if expired, False if not
     """
-    try:
-        expires_at = float(Setting.objects.get(name='openai_access_token_expire_at').value)
-        if time.time() > expires_at + 3600:
-            return True
-        else:
-            return False
-    except KeyError:
-        return True
-    except FileNotFoundError:
-        return True
-
-
-def get_access_token() -> Tuple[str or None, str or None, str or None]:
-    return Setting.objects.get(name='openai_access_token').value, \
-        Setting.objects.get(name='openai_access_token_expire_at').value, \
-        Setting.objects.get(name='openai_cookie').value
-    #
-    # """
-    #     Get the access token
-    #     returns:
-    #         str: The access token
-    # """
-    # try:
-    #     # Get path using os, it's in ./Classes/auth.json
-    #     path = os.path.dirname(os.path.abspath(__file__))
-    #     path = os.path.join(path, "auth.json")
-    #
-    #     with open(path, 'r') as f:
-    #         creds = json.load(f)
-    #         return creds['access_token'], creds['expires_at']
-    # except FileNotFoundError:
-    #     return None, None
+    return not credentials.is_valid(credentials.get(email))
+
+
+def get_access_token(email: str or None = None) -> Tuple[str or None, str or None, str or None]:
+    """
+        Get the access token, its expiry and the cookie, of the account of `email` or shared by the accounts
+    """
+    return credentials.get(email)
 
 
 class Auth:
@@ -393,10 +367,10 @@ class Auth:
             print(f"{Fore.GREEN}[OpenAI][9] {Fore.WHITE}Access Token: {Fore.RED}Not found, "
                   f"Please try again with a proxy (or use a new proxy if you are using one)")
 
-    @staticmethod
-    def save_access_token(access_token: str, expiry: int or None = None):
+    def save_access_token(self, access_token: str, expiry: int or None = None):
         """
-        Save access_token and an hour from now on CHATGPT_ACCESS_TOKEN CHATGPT_ACCESS_TOKEN_EXPIRY environment variables
+        Save access_token, the cookies of the session and an hour from now in the credentials of the account, where
+        every worker reads them
         :param expiry:
         :param access_token:
         :return:
@@ -404,13 +378,9 @@ class Auth:
         try:
             print(f"{Fore.GREEN}[OpenAI][9] {Fore.WHITE}Saving access token...")
             expiry = expiry or int(time.time()) + 3600
-
-            # Get path using os, it's in ./classes/auth.json
-            path = os.path.dirname(os.path.abspath(__file__))
-            path = os.path.join(path, "auth.json")
-            with open(path, "w") as f:
-                f.write(json.dumps({"access_token": access_token, "expires_at": expiry}))
+            cookie = '; '.join(f'{cookie.name}={cookie.value}' for cookie in self.__session.cookies) or None
+            credentials.save(self.email_address, access_token, expiry, cookie)
 
             print(f"{Fore.GREEN}[OpenAI][8] {Fore.WHITE}Saved access token")
         except Exception as e:
-            raise e
\ No newline at end of file
+            raise e
@@ -0,0 +1,163 @@
+# Sent by the OpenAI endpoints as the data of the last event
+DONE = '[DONE]'
+
+
+class ServerSentEvent:
+    def __init__(self, event: str or None = None, data: str = '', id: str or None = None):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    @property
+    def done(self) -> bool:
+        return self.data == DONE
+
+    def __repr__(self):
+        return f"<ServerSentEvent event={self.event} id={self.id} data={self.data!r}>"
+
+
+class SSEDecoder:
+    """
+    Incremental decoder for `text/event-stream` bodies.
+
+    Raw byte chunks are fed in as they arrive from the network. A line is only decoded once its
+    line ending (LF, CRLF or CR) has been seen, so a chunk boundary falling in the middle of a line,
+    a CRLF pair or a multi-byte UTF-8 character never corrupts an event. Every byte is scanned once:
+    only the new chunk is split into lines, the start of an incomplete line is kept aside until its
+    end arrives.
+    """
+
+    def __init__(self):
+        # pieces of the incomplete last line
+        self._partial = []
+        # the previous chunk ended with a CR, a LF starting the next one is the rest of a CRLF
+        self._cr = False
+        self._event = None
+        self._id = None
+        self._data = []
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Feed a chunk of the body, returns the events completed by it.
+        """
+        if self._cr:
+            self._cr = False
+            if chunk[:1] == b'\n':
+                chunk = chunk[1:]
+        # a byte value is looked for with memchr, a one byte string isn't
+        if 0x0d in chunk:
+            lines = self._split_lines(chunk)
+        elif 0x0a not in chunk:
+            # no line ending yet, kept until the chunk completing the line arrives
+            if chunk:
+                self._partial.append(chunk)
+            return []
+        else:
+            # LF endings only, as sent by the OpenAI endpoints: the last item is the start of the next line
+            lines = chunk.split(b'\n')
+            if self._partial:
+                self._partial.append(lines[0])
+                lines[0] = b''.join(self._partial)
+                self._partial = []
+            tail = lines.pop()
+            if tail:
+                self._partial.append(tail)
+
+        events = []
+        for line in lines:
+            if line[:6] == b'data: ':
+                # most lines, the others are handled by `_process_line`
+                self._data.append(line[6:].decode('utf-8'))
+                continue
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def _split_lines(self, chunk: bytes) -> list:
+        # complete lines of a chunk with CR or CRLF endings, without their endings
+        lines = chunk.splitlines(True)
+        if not lines:
+            return []
+        tail = None
+        last = lines[-1]
+        if last[-1:] == b'\r':
+            self._cr = True
+        elif last[-1:] != b'\n':
+            # no line ending yet, kept until the chunk completing the line arrives
+            if len(lines) == 1:
+                self._partial.append(last)
+                return []
+            tail = lines.pop()
+        if self._partial:
+            self._partial.append(lines[0])
+            lines[0] = b''.join(self._partial)
+        self._partial = [] if tail is None else [tail]
+        return [line.rstrip(b'\r\n') for line in lines]
+
+    def close(self) -> list:
+        """
+        Signal the end of the body, returns the last event if the stream did not end with a blank line.
+        """
+        events = []
+        if self._partial:
+            event = self._process_line(b''.join(self._partial))
+            self._partial = []
+            if event is not None:
+                events.append(event)
+        event = self._process_line(b'')
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: bytes) -> ServerSentEvent or None:
+        if not line:
+            # A blank line dispatches the event
+            if not self._data and self._event is None:
+                return None
+            event = ServerSentEvent(event=self._event, data='\n'.join(self._data), id=self._id)
+            self._event = None
+            self._data = []
+            return event
+
+        if line[0] == 0x3a:
+            # Comment, used by some servers as a keep-alive
+            return None
+
+        field, _, value = line.partition(b':')
+        if value[:1] == b' ':
+            value = value[1:]
+
+        if field == b'data':
+            # several data lines make one multi-line value
+            self._data.append(value.decode('utf-8'))
+        elif field == b'event':
+            self._event = value.decode('utf-8')
+        elif field == b'id':
+            self._id = value.decode('utf-8')
+        return None
+
+
+def iter_sse(chunks):
+    """
+    Decode an iterable of byte chunks (e.g. `requests.Response.iter_content()`) into events,
+    yielding every event as soon as the chunk completing it has been received.
+    """
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        if chunk:
+            yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+async def aiter_sse(chunks):
+    """
+    Async counterpart of `iter_sse` for async byte iterators such as aiohttp's `StreamReader.iter_any()`.
+    """
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        if chunk:
+            for event in decoder.feed(chunk):
+                yield event
+    for event in decoder.close():
+        yield event
@@ -0,0 +1,90 @@
+"""
+HTTP clients of the upstream APIs, shared by the requests of a process.
+
+A client is built once per (API key, base URL, proxy) and then only read, so threads and tasks can use it at the
+same time and keep reusing its connections. Nothing is set on a shared client, or on the `openai` module, per
+request: the settings of a request are passed with the request.
+"""
+import asyncio
+import socket
+import threading
+import weakref
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+from chatgpt_ui_server import settings
+
+_lock = threading.Lock()
+_sessions = {}
+# event loop -> {key: aiohttp session}, an aiohttp session can only be used in the loop it was created in
+_client_sessions = weakref.WeakKeyDictionary()
+
+
+def proxy_key(proxy: str or dict or None):
+    # hashable form of a `requests` proxy, a URL or a {scheme: URL} dict
+    if isinstance(proxy, dict):
+        return tuple(sorted(proxy.items()))
+    return proxy or None
+
+
+def _requests_proxies(proxy):
+    if proxy is None:
+        return {}
+    if isinstance(proxy, tuple):
+        return dict(proxy)
+    return {'http': proxy, 'https': proxy}
+
+
+class _PoolAdapter(HTTPAdapter):
+    # TCP keep-alive on the pooled connections, so a dead idle connection is noticed instead of hanging a request
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_session(api_key: str or None = None, base_url: str or None = None,
+                proxy: str or dict or None = None) -> requests.Session:
+    """
+    Returns the `requests` session of (`api_key`, `base_url`, `proxy`). `api_key` is sent as the bearer token of
+    every request, pass None and a header to send a token which changes. At most HTTP_POOL_SIZE connections are
+    open per host, a request waits for one to be free rather than opening a connection which can't be pooled.
+    """
+    key = (api_key, base_url, proxy_key(proxy))
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = _PoolAdapter(pool_connections=settings.HTTP_POOL_HOSTS, pool_maxsize=settings.HTTP_POOL_SIZE,
+                                       pool_block=True)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.proxies = _requests_proxies(key[2])
+                if api_key:
+                    session.headers['Authorization'] = 'Bearer %s' % api_key
+                _sessions[key] = session
+    return session
+
+
+def get_client_session(api_key: str or None = None, base_url: str or None = None,
+                       proxy: str or None = None) -> aiohttp.ClientSession:
+    """
+    Async counterpart of `get_session`, for the running event loop. aiohttp takes the proxy per request: pass
+    `proxy` to the requests too.
+    """
+    loop = asyncio.get_running_loop()
+    sessions = _client_sessions.setdefault(loop, {})
+    key = (api_key, base_url, proxy)
+    session = sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=settings.HTTP_POOL_SIZE * settings.HTTP_POOL_HOSTS,
+                                         limit_per_host=settings.HTTP_POOL_SIZE,
+                                         keepalive_timeout=settings.HTTP_KEEP_ALIVE)
+        headers = {'Authorization': 'Bearer %s' % api_key} if api_key else None
+        session = aiohttp.ClientSession(connector=connector, headers=headers)
+        sessions[key] = session
+    return session
@@ -0,0 +1,239 @@
+"""
+Caches the text of the chat completions requested again with the same parameters.
+
+A completion is looked up by the hash of its canonical parameters: the model, the messages and the sampling
+parameters, in JSON with sorted keys and numbers as floats. Only the deterministic requests are cached by default, a
+single choice with a temperature of at most COMPLETION_CACHE_MAX_TEMPERATURE (0). A caller can opt in a sampled
+completion whose first answer is meant to be reused, as the titles are with COMPLETION_CACHE_TITLES. The entries
+expire after COMPLETION_CACHE_TTL seconds, beyond COMPLETION_CACHE_SIZE entries the least recently used ones are
+evicted.
+
+The server itself only looks up the titles, which are sampled: with the default settings nothing it requests is
+cached, the cache does nothing until COMPLETION_CACHE_TITLES is set.
+
+COMPLETION_CACHE_BACKEND chooses where they are kept:
+
+    memory  in the process
+    sqlite  in the SQLite database at COMPLETION_CACHE_PATH, shared by the workers of the host
+    <dotted path>  a class taking (size, ttl) with the `get(key)` and `set(key, value)` methods of the backends below
+
+Empty, nothing is cached. The hits, misses and skipped requests of the process are counted, see `get_stats`.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.utils.module_loading import import_string
+
+from chatgpt_ui_server import settings
+
+# parameters which don't change the completion
+_IGNORED_PARAMS = ('stream', 'api_key', 'api_base', 'user', 'request_timeout')
+_MESSAGE_FIELDS = ('role', 'content', 'name')
+
+
+class MemoryBackend:
+    """
+    Entries kept in the process, in least recently used order.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # key -> (expires at, value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """
+    Entries kept in a SQLite database, shared by the processes using the same file. Each thread has its connection.
+    """
+
+    def __init__(self, size, ttl, path=None):
+        self.size = size
+        self.ttl = ttl
+        self.path = path or settings.COMPLETION_CACHE_PATH
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # waits for a write of another worker rather than failing
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS completions '
+                               '(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, used_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS completions_used_at ON completions (used_at)')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute('SELECT value FROM completions WHERE key = ? AND expires_at > ?',
+                                 (key, now)).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE completions SET used_at = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def set(self, key, value):
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)',
+                               (key, value, now + self.ttl, now))
+            connection.execute('DELETE FROM completions WHERE expires_at <= ?', (now,))
+            connection.execute('DELETE FROM completions WHERE key IN '
+                               '(SELECT key FROM completions ORDER BY used_at DESC LIMIT -1 OFFSET ?)', (self.size,))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def _reset():
+    global _lock, _backend, _stats
+    _lock = threading.Lock()
+    _backend = None
+    _stats = {'hits': 0, 'misses': 0, 'skipped': 0, 'errors': 0}
+
+
+_reset()
+# the connections of the SQLite backend can't be shared with a forked worker
+os.register_at_fork(after_in_child=_reset)
+
+
+def get_backend():
+    """
+    Returns the backend of COMPLETION_CACHE_BACKEND, None when the cache is off.
+    """
+    global _backend
+    if _backend is None and settings.COMPLETION_CACHE_BACKEND:
+        with _lock:
+            if _backend is None:
+                backend_class = BACKENDS.get(settings.COMPLETION_CACHE_BACKEND) or \
+                    import_string(settings.COMPLETION_CACHE_BACKEND)
+                _backend = backend_class(settings.COMPLETION_CACHE_SIZE, settings.COMPLETION_CACHE_TTL)
+    return _backend
+
+
+def make_key(params: dict) -> str:
+    """
+    Hash of the canonical form of the parameters of a chat completion.
+    """
+    canonical = {}
+    for name, value in params.items():
+        if name in _IGNORED_PARAMS or value is None:
+            continue
+        if name == 'messages':
+            value = [{field: message[field] for field in _MESSAGE_FIELDS if message.get(field) is not None}
+                     for message in value]
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            # 1 and 1.0 are the same temperature
+            value = float(value)
+        canonical[name] = value
+    data = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def is_cacheable(params: dict) -> bool:
+    """
+    Whether the completion is deterministic enough to be answered from the cache. The API samples with a
+    temperature of 1 when none is given.
+    """
+    temperature = params.get('temperature')
+    return params.get('n', 1) == 1 and (1 if temperature is None else temperature) <= \
+        settings.COMPLETION_CACHE_MAX_TEMPERATURE
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def get(params: dict, opt_in: bool = False) -> str or None:
+    """
+    Returns the cached text of the completion of `params`, None when it has to be requested. With `opt_in`, it is
+    cached whatever its temperature.
+    """
+    backend = get_backend()
+    if backend is None:
+        return None
+    if not opt_in and not is_cacheable(params):
+        _count('skipped')
+        return None
+    try:
+        value = backend.get(make_key(params))
+    except Exception as e:
+        # the completion is requested instead
+        print('>> Failed to read the completion cache: %s' % e)
+        _count('errors')
+        return None
+    _count('misses' if value is None else 'hits')
+    return value
+
+
+def put(params: dict, text: str, opt_in: bool = False):
+    """
+    Caches the text of the completion of `params`, if the policy or `opt_in` allows it.
+    """
+    backend = get_backend()
+    if backend is None or not text or not (opt_in or is_cacheable(params)):
+        return
+    try:
+        backend.set(make_key(params), text)
+    except Exception as e:
+        print('>> Failed to write the completion cache: %s' % e)
+        _count('errors')
+
+
+def get_stats() -> dict:
+    """
+    Counters of the lookups of this process, with the hit rate of the cacheable ones.
+    """
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+    stats['backend'] = settings.COMPLETION_CACHE_BACKEND or None
+    stats['pid'] = os.getpid()
+    backend = _backend
+    if backend is not None and hasattr(backend, '__len__'):
+        try:
+            stats['entries'] = len(backend)
+        except Exception:
+            pass
+    return stats
@@ -0,0 +1,106 @@
+"""
+The credentials of the unofficial API: the access token, when it expires and the cookie, of each account.
+
+They are kept in the Setting table and read through the settings cache (see chat.setting_cache), a lookup is a memory
+read. Saving credentials invalidates the cache of every worker once committed, a token renewed by one worker is used
+by all of them from their next lookup. The logins saving them run one at a time, see token_refresher.
+
+The `openai_access_token`, `openai_access_token_expire_at` and `openai_cookie` settings are the credentials set by
+an admin, shared by the accounts. Those created by the login of an account are saved in `openai_credentials:<email>`
+as JSON. The ones valid the longest are used.
+"""
+import json
+import time
+from functools import lru_cache
+from typing import Tuple
+
+from django.db import transaction
+
+from chat.models import Setting
+from chat.setting_cache import get_setting, get_settings
+
+_PREFIX = 'openai_credentials:'
+
+
+def valid_until(expires_at) -> float or None:
+    """
+    Time the credentials with `expires_at` can be used until, they are still accepted an hour past it. None if
+    `expires_at` is missing or invalid.
+    """
+    try:
+        return float(expires_at) + 3600
+    except (TypeError, ValueError):
+        return None
+
+
+def is_valid(credentials, ahead: float = 0) -> bool:
+    """
+    Whether `credentials` have a token still valid in `ahead` seconds.
+    """
+    if not credentials[0]:
+        return False
+    until = valid_until(credentials[1])
+    return until is not None and time.time() + ahead < until
+
+
+@lru_cache(maxsize=64)
+def _parse(value) -> Tuple[str or None, str or None, str or None] or None:
+    # the settings cache keeps the string, parsed once per value
+    try:
+        data = json.loads(value)
+        return data.get('access_token'), data.get('expires_at'), data.get('cookie')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _shared() -> Tuple[str or None, str or None, str or None]:
+    return get_setting('openai_access_token'), \
+        get_setting('openai_access_token_expire_at'), \
+        get_setting('openai_cookie')
+
+
+def get(email: str or None = None) -> Tuple[str or None, str or None, str or None]:
+    """
+    Returns the (access token, expires at, cookie) of the account of `email`, the shared ones without `email`.
+    """
+    shared = _shared()
+    value = get_setting(_PREFIX + email) if email else None
+    own = _parse(value) if value else None
+    if own is None:
+        return shared
+    return max(own, shared, key=lambda credentials: (valid_until(credentials[1]) or 0) if credentials[0] else -1)
+
+
+def save(email: str, access_token: str, expires_at: int, cookie: str or None = None):
+    """
+    Saves the credentials created by the login of `email`. Without `cookie`, the cookie in use is kept.
+    """
+    if cookie is None:
+        cookie = get(email)[2]
+    value = json.dumps({'access_token': access_token, 'expires_at': expires_at, 'cookie': cookie})
+    with transaction.atomic():
+        Setting.objects.update_or_create(name=_PREFIX + email, defaults={'value': value})
+
+
+def discard(access_token: str):
+    """
+    Expires the credentials with `access_token`, e.g. once refused with a 401. The next lookup logs in again.
+    """
+    if not access_token:
+        return
+    names = [name for name, value in get_settings().items()
+             if name.startswith(_PREFIX) and (_parse(value) or (None,))[0] == access_token]
+    if get_setting('openai_access_token') == access_token:
+        names.append('openai_access_token_expire_at')
+    # saved one by one, the post_save signal invalidates the settings cache of the workers
+    with transaction.atomic():
+        for setting in Setting.objects.select_for_update().filter(name__in=names):
+            if setting.name.startswith(_PREFIX):
+                credentials = _parse(setting.value)
+                if credentials is None or credentials[0] != access_token:
+                    # renewed meanwhile
+                    continue
+                setting.value = json.dumps({'access_token': access_token, 'expires_at': 0, 'cookie': credentials[2]})
+            else:
+                setting.value = '0'
+            setting.save()
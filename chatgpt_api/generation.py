@@ -0,0 +1,542 @@
+import asyncio
+import hashlib
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from django.http import StreamingHttpResponse
+
+from chatgpt_ui_server import settings
+from . import spool
+from .classes.utils import sse_pack
+
+# Generations of this process by id, kept GENERATION_REPLAY_TTL seconds after they finish so clients can resume
+_generations = {}
+# Generations of this process by turn key, while they run or, for idempotency keys, while they can be replayed
+_turns = {}
+# Generations of this process running by (user, conversation, parent message), found by the other clients of the
+# conversation whatever their message
+_running = {}
+_lock = threading.Lock()
+_executor = None
+_purged_at = 0
+
+# (seconds, characters) the deltas of the answer are held for before they are sent in one `message` frame. With
+# `latency` every delta gets its own frame, the others trade a little latency for fewer frames and writes.
+FLUSH_POLICIES = {
+    'latency': (0, 0),
+    'balanced': (0.05, 1024),
+    'throughput': (0.25, 8192),
+}
+
+
+class Delta(str):
+    """
+    A piece of the answer, yielded by producers instead of a `message` frame so it can be coalesced.
+    """
+
+
+class Generation:
+    """
+    Replay buffer of one answer being generated. The producer runs detached from the HTTP response that started
+    it and publishes SSE frames here; any number of responses read them, starting from any event id.
+    """
+
+    def __init__(self, user_id=None, flush_policy=None):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.flush_interval, self.flush_size = FLUSH_POLICIES[flush_policy or settings.SSE_FLUSH_POLICY]
+        # deltas not flushed into a frame yet
+        self._pending = []
+        self._pending_size = 0
+        self._pending_since = None
+        self.frames = []
+        self.done = False
+        self.finished_at = None
+        self.cancelled = False
+        # number of responses streaming the generation
+        self.readers = 0
+        self._condition = threading.Condition()
+        # (loop, asyncio.Event) of the async readers waiting for a frame
+        self._waiters = []
+        self._cancel_callbacks = []
+        self._finish_callbacks = []
+        # written for the other worker processes when GENERATION_SPOOL_DIR is set
+        self.spool = None
+        self._cancel_checked_at = 0
+        self.turn = None
+        # turns claimed with an idempotency key stay claimed after the generation, to replay it
+        self.keep_turn = False
+        # key of the generation in `_running`
+        self.running_key = None
+        self.started = False
+        # keeps a reference to the task of an async producer
+        self.task = None
+
+    def publish(self, frame: str):
+        self._check_cancel()
+        with self._condition:
+            self._flush()
+            self._append(frame)
+
+    def publish_delta(self, delta: str):
+        """
+        Adds a delta of the answer, sent with the following ones in a `message` frame once the flush interval has
+        elapsed since the first of them or their size reaches the flush size.
+        """
+        self._check_cancel()
+        with self._condition:
+            self._pending.append(delta)
+            self._pending_size += len(delta)
+            if len(self._pending) == 1:
+                self._pending_since = time.monotonic()
+            if self._pending_size < self.flush_size and \
+                    time.monotonic() - self._pending_since < self.flush_interval:
+                if len(self._pending) == 1:
+                    # the readers wait for it to be due and flush it if no other delta does
+                    self._notify()
+                return
+            self._flush()
+
+    def _flush(self):
+        # the caller holds the condition
+        if self._pending:
+            content = ''.join(self._pending)
+            self._pending = []
+            self._pending_size = 0
+            self._append(sse_pack('message', {'content': content}))
+
+    def _flush_timeout(self):
+        # seconds until the pending deltas are due, None if there are none, the caller holds the condition
+        if not self._pending:
+            return None
+        return self._pending_since + self.flush_interval - time.monotonic()
+
+    def _append(self, frame):
+        # the caller holds the condition, the spool is written under it to keep the frames in order. It is written
+        # before the readers are woken up: a system call releases the GIL, a reader already woken up would take it.
+        if self.spool is not None:
+            self.spool.append(frame)
+        self.frames.append(frame)
+        self._notify()
+
+    def _check_cancel(self):
+        # a stop received by another worker, looked for once per GENERATION_SPOOL_POLL like the other workers
+        # look for the frames, before publishing for the same reason as in `_append`
+        if self.spool is None or self.cancelled:
+            return
+        now = time.monotonic()
+        if now - self._cancel_checked_at < settings.GENERATION_SPOOL_POLL:
+            return
+        self._cancel_checked_at = now
+        if self.spool.cancel_requested():
+            self.cancel()
+
+    def finish(self):
+        with self._condition:
+            if self.done:
+                return
+            self._flush()
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._notify()
+        # only an answer that completed is replayed, a retry after a failure starts over
+        completed = bool(self.frames) and self.frames[-1].startswith('event: done\n')
+        if self.turn is not None and not (self.keep_turn and completed):
+            with _lock:
+                if _turns.get(self.turn) is self:
+                    del _turns[self.turn]
+            if spool.enabled():
+                spool.release_turn(self.turn, self.id)
+        if self.running_key is not None:
+            with _lock:
+                if _running.get(self.running_key) is self:
+                    del _running[self.running_key]
+            if spool.enabled():
+                spool.remove_running(self.running_key, self.id)
+        if self.spool is not None:
+            self.spool.close()
+        for callback in self._finish_callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        self._finish_callbacks = []
+
+    def on_finish(self, callback):
+        """
+        Registers `callback` to be called when the generation is finished, right away if it already is.
+        """
+        with self._condition:
+            if not self.done:
+                self._finish_callbacks.append(callback)
+                return
+        callback()
+
+    def on_cancel(self, callback):
+        """
+        Registers `callback` to be called, from the thread cancelling, when the generation is cancelled. Producers
+        use it to close their upstream response. It is called right away if the generation is already cancelled.
+        """
+        with self._condition:
+            if not self.cancelled:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self) -> bool:
+        """
+        Stops the producer, which persists the answer received so far. Returns False if the generation is over.
+        """
+        with self._condition:
+            if self.done or self.cancelled:
+                return False
+            self.cancelled = True
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        return True
+
+    def _join(self):
+        with self._condition:
+            self.readers += 1
+
+    def _leave(self, complete):
+        with self._condition:
+            self.readers -= 1
+            abandoned = not complete and not self.done and self.readers == 0
+        if abandoned and self.spool is not None and self.spool.has_readers():
+            # still followed from another worker
+            abandoned = False
+        if abandoned and settings.GENERATION_CANCEL_ON_DISCONNECT:
+            print('>> Generation %s abandoned by its clients, cancelling it' % self.id)
+            self.cancel()
+
+    def _notify(self):
+        self._condition.notify_all()
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+        self._waiters = []
+
+    def _read(self, index):
+        # frames after `index`, each with its `id:` field and joined to be sent in one write, and whether the
+        # generation is over; the caller holds the condition
+        if self._pending and self._flush_timeout() <= 0:
+            self._flush()
+        frames = self.frames[index:]
+        return ''.join('id: %d\n%s' % (index + i, frame) for i, frame in enumerate(frames, 1)), len(frames), \
+            self.done
+
+    def _wait(self, index, timeout):
+        # waits for frames after `index`, flushing the pending deltas when they are due, the caller holds the
+        # condition; returns False after `timeout` seconds without frames
+        deadline = time.monotonic() + timeout
+        while index >= len(self.frames) and not self.done:
+            flush_timeout = self._flush_timeout()
+            if flush_timeout is not None and flush_timeout <= 0:
+                self._flush()
+                continue
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                return False
+            self._condition.wait(wait if flush_timeout is None else min(wait, flush_timeout))
+        return True
+
+    def stream(self, last_event_id: int = 0):
+        """
+        Yields the frames after `last_event_id`, each with its `id:` field, until the generation is done. The WSGI
+        server closes the generator when the client is gone.
+        """
+        index = last_event_id
+        complete = False
+        self._join()
+        try:
+            while True:
+                with self._condition:
+                    has_frames = self._wait(index, settings.GENERATION_KEEP_ALIVE)
+                    frames, count, done = self._read(index)
+                if not has_frames:
+                    yield ': keep-alive\n\n'
+                    continue
+                if frames:
+                    index += count
+                    yield frames
+                if done:
+                    complete = True
+                    return
+        finally:
+            self._leave(complete)
+
+    async def astream(self, last_event_id: int = 0, disconnected: asyncio.Event or None = None):
+        """
+        Async counterpart of `stream`, it stops when `disconnected` is set.
+        """
+        loop = asyncio.get_running_loop()
+        index = last_event_id
+        complete = False
+        disconnect_task = asyncio.ensure_future(disconnected.wait()) if disconnected is not None else None
+        sent_at = time.monotonic()
+        self._join()
+        try:
+            while True:
+                event = asyncio.Event()
+                with self._condition:
+                    frames, count, done = self._read(index)
+                    if not frames and not done:
+                        self._waiters.append((loop, event))
+                        flush_timeout = self._flush_timeout()
+                if not frames and not done:
+                    timeout = sent_at + settings.GENERATION_KEEP_ALIVE - time.monotonic()
+                    if flush_timeout is not None:
+                        timeout = min(timeout, flush_timeout)
+                    event_task = asyncio.ensure_future(event.wait())
+                    waits = {event_task, disconnect_task} if disconnect_task else {event_task}
+                    finished, _ = await asyncio.wait(waits, timeout=max(timeout, 0),
+                                                     return_when=asyncio.FIRST_COMPLETED)
+                    if event_task not in finished:
+                        event_task.cancel()
+                    if disconnect_task in finished:
+                        return
+                    if not finished and time.monotonic() - sent_at >= settings.GENERATION_KEEP_ALIVE:
+                        sent_at = time.monotonic()
+                        yield ': keep-alive\n\n'
+                    continue
+                if frames:
+                    index += count
+                    sent_at = time.monotonic()
+                    yield frames
+                if done:
+                    complete = True
+                    return
+        finally:
+            if disconnect_task is not None:
+                disconnect_task.cancel()
+            self._leave(complete)
+
+
+def _get_executor():
+    global _executor
+    # created on first use, so that every worker forked from a preloaded master gets its own threads
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.GENERATION_WORKERS,
+                                               thread_name_prefix='generation')
+    return _executor
+
+
+def _register(generation):
+    global _purged_at
+    now = time.monotonic()
+    with _lock:
+        for generation_id in [generation_id for generation_id, g in _generations.items()
+                              if g.done and now - g.finished_at > settings.GENERATION_REPLAY_TTL]:
+            del _generations[generation_id]
+        for key in [key for key, g in _turns.items() if g.done and g.id not in _generations]:
+            del _turns[key]
+        _generations[generation.id] = generation
+        purge = spool.enabled() and now - _purged_at > settings.GENERATION_REPLAY_TTL
+        if purge:
+            _purged_at = now
+    if purge:
+        spool.purge(settings.GENERATION_REPLAY_TTL)
+    if generation.spool is None:
+        _open_spool(generation)
+
+
+def _open_spool(generation):
+    if spool.enabled():
+        try:
+            generation.spool = spool.Spool(generation.id, generation.user_id)
+        except OSError as e:
+            # still served by this worker
+            print('>> Cannot spool generation %s: %s' % (generation.id, e))
+
+
+def get_generation(generation_id: str):
+    """
+    Returns the generation `generation_id`, run by this process or, read from its spool, by another one.
+    """
+    generation = _generations.get(generation_id)
+    if generation is None:
+        generation = spool.open_generation(generation_id)
+    return generation
+
+
+def _turn_key(*parts):
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def claim_turn(user, conversation_id, parent_message_id, message=None, idempotency_key=None, flush_policy=None):
+    """
+    Returns `(generation, claimed)` for the answer to `parent_message_id` in a conversation. When the turn is
+    already being answered, in this process or another worker, that generation is returned with `claimed` False
+    and the caller just streams it. Otherwise the caller gets a new generation to pass to `start_generation`, it
+    must call `finish` on it if it does not start it.
+
+    With an `idempotency_key` the turn is the key, and a finished generation is still returned, to be replayed,
+    for GENERATION_REPLAY_TTL seconds. Otherwise the turn is the message and its parent message.
+    `flush_policy` is the name of the FLUSH_POLICIES entry the deltas of a new generation are coalesced with.
+
+    A new generation in an existing conversation can be found by the other clients with `find_turn`.
+    """
+    generation = Generation(user_id=user.id, flush_policy=flush_policy)
+    if idempotency_key:
+        key = _turn_key(user.id, 'idempotency', idempotency_key)
+        replay_ttl = settings.GENERATION_REPLAY_TTL
+    else:
+        # only the same message to the same parent is the same turn, an edited message is answered on its own
+        key = _turn_key(user.id, conversation_id, parent_message_id, message)
+        replay_ttl = None
+
+    with _lock:
+        current = _turns.get(key)
+        if current is not None and (not current.done or replay_ttl is not None):
+            return current, False
+        owner_id = None
+        if spool.enabled():
+            # the other workers find the generation of a claim as soon as they see the claim
+            _open_spool(generation)
+            owner_id = spool.claim_turn(key, generation.id, replay_ttl)
+        if owner_id is not None:
+            owner = _generations.get(owner_id) or spool.open_generation(owner_id)
+            if owner is not None:
+                if generation.spool is not None:
+                    generation.spool.discard()
+                return owner, False
+        _turns[key] = generation
+        generation.turn = key
+        generation.keep_turn = replay_ttl is not None
+        if conversation_id:
+            generation.running_key = _turn_key(user.id, conversation_id, parent_message_id)
+            _running[generation.running_key] = generation
+            if spool.enabled():
+                spool.add_running(generation.running_key, generation.id)
+    _register(generation)
+    return generation, True
+
+
+def find_turn(user, conversation_id, parent_message_id):
+    """
+    Returns the generation answering `parent_message_id` in a conversation of `user`, in this process or another
+    worker, whichever client asked for it. None when the turn is not being answered.
+    """
+    key = _turn_key(user.id, conversation_id, parent_message_id)
+    generation = _running.get(key)
+    if generation is None and spool.enabled():
+        generation_id = spool.find_running(key)
+        if generation_id is not None:
+            generation = spool.open_generation(generation_id)
+    return generation
+
+
+def _run(generation, producer):
+    close_old_connections()
+    try:
+        for frame in producer(generation):
+            if isinstance(frame, Delta):
+                generation.publish_delta(frame)
+            else:
+                generation.publish(frame)
+    except Exception as e:
+        traceback.print_exc()
+        generation.publish(sse_pack('error', {'error': str(e)}))
+    finally:
+        generation.finish()
+        # the worker thread keeps its connection otherwise
+        close_old_connections()
+
+
+async def _arun(generation, producer):
+    try:
+        async for frame in producer(generation):
+            if isinstance(frame, Delta):
+                generation.publish_delta(frame)
+            else:
+                generation.publish(frame)
+    except asyncio.CancelledError:
+        # cancelled outside of the upstream read, e.g. while saving, nothing left to send
+        pass
+    except Exception as e:
+        traceback.print_exc()
+        generation.publish(sse_pack('error', {'error': str(e)}))
+    finally:
+        generation.finish()
+
+
+def start_generation(producer, user=None, generation=None) -> Generation:
+    """
+    Runs `producer`, a generator function taking the generation and yielding SSE frames or `Delta`s of the
+    answer, in the generation thread pool. It keeps running, and persists its answer, when the client goes away unless
+    GENERATION_CANCEL_ON_DISCONNECT is set. Producers stop reading upstream once `generation.cancelled` is set.
+    `generation` is the one returned by `claim_turn`, if any.
+    """
+    if generation is None:
+        generation = Generation(user_id=user.id if user else None)
+        _register(generation)
+    generation.started = True
+    _get_executor().submit(_run, generation, producer)
+    return generation
+
+
+def astart_generation(producer, user=None, generation=None) -> Generation:
+    """
+    Async counterpart of `start_generation`, `producer` is an async generator function run as a task of the
+    current event loop. Cancelling the generation cancels the task, the producer catches the CancelledError
+    raised in its upstream read.
+    """
+    if generation is None:
+        generation = Generation(user_id=user.id if user else None)
+        _register(generation)
+    generation.started = True
+    loop = asyncio.get_running_loop()
+    generation.task = loop.create_task(_arun(generation, producer))
+    generation.on_cancel(lambda: loop.call_soon_threadsafe(generation.task.cancel))
+    return generation
+
+
+def generation_response(generation, last_event_id: int = 0):
+    response = StreamingHttpResponse(generation.stream(last_event_id), content_type='text/event-stream')
+    response['X-Generation-Id'] = generation.id
+    return response
+
+
+def ageneration_response(generation, last_event_id: int = 0, disconnected: asyncio.Event or None = None):
+    response = StreamingHttpResponse(generation.astream(last_event_id, disconnected),
+                                     content_type='text/event-stream')
+    response['X-Generation-Id'] = generation.id
+    return response
+
+
+def get_disconnected_event(request) -> asyncio.Event or None:
+    """
+    Returns the event set when the client of `request` goes away, see `DisconnectMiddleware` in the ASGI config.
+    """
+    return getattr(request, 'scope', {}).get('disconnected')
+
+
+def get_flush_policy(request) -> str or None:
+    """
+    Reads the name of the flush policy a client asks for, `latency` to get every delta as soon as it arrives or
+    `throughput` for fewer and bigger frames, from the `X-Stream-Flush` header or a `flush` query parameter.
+    """
+    policy = request.headers.get('X-Stream-Flush') or request.GET.get('flush')
+    return policy if policy in FLUSH_POLICIES else None
+
+
+def get_last_event_id(request) -> int:
+    """
+    Reads the event id to resume after, from the `Last-Event-ID` header sent by EventSource when it reconnects
+    or from a `lastEventId` query parameter.
+    """
+    value = request.headers.get('Last-Event-ID') or request.GET.get('lastEventId')
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,154 @@
+"""
+Spreads the requests to the OpenAI API over the keys of the `openai_api_key` setting, which can hold several keys
+separated by commas or new lines.
+
+Each key has a token bucket for its requests per minute and one for its tokens per minute. They start from
+API_KEY_RPM and API_KEY_TPM and follow the x-ratelimit-* headers of the responses, which also count the requests of
+the other processes using the key. A key answering 429 is not used until its limit resets. A request goes to the key
+which can take it soonest, the one with the most headroom among those which can take it now.
+"""
+import re
+import threading
+import time
+
+from chat.setting_cache import get_setting
+from chatgpt_ui_server import settings
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+_lock = threading.Lock()
+# key -> _KeyState
+_keys = {}
+
+
+def parse_duration(value) -> float or None:
+    """
+    Seconds of a duration of the rate limit headers, such as `20ms`, `1s` or `6m0s`, or of a plain number.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+def get_api_keys() -> list:
+    return [key for key in re.split(r'[\s,]+', get_setting('openai_api_key') or '') if key]
+
+
+class _Bucket:
+    # A token bucket refilled at its limit per minute. The level goes below zero when more than the bucket holds
+    # is reserved, the following reservations then wait for it to be refilled.
+    def __init__(self, limit):
+        self.limit = limit
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def delay(self, amount) -> float:
+        # seconds until `amount` can be taken
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) * 60 / self.limit
+
+    def learn(self, limit, remaining, now):
+        if limit:
+            self.limit = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+            self.updated = now
+
+
+class _KeyState:
+    def __init__(self):
+        self.requests = _Bucket(settings.API_KEY_RPM)
+        self.tokens = _Bucket(settings.API_KEY_TPM)
+        self.blocked_until = 0
+
+    def delay(self, tokens, now) -> float:
+        return max(self.blocked_until - now, self.requests.delay(1), self.tokens.delay(min(tokens, self.tokens.limit)))
+
+    def headroom(self) -> float:
+        return min(self.requests.level / self.requests.limit, self.tokens.level / self.tokens.limit)
+
+
+def _states() -> dict:
+    # follows the setting, keeps what was learned about the keys still in it
+    keys = get_api_keys()
+    if keys != list(_keys):
+        states = {key: _keys.get(key) or _KeyState() for key in keys}
+        _keys.clear()
+        _keys.update(states)
+    return _keys
+
+
+def reserve(tokens: int) -> tuple:
+    """
+    Reserves a request of about `tokens` tokens (the prompt and max_tokens) on the key which can take it soonest.
+    Returns the key, or None when no key is set, and the seconds to wait before sending the request.
+    """
+    now = time.monotonic()
+    with _lock:
+        states = _states()
+        if not states:
+            return None, 0
+        for state in states.values():
+            state.requests.refill(now)
+            state.tokens.refill(now)
+        key, state = min(states.items(), key=lambda item: (item[1].delay(tokens, now), -item[1].headroom()))
+        delay = state.delay(tokens, now)
+        state.requests.level -= 1
+        state.tokens.level -= tokens
+    return key, min(delay, settings.API_KEY_MAX_WAIT)
+
+
+def update(key: str, status: int, headers):
+    """
+    Learns the limits of `key` from the headers of a response, and blocks it until they reset after a 429.
+    """
+    if key is None:
+        return
+    now = time.monotonic()
+    with _lock:
+        state = _keys.get(key)
+        if state is None:
+            return
+        state.requests.learn(_int(headers.get('x-ratelimit-limit-requests')),
+                             _int(headers.get('x-ratelimit-remaining-requests')), now)
+        state.tokens.learn(_int(headers.get('x-ratelimit-limit-tokens')),
+                           _int(headers.get('x-ratelimit-remaining-tokens')), now)
+        if status == 429:
+            wait = parse_duration(headers.get('retry-after'))
+            if wait is None:
+                # the reset of the limit which was reached, the latest reset when the headers don't tell which
+                resets = {limit: parse_duration(headers.get('x-ratelimit-reset-%s' % limit))
+                          for limit in ('requests', 'tokens')}
+                known = [reset for reset in resets.values() if reset]
+                reached = [reset for limit, reset in resets.items()
+                           if reset and _int(headers.get('x-ratelimit-remaining-%s' % limit)) == 0]
+                wait = max(reached or known) if known else settings.API_KEY_COOLDOWN
+            state.blocked_until = max(state.blocked_until, now + wait)
+
+
+def _int(value) -> int or None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(messages, max_tokens) -> int:
+    """
+    Tokens a completion request is counted for by the rate limits, estimated like the API does: a token per four
+    characters of the messages and the max_tokens of the answer.
+    """
+    return sum(len(message.get('content') or '') for message in messages) // 4 + (max_tokens or 0)
@@ -0,0 +1,385 @@
+"""
+Shares generations between the worker processes of a host. The process running a generation appends its SSE
+frames to a file in GENERATION_SPOOL_DIR, the others follow the file.
+
+    <GENERATION_SPOOL_DIR>/<generation id>/meta.json   owner of the generation
+                                          /frames      SSE frames, ended by END_FRAME
+                                          /cancel      created to ask the owner to stop
+                                          /readers/    one file per reader in another process
+    <GENERATION_SPOOL_DIR>/turns/<turn key>            claim of a turn by a generation, or of an idempotency key
+    <GENERATION_SPOOL_DIR>/running/<turn key>          generation answering a turn of a conversation, found by the
+                                                       other clients of the conversation
+"""
+import asyncio
+import json
+import os
+import shutil
+import time
+import uuid
+
+from chatgpt_ui_server import settings
+
+# A comment, it can't be confused with the frames built by `sse_pack`
+END_FRAME = b': end\n\n'
+
+
+def enabled() -> bool:
+    return bool(settings.GENERATION_SPOOL_DIR)
+
+
+def _generation_path(generation_id, *names):
+    return os.path.join(settings.GENERATION_SPOOL_DIR, generation_id, *names)
+
+
+def _turn_path(key):
+    return os.path.join(settings.GENERATION_SPOOL_DIR, 'turns', key)
+
+
+def _running_path(key):
+    return os.path.join(settings.GENERATION_SPOOL_DIR, 'running', key)
+
+
+def _write_atomic(path, content: str):
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Spool:
+    """
+    Writing side of a spooled generation, used by the process running it.
+    """
+
+    def __init__(self, generation_id, user_id):
+        self.generation_id = generation_id
+        os.makedirs(_generation_path(generation_id, 'readers'), exist_ok=True)
+        _write_atomic(_generation_path(generation_id, 'meta.json'),
+                      json.dumps({'user_id': user_id, 'pid': os.getpid()}))
+        # frames are written with one O_APPEND write each, so a reader never sees half of one
+        self._fd = os.open(_generation_path(generation_id, 'frames'), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def append(self, frame: str):
+        os.write(self._fd, frame.encode('utf-8'))
+
+    def close(self):
+        try:
+            os.write(self._fd, END_FRAME)
+        finally:
+            os.close(self._fd)
+
+    def discard(self):
+        # the generation won't run, e.g. its turn was claimed by another one
+        os.close(self._fd)
+        shutil.rmtree(_generation_path(self.generation_id), ignore_errors=True)
+
+    def cancel_requested(self) -> bool:
+        return os.path.exists(_generation_path(self.generation_id, 'cancel'))
+
+    def has_readers(self) -> bool:
+        try:
+            return bool(os.listdir(_generation_path(self.generation_id, 'readers')))
+        except FileNotFoundError:
+            return False
+
+
+def _is_finished(generation_id) -> bool:
+    # whether the spool of the generation ends with END_FRAME
+    try:
+        with open(_generation_path(generation_id, 'frames'), 'rb') as f:
+            f.seek(max(0, os.fstat(f.fileno()).st_size - len(END_FRAME)))
+            return f.read() == END_FRAME
+    except FileNotFoundError:
+        return False
+
+
+def _claim_holder(path, replay_ttl):
+    # id of the generation holding a claim, None if the claim is stale
+    owner = _read_json(path)
+    if owner is None:
+        return None
+    if replay_ttl is not None and _is_finished(owner['generation_id']):
+        # kept after the generation finished, it can be replayed from its spool until then
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        return owner['generation_id'] if age < replay_ttl else None
+    # an unfinished generation whose worker died is never finished, it is answered again
+    if owner['pid'] != os.getpid() and _is_alive(owner['pid']):
+        return owner['generation_id']
+    return None
+
+
+def claim_turn(key: str, generation_id: str, replay_ttl=None) -> str or None:
+    """
+    Claims the turn `key` for `generation_id`. Returns None when claimed, or the id of the generation holding it:
+    a running generation of another process or, when `replay_ttl` is given, a finished generation that claimed it
+    less than `replay_ttl` seconds ago.
+    """
+    path = _turn_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%s.tmp' % (path, generation_id)
+    with open(tmp_path, 'w') as f:
+        json.dump({'generation_id': generation_id, 'pid': os.getpid()}, f)
+    try:
+        for _ in range(2):
+            try:
+                # fails if the claim exists, readers never see a claim without its content
+                os.link(tmp_path, path)
+                return None
+            except FileExistsError:
+                holder = _claim_holder(path, replay_ttl)
+                if holder is not None:
+                    return holder
+                # released meanwhile, expired, left by a worker that died or by this process, take it over
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        return None
+    finally:
+        os.unlink(tmp_path)
+
+
+def _release(path, generation_id):
+    owner = _read_json(path)
+    if owner is not None and owner['generation_id'] == generation_id:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def release_turn(key: str, generation_id: str):
+    _release(_turn_path(key), generation_id)
+
+
+def add_running(key: str, generation_id: str):
+    """
+    Indexes `generation_id` as the generation answering the turn `key`, the newest generation of a turn wins.
+    """
+    path = _running_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_atomic(path, json.dumps({'generation_id': generation_id, 'pid': os.getpid()}))
+
+
+def remove_running(key: str, generation_id: str):
+    _release(_running_path(key), generation_id)
+
+
+def find_running(key: str) -> str or None:
+    """
+    Returns the id of the generation answering the turn `key` in another process, None if there is none.
+    """
+    owner = _read_json(_running_path(key))
+    if owner is None or owner['pid'] == os.getpid() or not _is_alive(owner['pid']):
+        return None
+    return owner['generation_id']
+
+
+def open_generation(generation_id: str):
+    """
+    Returns the spooled generation `generation_id` run by another process, or None.
+    """
+    if not enabled() or os.sep in generation_id or generation_id in ('.', '..', 'turns', 'running'):
+        return None
+    meta = _read_json(_generation_path(generation_id, 'meta.json'))
+    if meta is None or meta['pid'] == os.getpid():
+        return None
+    return SpooledGeneration(generation_id, meta['user_id'], meta['pid'])
+
+
+def purge(max_age):
+    """
+    Removes the generations which have not been written for `max_age` seconds, and the claims and index entries
+    left on them.
+    """
+    now = time.time()
+    try:
+        entries = os.listdir(settings.GENERATION_SPOOL_DIR)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry in ('turns', 'running'):
+            continue
+        try:
+            if now - os.stat(_generation_path(entry, 'frames')).st_mtime < max_age:
+                continue
+        except FileNotFoundError:
+            # not written yet, or a leftover of a failed generation
+            try:
+                if now - os.stat(_generation_path(entry)).st_mtime < max_age:
+                    continue
+            except FileNotFoundError:
+                continue
+        shutil.rmtree(_generation_path(entry), ignore_errors=True)
+
+    for directory in ('turns', 'running'):
+        directory_path = os.path.join(settings.GENERATION_SPOOL_DIR, directory)
+        try:
+            keys = os.listdir(directory_path)
+        except FileNotFoundError:
+            continue
+        for key in keys:
+            path = os.path.join(directory_path, key)
+            owner = _read_json(path)
+            try:
+                if owner is not None and os.path.isdir(_generation_path(owner['generation_id'])) or \
+                        now - os.stat(path).st_mtime < max_age:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class _FrameReader:
+    # Reads the complete frames appended to a spool since the previous call
+    def __init__(self, generation_id):
+        self._path = _generation_path(generation_id, 'frames')
+        self._file = None
+        self._buffer = b''
+
+    def read(self):
+        if self._file is None:
+            try:
+                self._file = open(self._path, 'rb')
+            except FileNotFoundError:
+                return [], False
+        self._buffer += self._file.read()
+        frames = []
+        done = False
+        start = 0
+        while True:
+            end = self._buffer.find(b'\n\n', start)
+            if end == -1:
+                break
+            frame = self._buffer[start:end + 2]
+            start = end + 2
+            if frame == END_FRAME:
+                done = True
+                break
+            frames.append(frame.decode('utf-8'))
+        self._buffer = self._buffer[start:]
+        return frames, done
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class SpooledGeneration:
+    """
+    A generation running in another process, read from its spool. It can be streamed and cancelled like a
+    `Generation`.
+    """
+
+    def __init__(self, generation_id, user_id, pid):
+        self.id = generation_id
+        self.user_id = user_id
+        self.pid = pid
+
+    @property
+    def done(self) -> bool:
+        return _is_finished(self.id)
+
+    def cancel(self) -> bool:
+        if self.done:
+            return False
+        # the owner checks for it when it publishes the next frame
+        open(_generation_path(self.id, 'cancel'), 'a').close()
+        return True
+
+    def _join(self):
+        path = _generation_path(self.id, 'readers', '%d-%s' % (os.getpid(), uuid.uuid4().hex))
+        try:
+            open(path, 'w').close()
+        except FileNotFoundError:
+            return None
+        return path
+
+    @staticmethod
+    def _leave(path):
+        if path is not None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _frames(self, reader, index, last_event_id):
+        frames, done = reader.read()
+        packed = []
+        for frame in frames:
+            index += 1
+            if index > last_event_id:
+                packed.append('id: %d\n%s' % (index, frame))
+        if not done and not frames:
+            # purged, or the owner died before finishing it
+            done = not os.path.isdir(_generation_path(self.id)) or not _is_alive(self.pid)
+        return packed, index, done
+
+    def stream(self, last_event_id: int = 0):
+        reader = _FrameReader(self.id)
+        marker = self._join()
+        index = 0
+        idle = 0
+        try:
+            while True:
+                frames, index, done = self._frames(reader, index, last_event_id)
+                if frames:
+                    yield ''.join(frames)
+                if done:
+                    return
+                if frames:
+                    idle = 0
+                    continue
+                time.sleep(settings.GENERATION_SPOOL_POLL)
+                idle += settings.GENERATION_SPOOL_POLL
+                if idle >= settings.GENERATION_KEEP_ALIVE:
+                    idle = 0
+                    yield ': keep-alive\n\n'
+        finally:
+            reader.close()
+            self._leave(marker)
+
+    async def astream(self, last_event_id: int = 0, disconnected: asyncio.Event or None = None):
+        reader = _FrameReader(self.id)
+        marker = self._join()
+        index = 0
+        idle = 0
+        try:
+            while True:
+                frames, index, done = self._frames(reader, index, last_event_id)
+                if frames:
+                    yield ''.join(frames)
+                if done or disconnected is not None and disconnected.is_set():
+                    return
+                if frames:
+                    idle = 0
+                    continue
+                await asyncio.sleep(settings.GENERATION_SPOOL_POLL)
+                idle += settings.GENERATION_SPOOL_POLL
+                if idle >= settings.GENERATION_KEEP_ALIVE:
+                    idle = 0
+                    yield ': keep-alive\n\n'
+        finally:
+            reader.close()
+            self._leave(marker)
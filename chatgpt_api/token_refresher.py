@@ -0,0 +1,146 @@
+"""
+Keeps a valid access token of the unofficial API for each account, and renews it before it expires.
+
+A request reads the token of the credential store, a memory read (see credentials). A background thread renews it
+ACCESS_TOKEN_REFRESH_AHEAD seconds before it expires, a request only waits for a login when there is no valid token at
+all. A single login of an account runs at a time: the threads of a process take its lock, the worker processes a lock
+file in ACCESS_TOKEN_DIR. Whoever waited for a login reads the token it saved instead of logging in again. A failed
+login isn't retried before ACCESS_TOKEN_RETRY seconds, in any of the processes.
+"""
+import contextlib
+import fcntl
+import hashlib
+import os
+import threading
+import time
+import traceback
+from typing import Tuple
+
+from django.db import close_old_connections
+
+from chatgpt_ui_server import settings
+from . import credentials as Credentials
+from .classes import openai as OpenAI
+from .classes import exceptions as Exceptions
+
+
+def _reset():
+    global _lock, _accounts, _thread
+    _lock = threading.Lock()
+    # email -> _Account
+    _accounts = {}
+    _thread = None
+
+
+_reset()
+# the thread and the locks of the parent process are not those of a forked worker
+os.register_at_fork(after_in_child=_reset)
+
+
+class _Account:
+    def __init__(self, email, password, proxy):
+        self.email = email
+        self.password = password
+        self.proxy = proxy
+        # a single login at a time in the process
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _lock_file(self, wait):
+        # the lock of the login across the workers, the file holds the time of the last failed login
+        os.makedirs(settings.ACCESS_TOKEN_DIR, exist_ok=True)
+        path = os.path.join(settings.ACCESS_TOKEN_DIR, '%s.lock' % hashlib.sha1(self.email.encode()).hexdigest())
+        with open(path, 'a+') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield None
+                return
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def refresh(self, ahead: float, wait: bool = True) -> bool:
+        """
+        Logs in unless the token is valid for `ahead` more seconds once the lock is taken. Without `wait`, gives up
+        when another thread or worker is already logging in. Returns whether the token is valid for `ahead` seconds.
+        """
+        if not self.lock.acquire(blocking=wait):
+            return False
+        try:
+            with self._lock_file(wait) as f:
+                if f is None:
+                    return False
+                # renewed by the thread or the worker we waited for
+                if Credentials.is_valid(Credentials.get(self.email), ahead):
+                    return True
+
+                f.seek(0)
+                failed_at = f.read().strip()
+                if failed_at and time.time() < float(failed_at) + settings.ACCESS_TOKEN_RETRY:
+                    raise Exceptions.PyChatGPTException("Failed to recreate access token, retrying later.")
+
+                print('>> Renewing the access token of %s' % self.email)
+                try:
+                    # saves the new credentials in the store
+                    OpenAI.Auth(email_address=self.email, password=self.password, proxy=self.proxy).create_token()
+                    if not Credentials.is_valid(Credentials.get(self.email)):
+                        raise Exceptions.PyChatGPTException("Failed to recreate access token.")
+                except Exception:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(str(time.time()))
+                    f.flush()
+                    raise
+                f.truncate(0)
+                return True
+        finally:
+            self.lock.release()
+
+
+def _get_account(email, password, proxy) -> _Account:
+    account = _accounts.get(email)
+    if account is None or account.password != password or account.proxy != proxy:
+        with _lock:
+            account = _accounts.get(email)
+            if account is None or account.password != password or account.proxy != proxy:
+                account = _accounts[email] = _Account(email, password, proxy)
+    _start()
+    return account
+
+
+def get_access_token(email: str, password: str,
+                     proxy: str or dict or None = None) -> Tuple[str or None, str or None, str or None]:
+    """
+    Returns the (access token, expires at, cookie) of the account, logging in only when there is no valid token.
+    """
+    account = _get_account(email, password, proxy)
+    credentials = Credentials.get(email)
+    if Credentials.is_valid(credentials):
+        return credentials
+    # never logged in, or the background renewal failed
+    account.refresh(0)
+    return Credentials.get(email)
+
+
+def _run():
+    while True:
+        time.sleep(settings.ACCESS_TOKEN_REFRESH_INTERVAL)
+        # the thread lives longer than CONN_MAX_AGE, or than the database keeps an idle connection
+        close_old_connections()
+        for account in list(_accounts.values()):
+            try:
+                # a worker already logging in renews it for everyone
+                account.refresh(settings.ACCESS_TOKEN_REFRESH_AHEAD, wait=False)
+            except Exception:
+                traceback.print_exc()
+
+
+def _start():
+    global _thread
+    if _thread is None:
+        with _lock:
+            if _thread is None:
+                _thread = threading.Thread(target=_run, name='access-token-refresher', daemon=True)
+                _thread.start()
@@ -0,0 +1,119 @@
+import os
+import threading
+
+import requests
+import tiktoken
+import tiktoken.load
+
+# Tokens added around every message by the chat format of each model family, the longest matching prefix wins.
+# See https://github.com/openai/openai-python/blob/main/chatml.md
+MESSAGE_FORMATS = {
+    # every message follows <im_start>{role/name}\n{content}<im_end>\n, a name replaces the role,
+    # every reply is primed with <im_start>assistant
+    'gpt-3.5-turbo': {'tokens_per_message': 4, 'tokens_per_name': -1, 'tokens_per_reply': 2},
+    'gpt-4': {'tokens_per_message': 3, 'tokens_per_name': 1, 'tokens_per_reply': 3},
+}
+
+# Models whose encodings are loaded when the app starts
+WARM_UP_MODELS = ['gpt-3.5-turbo', 'gpt-4']
+
+_encodings = {}
+_lock = threading.Lock()
+
+# When offline, encodings missing from the cache raise instead of being downloaded
+_offline = False
+# Seconds a download of an encoding may wait on the network
+_timeout = None
+_read_blob = tiktoken.load.read_file
+
+
+class TokenizerCacheMissing(Exception):
+    pass
+
+
+def _read_file(blobpath: str) -> bytes:
+    if _offline and (blobpath.startswith("http://") or blobpath.startswith("https://")):
+        raise TokenizerCacheMissing(
+            f"{blobpath} is not in the tokenizer cache ({os.environ.get('TIKTOKEN_CACHE_DIR')}) and downloads are "
+            f"disabled, populate it with `python manage.py cache_tokenizers`.")
+    return _download(blobpath)
+
+
+def _download(blobpath: str) -> bytes:
+    if not (blobpath.startswith("http://") or blobpath.startswith("https://")):
+        return _read_blob(blobpath)
+    # tiktoken downloads without a timeout, a stalled connection would block the worker forever
+    response = requests.get(blobpath, timeout=_timeout)
+    response.raise_for_status()
+    return response.content
+
+
+# tiktoken only downloads through this function, after looking up its file cache
+tiktoken.load.read_file = _read_file
+
+
+def configure(cache_dir: str or None = None, offline: bool = False, timeout: float or None = None):
+    """
+    Points tiktoken to a local encoding cache shared by all workers. With `offline`, a missing encoding fails
+    right away instead of reaching the network, otherwise its download fails after `timeout` seconds.
+    """
+    global _offline, _timeout
+    if cache_dir:
+        os.environ['TIKTOKEN_CACHE_DIR'] = str(cache_dir)
+    _offline = offline
+    _timeout = timeout
+
+
+def get_encoding(model="gpt-3.5-turbo"):
+    """
+    Returns the tiktoken encoding of a model. Encodings are loaded once per process and shared by all threads.
+    """
+    encoding = _encodings.get(model)
+    if encoding is None:
+        with _lock:
+            encoding = _encodings.get(model)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("cl100k_base")
+                _encodings[model] = encoding
+    return encoding
+
+
+def get_message_format(model="gpt-3.5-turbo"):
+    prefixes = [prefix for prefix in MESSAGE_FORMATS if model.startswith(prefix)]
+    if not prefixes:
+        raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}. See 
+        https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to 
+        tokens.""")
+    return MESSAGE_FORMATS[max(prefixes, key=len)]
+
+
+def warm_up(models=None):
+    """
+    Loads the encodings of `models` (defaults to WARM_UP_MODELS), so the first request doesn't pay for it.
+    """
+    for model in models or WARM_UP_MODELS:
+        get_encoding(model).encode("warm up")
+
+
+def num_tokens_from_message(message, model="gpt-3.5-turbo"):
+    """Returns the number of tokens a single message adds to a list of messages."""
+    encoding = get_encoding(model)
+    message_format = get_message_format(model)
+    num_tokens = message_format['tokens_per_message']
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += message_format['tokens_per_name']
+    return num_tokens
+
+
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
+    """Returns the number of tokens used by a list of messages."""
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, model)
+    num_tokens += get_message_format(model)['tokens_per_reply']
+    return num_tokens
@@ -7,10 +7,56 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
+from django.apps import apps
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatgpt_ui_server.settings')
 
-application = get_asgi_application()
+
+class DisconnectMiddleware:
+    """
+    Django only listens for `http.disconnect` while it reads the request body. This keeps listening while the
+    response is sent and sets `scope['disconnected']`, an asyncio.Event, when the client goes away, so streaming
+    responses can stop early.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        disconnected = asyncio.Event()
+        scope['disconnected'] = disconnected
+        listener = None
+
+        async def listen():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        async def receive_body():
+            nonlocal listener
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+            elif not message.get('more_body', False):
+                # the body is complete, the next message can only be the disconnect
+                listener = asyncio.ensure_future(listen())
+            return message
+
+        try:
+            await self.app(scope, receive_body, send)
+        finally:
+            if listener is not None:
+                listener.cancel()
+
+
+application = DisconnectMiddleware(get_asgi_application())
+
+# before the first request, and once in the master process with gunicorn --preload
+apps.get_app_config('chat').warm_up()
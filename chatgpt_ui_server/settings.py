@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 import os
+import tempfile
 from datetime import timedelta
 
 import dj_database_url
@@ -91,6 +92,113 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'chatgpt_ui_server.wsgi.application'
 
+# Route the conversation and gen_title endpoints to their async views, requires serving through asgi.py
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', False) == 'True'
+
+# Load the tokenizer encodings when a server process starts instead of on its first request, the management commands
+# don't load them
+TOKENIZER_WARM_UP = os.getenv('TOKENIZER_WARM_UP', 'True') == 'True'
+
+# Local tiktoken encoding cache shared by all workers, populated with `python manage.py cache_tokenizers`
+TOKENIZER_CACHE_DIR = os.getenv('TOKENIZER_CACHE_DIR', os.path.join(BASE_DIR, 'tiktoken_cache'))
+
+# Never download encodings at runtime, a missing one fails instead of waiting on the network
+TOKENIZER_OFFLINE = os.getenv('TOKENIZER_OFFLINE', False) == 'True'
+
+# Seconds a download of an encoding may take to connect or between two reads before failing
+TOKENIZER_DOWNLOAD_TIMEOUT = float(os.getenv('TOKENIZER_DOWNLOAD_TIMEOUT', 10))
+
+# Setting rows are cached in every worker. A change made through the ORM is propagated to the other workers of
+# the host through this file, the TTL bounds how long other changes (raw SQL, other hosts) can stay unseen.
+SETTING_CACHE_TTL = int(os.getenv('SETTING_CACHE_TTL', 60))
+SETTING_CACHE_VERSION_FILE = os.getenv('SETTING_CACHE_VERSION_FILE',
+                                       os.path.join(tempfile.gettempdir(), 'chatgpt-ui-server-settings.version'))
+
+# Answers are generated by a pool of threads detached from the responses (GENERATION_WORKERS per process), and can
+# be resumed with Last-Event-ID for GENERATION_REPLAY_TTL seconds after they finish. A request repeating the
+# Idempotency-Key header of an answered one within that delay gets the same answer replayed.
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', 32))
+GENERATION_REPLAY_TTL = int(os.getenv('GENERATION_REPLAY_TTL', 300))
+# Seconds without a frame after which a comment is sent to keep the connection open
+GENERATION_KEEP_ALIVE = int(os.getenv('GENERATION_KEEP_ALIVE', 15))
+# Stop the upstream request when the last client streaming an answer disconnects, instead of finishing it
+GENERATION_CANCEL_ON_DISCONNECT = os.getenv('GENERATION_CANCEL_ON_DISCONNECT', False) == 'True'
+# Generations are spooled to this directory so the other worker processes of the host can stream them, e.g. when a
+# conversation is open in several tabs. Set it to an empty value to keep generations in their process.
+GENERATION_SPOOL_DIR = os.getenv('GENERATION_SPOOL_DIR',
+                                 os.path.join(tempfile.gettempdir(), 'chatgpt-ui-server-generations'))
+# How the deltas of an answer are coalesced into SSE frames by default, `latency`, `balanced` or `throughput`. A
+# client can ask for another policy with the X-Stream-Flush header.
+SSE_FLUSH_POLICY = os.getenv('SSE_FLUSH_POLICY', 'balanced')
+# Seconds between two reads of a generation spooled by another worker
+GENERATION_SPOOL_POLL = float(os.getenv('GENERATION_SPOOL_POLL', 0.05))
+# Write the turns of the conversations from a background thread, the end of an answer doesn't wait for the database.
+# They are spooled to PERSISTENCE_SPOOL_DIR first, so those of a worker which dies are written by another one. Use a
+# directory which outlives the containers to keep them across restarts, an empty value keeps them in memory only.
+PERSISTENCE_WRITE_BEHIND = os.getenv('PERSISTENCE_WRITE_BEHIND', False) == 'True'
+PERSISTENCE_SPOOL_DIR = os.getenv('PERSISTENCE_SPOOL_DIR',
+                                  os.path.join(tempfile.gettempdir(), 'chatgpt-ui-server-turns'))
+# Turns queued per process, a turn saved when the queue is full is written in the request
+PERSISTENCE_QUEUE_SIZE = int(os.getenv('PERSISTENCE_QUEUE_SIZE', 1000))
+# Retries of a failed write before its turn is set aside as <file>.failed
+PERSISTENCE_RETRIES = int(os.getenv('PERSISTENCE_RETRIES', 5))
+# Seconds a request continuing a conversation waits for its turns to be written
+PERSISTENCE_FLUSH_TIMEOUT = float(os.getenv('PERSISTENCE_FLUSH_TIMEOUT', 5))
+# Connections kept open to an upstream host per client, a request waits for a free one beyond that. A client is
+# shared by the requests using the same API key, base URL and proxy.
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', GENERATION_WORKERS))
+# Upstream hosts a client keeps connections to
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 4))
+# Seconds an idle upstream connection is kept open by the async clients
+HTTP_KEEP_ALIVE = float(os.getenv('HTTP_KEEP_ALIVE', 30))
+# Limits assumed for an API key of the `openai_api_key` setting until its responses tell them, per minute
+API_KEY_RPM = int(os.getenv('API_KEY_RPM', 3500))
+API_KEY_TPM = int(os.getenv('API_KEY_TPM', 90000))
+# Longest wait in seconds for a key to have room for a request, it is sent anyway after that
+API_KEY_MAX_WAIT = float(os.getenv('API_KEY_MAX_WAIT', 10))
+# Seconds a key is not used after a 429 which doesn't tell when its limit resets
+API_KEY_COOLDOWN = float(os.getenv('API_KEY_COOLDOWN', 20))
+# Other keys tried when a completion is rate limited
+API_KEY_RETRIES = int(os.getenv('API_KEY_RETRIES', 2))
+# Accounts of the unofficial API, `email:password` separated by commas, each with a session shared by the requests.
+# Without accounts, the conversations are answered by the official API.
+UNOFFICIAL_ACCOUNTS = os.getenv('UNOFFICIAL_ACCOUNTS', '')
+# Proxy of the unofficial API, e.g. http://127.0.0.1:7890
+UNOFFICIAL_PROXY = os.getenv('UNOFFICIAL_PROXY', '')
+# Asks failing in a row before an account session is left out and created again
+UNOFFICIAL_SESSION_MAX_FAILURES = int(os.getenv('UNOFFICIAL_SESSION_MAX_FAILURES', 3))
+# Seconds a failing account session is left out
+UNOFFICIAL_SESSION_RETRY = float(os.getenv('UNOFFICIAL_SESSION_RETRY', 30))
+# Seconds before its expiry an access token of the unofficial API is renewed in the background
+ACCESS_TOKEN_REFRESH_AHEAD = float(os.getenv('ACCESS_TOKEN_REFRESH_AHEAD', 600))
+# Seconds between the checks of the access tokens by the background refresher
+ACCESS_TOKEN_REFRESH_INTERVAL = float(os.getenv('ACCESS_TOKEN_REFRESH_INTERVAL', 60))
+# Seconds a failed login is not tried again, by any worker
+ACCESS_TOKEN_RETRY = float(os.getenv('ACCESS_TOKEN_RETRY', 300))
+# Directory of the files the workers share to log in one at a time
+ACCESS_TOKEN_DIR = os.getenv('ACCESS_TOKEN_DIR', os.path.join(tempfile.gettempdir(), 'chatgpt-ui-server-auth'))
+# Threads per process sending the moderations of the unofficial API, alongside the conversation requests
+MODERATION_WORKERS = int(os.getenv('MODERATION_WORKERS', 4))
+# Moderations pending per process, a message is sent without its moderation beyond that
+MODERATION_QUEUE_SIZE = int(os.getenv('MODERATION_QUEUE_SIZE', 64))
+# Longest wait in seconds for the moderation to finish before the answer is streamed, 0 doesn't wait for it
+MODERATION_WAIT = float(os.getenv('MODERATION_WAIT', 0))
+# Where the completions requested again with the same parameters are cached: memory, sqlite, the dotted path of a
+# backend class, or empty not to cache them
+COMPLETION_CACHE_BACKEND = os.getenv('COMPLETION_CACHE_BACKEND', 'memory')
+# Database of the sqlite backend, shared by the workers of the host
+COMPLETION_CACHE_PATH = os.getenv('COMPLETION_CACHE_PATH',
+                                  os.path.join(tempfile.gettempdir(), 'chatgpt-ui-server-completions.sqlite3'))
+# Completions kept, the least recently used ones are evicted beyond that
+COMPLETION_CACHE_SIZE = int(os.getenv('COMPLETION_CACHE_SIZE', 1000))
+# Seconds a completion is kept
+COMPLETION_CACHE_TTL = float(os.getenv('COMPLETION_CACHE_TTL', 86400))
+# Highest temperature of a completion deterministic enough to be cached, only greedy sampling by default
+COMPLETION_CACHE_MAX_TEMPERATURE = float(os.getenv('COMPLETION_CACHE_MAX_TEMPERATURE', 0))
+# Cache the titles though they are sampled (temperature 0.5): the same first message then always gets its first title.
+# Off by default, and the titles are the only completions the server looks up: the cache is inert until it is set
+COMPLETION_CACHE_TITLES = os.getenv('COMPLETION_CACHE_TITLES', False) == 'True'
+
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
@@ -13,14 +13,29 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
-from chat.views import conversation, gen_title
+from chat.views import conversation, gen_title, conversation_stream, conversation_turn_stream, stop_generation, \
+    aconversation, agen_title, aconversation_stream, aconversation_turn_stream, completion_cache_stats
+
+if settings.ASYNC_VIEWS:
+    # Served by the ASGI application, long-lived streams don't hold a worker
+    conversation_view, gen_title_view, conversation_stream_view, conversation_turn_stream_view = \
+        aconversation, agen_title, aconversation_stream, aconversation_turn_stream
+else:
+    conversation_view, gen_title_view, conversation_stream_view, conversation_turn_stream_view = \
+        conversation, gen_title, conversation_stream, conversation_turn_stream
 
 urlpatterns = [
     path('api/chat/', include('chat.urls')),
-    path('api/conversation/', conversation, name='conversation'),
-    path('api/gen_title/', gen_title, name='gen_title'),
+    path('api/conversation/', conversation_view, name='conversation'),
+    # before the generation ids
+    path('api/conversation/stream/', conversation_turn_stream_view, name='conversation_turn_stream'),
+    path('api/conversation/<str:generation_id>/', conversation_stream_view, name='conversation_stream'),
+    path('api/conversation/<str:generation_id>/stop/', stop_generation, name='stop_generation'),
+    path('api/gen_title/', gen_title_view, name='gen_title'),
+    path('api/completion_cache/', completion_cache_stats, name='completion_cache_stats'),
     path('api/account/', include('account.urls')),
     path('admin/', admin.site.urls),
 ]
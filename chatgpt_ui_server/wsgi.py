@@ -9,8 +9,12 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/wsgi/
 
 import os
 
+from django.apps import apps
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatgpt_ui_server.settings')
 
 application = get_wsgi_application()
+
+# before the first request, and once in the master process with gunicorn --preload
+apps.get_app_config('chat').warm_up()
@@ -4,4 +4,10 @@ python manage.py migrate
 
 python manage.py createsuperuser --no-input
 
-exec gunicorn chatgpt_ui_server.wsgi --bind 0.0.0.0:8000 --access-logfile -
\ No newline at end of file
+# --preload loads the app, and the tokenizer encodings it warms up, once in the master process.
+# The forked workers share those pages instead of each parsing its own copy.
+if [ "$ASYNC_VIEWS" = "True" ]; then
+  exec gunicorn chatgpt_ui_server.asgi:application -k uvicorn.workers.UvicornWorker --preload --bind 0.0.0.0:8000 --access-logfile -
+else
+  exec gunicorn chatgpt_ui_server.wsgi --preload --bind 0.0.0.0:8000 --access-logfile -
+fi